@@ -0,0 +1,16 @@
+"""Пересчитывает сводку monthly_car_expenses по всем заправкам и обслуживаниям.
+
+Запуск: python backfill_monthly_expenses.py
+"""
+import logging
+
+from database import engine, MonthlyCarExpense, rebuild_monthly_expenses
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    MonthlyCarExpense.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        rebuild_monthly_expenses(conn)
+    logger.info("Сводка monthly_car_expenses пересчитана")
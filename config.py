@@ -6,6 +6,8 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     DATABASE_URL = os.getenv("DATABASE_URL")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
     
     ADMIN_IDS = []
     env_admin_ids = os.getenv("ADMIN_IDS")
@@ -20,6 +22,88 @@ class Config:
             FEEDBACK_CHAT_ID = None
     
     GIGACHAT_AUTH_KEY = os.getenv("GIGACHAT_AUTH_KEY", "")
+    GIGACHAT_MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat-2")
+    # Одновременных запросов к GigaChat и таймаут одного запроса, секунд
+    GIGACHAT_CONCURRENCY = int(os.getenv("GIGACHAT_CONCURRENCY", "4"))
+    GIGACHAT_TIMEOUT = float(os.getenv("GIGACHAT_TIMEOUT", "60"))
+    # Сколько секунд хранится совет по неизменившимся данным машины
+    AI_ADVICE_CACHE_TTL = int(os.getenv("AI_ADVICE_CACHE_TTL", str(7 * 24 * 3600)))
+    # Совет дописывается в сообщение по мере генерации; правки не чаще раза в AI_STREAM_EDIT_INTERVAL секунд
+    AI_STREAMING = os.getenv("AI_STREAMING", "true").lower() == "true"
+    AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.5"))
+    # Ночной расчёт советов для премиум-пользователей: час запуска по UTC и число параллельных запросов
+    AI_PRECOMPUTE_HOUR = int(os.getenv("AI_PRECOMPUTE_HOUR", "0"))
+    AI_PRECOMPUTE_CONCURRENCY = int(os.getenv("AI_PRECOMPUTE_CONCURRENCY", "2"))
+    # Сколько машин пользователя обрабатываются одновременно в режиме «Все автомобили»
+    AI_CARS_CONCURRENCY = int(os.getenv("AI_CARS_CONCURRENCY", "3"))
+    
+    # Ограничения для массовых уведомлений (Telegram допускает ~30 сообщений/с).
+    # Лимит действует на процесс; outbox доставляет только одна реплика (advisory lock)
+    NOTIFY_RATE_PER_SEC = float(os.getenv("NOTIFY_RATE_PER_SEC", "25"))
+    NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "10"))
+    # Лимит на один чат (~1 сообщение/с с небольшим запасом) и число повторов после 429
+    NOTIFY_PER_CHAT_RATE = float(os.getenv("NOTIFY_PER_CHAT_RATE", "1"))
+    NOTIFY_PER_CHAT_BURST = int(os.getenv("NOTIFY_PER_CHAT_BURST", "3"))
+    NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+    # Очередь уведомлений (outbox): размер пачки, число попыток и базовая задержка повтора в секундах
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+    OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "30"))
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+    
+    # Рассылка сохраняет прогресс после каждой страницы получателей
+    BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+    
+    # Напоминания рассылаются слотами по REMINDER_SLOT_MINUTES минут в местное время пользователя;
+    # без своей настройки — в DEFAULT_REMINDER_HOUR по UTC+DEFAULT_UTC_OFFSET минут (Москва)
+    REMINDER_SLOT_MINUTES = int(os.getenv("REMINDER_SLOT_MINUTES", "5"))
+    DEFAULT_REMINDER_HOUR = int(os.getenv("DEFAULT_REMINDER_HOUR", "9"))
+    DEFAULT_UTC_OFFSET = int(os.getenv("DEFAULT_UTC_OFFSET", "180"))
+    
+    # Пропущенные за время простоя слоты напоминаний досылаются, но не старше SCHEDULER_CATCHUP_HOURS часов
+    SCHEDULER_CATCHUP_HOURS = int(os.getenv("SCHEDULER_CATCHUP_HOURS", "24"))
+    
+    # Кеш статистики: по умолчанию в памяти процесса, при заданном REDIS_URL — в Redis.
+    # Несколько реплик (BOT_MODE=webhook) требуют Redis: без него кеш статистики отключается
+    REDIS_URL = os.getenv("REDIS_URL", "")
+    STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "600"))
+    STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "10000"))
+    
+    # Список заблокированных перечитывается из БД с этим интервалом, чтобы бан с другой реплики вступал в силу
+    BAN_LIST_REFRESH = int(os.getenv("BAN_LIST_REFRESH", "30"))
+    
+    # Кеш записи о пользователе (id, премиум, активные машины), которую получают хендлеры.
+    # Сброс кеша локален для реплики, поэтому TTL ограничивает, насколько устаревшей может быть запись на других
+    IDENTITY_CACHE_TTL = int(os.getenv("IDENTITY_CACHE_TTL", "30"))
+    IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "50000"))
+    
+    # Хранилище диалогов FSM: db (таблица fsm_states), redis или memory; брошенные диалоги живут FSM_STATE_TTL секунд
+    FSM_STORAGE = os.getenv("FSM_STORAGE", "db")
+    FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+    FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.2"))
+    FSM_FLUSH_BATCH = int(os.getenv("FSM_FLUSH_BATCH", "500"))
+    
+    # Режим получения апдейтов: polling (по умолчанию) или webhook (несколько реплик за балансировщиком)
+    BOT_MODE = os.getenv("BOT_MODE", "polling")
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+    WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))
+    WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "20"))
+    
+    # Фоновые задачи: воркеры для I/O, процессы для CPU-работы, лимит одновременных задач на пользователя
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+    JOB_CPU_WORKERS = int(os.getenv("JOB_CPU_WORKERS", "2"))
+    JOB_USER_LIMIT = int(os.getenv("JOB_USER_LIMIT", "1"))
+    JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+    # Аренда выполняющейся задачи (продлевается, пока воркер жив) и число попыток до пометки failed
+    JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
     
     PREMIUM_PRICE_MONTH = 50
     PREMIUM_PRICE_YEAR = 500
@@ -1,14 +1,57 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, BigInteger, Numeric, Index
+from sqlalchemy import create_engine, Column, Integer, String, Text, Float, Boolean, DateTime, ForeignKey, BigInteger, Numeric, Index
+from sqlalchemy import inspect, text, select, update, delete, and_, func, extract, event, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, relationship, Session
+from collections import defaultdict
+from datetime import datetime, timedelta
 from config import config
 
+# Асинхронные драйверы для синхронных схем подключения
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def make_async_url(database_url: str):
+    """Преобразует DATABASE_URL (psycopg2) в URL для асинхронного драйвера (asyncpg)."""
+    url = make_url(database_url)
+    driver = ASYNC_DRIVERS.get(url.drivername)
+    if not driver:
+        return url
+    url = url.set(drivername=driver)
+    # asyncpg не понимает sslmode из libpq-строки, у него параметр ssl
+    if driver == "postgresql+asyncpg" and "sslmode" in url.query:
+        query = dict(url.query)
+        query["ssl"] = query.pop("sslmode")
+        url = url.set(query=query)
+    return url
+
+# Синхронный движок оставлен для утилит командной строки
 engine = create_engine(config.DATABASE_URL, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок для обработчиков и планировщика: запросы не блокируют event loop
+async_database_url = make_async_url(config.DATABASE_URL)
+async_engine_options = {"pool_pre_ping": True}
+if async_database_url.get_backend_name() != "sqlite":
+    async_engine_options.update(pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW)
+async_engine = create_async_engine(async_database_url, **async_engine_options)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
+def next_due(last_mileage, interval_mileage, last_date, interval_months):
+    """Следующий срок замены/ТО по пробегу и по дате (месяц считается за 30 дней)."""
+    due_mileage = last_mileage + interval_mileage if interval_mileage and last_mileage is not None else None
+    due_date = last_date + timedelta(days=30 * interval_months) if interval_months and last_date is not None else None
+    return due_mileage, due_date
+
 class User(Base):
     __tablename__ = "users"
     
@@ -21,6 +64,14 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     is_premium = Column(Boolean, default=False)
     premium_until = Column(DateTime, nullable=True)
+    # False — бот заблокирован пользователем, в рассылки и напоминания он не попадает
+    is_reachable = Column(Boolean, default=True)
+    unreachable_since = Column(DateTime, nullable=True)
+    # False — напоминания приходят по одному, а не единой сводкой
+    reminder_digest = Column(Boolean, default=True)
+    # Местный час напоминаний и смещение часового пояса от UTC в минутах; NULL — значения из config
+    reminder_hour = Column(Integer, nullable=True)
+    utc_offset = Column(Integer, nullable=True)
     
     cars = relationship("Car", back_populates="owner", cascade="all, delete-orphan")
 
@@ -45,6 +96,9 @@ class Car(Base):
     to_months_interval = Column(Integer, nullable=True)
     notified_to_mileage = Column(Boolean, default=False)
     notified_to_date = Column(Boolean, default=False)
+    # Пересчитываются через update_next_due() при изменении последнего ТО или интервалов
+    next_due_mileage = Column(Float, nullable=True)
+    next_due_date = Column(DateTime, nullable=True)
     
     owner = relationship("User", back_populates="cars")
     fuel_events = relationship("FuelEvent", back_populates="car", cascade="all, delete-orphan")
@@ -52,6 +106,17 @@ class Car(Base):
     insurances = relationship("Insurance", back_populates="car", cascade="all, delete-orphan")
     parts = relationship("Part", back_populates="car", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index('ix_cars_due_mileage', 'notified_to_mileage', 'next_due_mileage', 'current_mileage'),
+        Index('ix_cars_due_date', 'notified_to_date', 'next_due_date'),
+    )
+
+    def update_next_due(self):
+        self.next_due_mileage, self.next_due_date = next_due(
+            self.last_maintenance_mileage, self.to_mileage_interval,
+            self.last_maintenance_date, self.to_months_interval
+        )
+
 class FuelEvent(Base):
     __tablename__ = "fuel_events"
     
@@ -114,9 +179,21 @@ class Part(Base):
     last_mileage = Column(Float, nullable=True, index=True)
     last_date = Column(DateTime, nullable=True, index=True)
     notified = Column(Boolean, default=False)
+    next_due_mileage = Column(Float, nullable=True)
+    next_due_date = Column(DateTime, nullable=True)
     
     car = relationship("Car", back_populates="parts")
 
+    __table_args__ = (
+        Index('ix_parts_due_mileage', 'notified', 'next_due_mileage'),
+        Index('ix_parts_due_date', 'notified', 'next_due_date'),
+    )
+
+    def update_next_due(self):
+        self.next_due_mileage, self.next_due_date = next_due(
+            self.last_mileage, self.interval_mileage, self.last_date, self.interval_months
+        )
+
 class Admin(Base):
     __tablename__ = "admins"
     
@@ -134,5 +211,271 @@ class BannedUser(Base):
     banned_by = Column(BigInteger, nullable=True)
     banned_at = Column(DateTime, default=datetime.utcnow)
 
+class MonthlyCarExpense(Base):
+    """Помесячные суммы расходов по машине, обновляются при записи заправок и обслуживания."""
+    __tablename__ = "monthly_car_expenses"
+
+    id = Column(Integer, primary_key=True, index=True)
+    car_id = Column(Integer, ForeignKey("cars.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    fuel_cost = Column(Numeric(12, 2), nullable=False, default=0)
+    fuel_liters = Column(Float, nullable=False, default=0)
+    fuel_count = Column(Integer, nullable=False, default=0)
+    maintenance_cost = Column(Numeric(12, 2), nullable=False, default=0)
+    maintenance_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint('car_id', 'year', 'month', name='uq_monthly_car_expenses_car_month'),)
+
+class Job(Base):
+    """Фоновая задача (экспорт, AI-совет, сравнение), выполняемая воркерами services/jobs.py."""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    payload = Column(Text, nullable=True)
+    priority = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False, default="queued")  # queued / running / done / failed
+    message_id = Column(BigInteger, nullable=True)  # сообщение с прогрессом, редактируется по ходу задачи
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Аренда выполняющейся задачи: воркер продлевает её, пока жив; просроченную задачу забирает другой
+    locked_until = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_jobs_status_priority', 'status', 'priority', 'id'),
+        Index('ix_jobs_chat_status', 'chat_id', 'status'),
+        # Не больше одной незавершённой задачи одного вида на чат
+        Index('uq_jobs_chat_kind_active', 'chat_id', 'kind', unique=True,
+              postgresql_where=text("status IN ('queued', 'running')"),
+              sqlite_where=text("status IN ('queued', 'running')")),
+    )
+
+class OutboxMessage(Base):
+    """Уведомление, ожидающее доставки воркером services/outbox.py."""
+    __tablename__ = "notification_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    dedup_key = Column(String, unique=True, nullable=False)  # одно и то же уведомление ставится один раз
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    options = Column(Text, nullable=True)  # JSON: parse_mode, reply_markup
+    priority = Column(Integer, nullable=False, default=1)
+    status = Column(String, nullable=False, default="pending")  # pending / sending / sent / dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_notification_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+
+class BroadcastCampaign(Base):
+    """Рассылка администратора; курсор last_user_id позволяет продолжить её после перезапуска."""
+    __tablename__ = "broadcast_campaigns"
+
+    id = Column(Integer, primary_key=True, index=True)
+    text = Column(Text, nullable=False)
+    created_by = Column(BigInteger, nullable=True)
+    status = Column(String, nullable=False, default="running")  # running / done / cancelled
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)  # заблокированные администратором
+    last_user_id = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class BroadcastDelivery(Base):
+    """Результат доставки рассылки одному получателю."""
+    __tablename__ = "broadcast_deliveries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    campaign_id = Column(Integer, ForeignKey("broadcast_campaigns.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    status = Column(String, nullable=False)  # sent / failed / skipped
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('campaign_id', 'user_id', name='uq_broadcast_deliveries_campaign_user'),)
+
+class FsmRecord(Base):
+    """Состояние и данные диалога FSM одного пользователя (services/fsm_storage.py)."""
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)  # компактный JSON
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class AdviceCacheEntry(Base):
+    """Готовый совет GigaChat по отпечатку данных машины (services/advice_cache.py)."""
+    __tablename__ = "ai_advice_cache"
+
+    fingerprint = Column(String(64), primary_key=True)  # sha256 от данных машины, модели и версии промпта
+    advice = Column(Text, nullable=False)
+    model = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class SchedulerCursor(Base):
+    """До какого момента задача планировщика уже отработала (services/scheduler.py)."""
+    __tablename__ = "scheduler_cursors"
+
+    name = Column(String, primary_key=True)
+    last_run_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+ROLLUP_FIELDS = ("fuel_cost", "fuel_liters", "fuel_count", "maintenance_cost", "maintenance_count")
+
+def expense_delta(obj, get, sign):
+    """Вклад события в помесячную сводку; get(name) возвращает нужное значение поля."""
+    date = get("date") or datetime.utcnow()
+    key = (get("car_id"), date.year, date.month)
+    cost = sign * float(get("cost") or 0)
+    if isinstance(obj, FuelEvent):
+        return key, {"fuel_cost": cost, "fuel_liters": sign * float(get("liters") or 0), "fuel_count": sign}
+    return key, {"maintenance_cost": cost, "maintenance_count": sign}
+
+def previous_value(obj, name):
+    history = inspect(obj).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(obj, name)
+
+def add_monthly_expenses(conn, key, values):
+    car_id, year, month = key
+    row = {field: values.get(field, 0) for field in ROLLUP_FIELDS}
+    if conn.dialect.name in ("postgresql", "sqlite"):
+        insert = pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert(MonthlyCarExpense).values(car_id=car_id, year=year, month=month, **row)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["car_id", "year", "month"],
+            set_={field: getattr(MonthlyCarExpense, field) + stmt.excluded[field] for field in ROLLUP_FIELDS}
+        )
+        conn.execute(stmt)
+        return
+    result = conn.execute(
+        update(MonthlyCarExpense)
+        .where(MonthlyCarExpense.car_id == car_id, MonthlyCarExpense.year == year, MonthlyCarExpense.month == month)
+        .values({field: getattr(MonthlyCarExpense, field) + value for field, value in row.items()})
+    )
+    if result.rowcount == 0:
+        conn.execute(MonthlyCarExpense.__table__.insert().values(car_id=car_id, year=year, month=month, **row))
+
+@event.listens_for(Session, "after_flush")
+def update_monthly_expenses(session, flush_context):
+    """Поддерживает monthly_car_expenses при добавлении, изменении и удалении событий через ORM.
+
+    Массовые update()/delete() по fuel_events и maintenance_events обходят этот обработчик —
+    после них сводку нужно пересчитать через rebuild_monthly_expenses.
+    """
+    deltas = defaultdict(lambda: defaultdict(float))
+
+    def collect(obj, get, sign):
+        key, values = expense_delta(obj, get, sign)
+        for field, value in values.items():
+            deltas[key][field] += value
+
+    for obj in session.new:
+        if isinstance(obj, (FuelEvent, MaintenanceEvent)):
+            collect(obj, lambda name: getattr(obj, name), 1)
+    for obj in session.deleted:
+        if isinstance(obj, (FuelEvent, MaintenanceEvent)):
+            collect(obj, lambda name: previous_value(obj, name), -1)
+    for obj in session.dirty:
+        if not isinstance(obj, (FuelEvent, MaintenanceEvent)) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[name].history.has_changes() for name in ("car_id", "date", "cost", "liters")
+                   if name in state.attrs):
+            continue
+        collect(obj, lambda name: previous_value(obj, name), -1)
+        collect(obj, lambda name: getattr(obj, name), 1)
+
+    if not deltas:
+        return
+    conn = session.connection()
+    for key, values in deltas.items():
+        add_monthly_expenses(conn, key, values)
+
+def rebuild_monthly_expenses(conn, only_if_empty=False):
+    """Пересчитывает monthly_car_expenses целиком по заправкам и обслуживаниям."""
+    if only_if_empty and conn.scalar(select(MonthlyCarExpense.id).limit(1)) is not None:
+        return
+    conn.execute(delete(MonthlyCarExpense))
+    totals = defaultdict(lambda: {field: 0 for field in ROLLUP_FIELDS})
+    for model, fields in (
+        (FuelEvent, {"fuel_cost": func.sum(FuelEvent.cost), "fuel_liters": func.sum(FuelEvent.liters),
+                     "fuel_count": func.count(FuelEvent.id)}),
+        (MaintenanceEvent, {"maintenance_cost": func.sum(MaintenanceEvent.cost),
+                            "maintenance_count": func.count(MaintenanceEvent.id)}),
+    ):
+        year = extract("year", model.date)
+        month = extract("month", model.date)
+        rows = conn.execute(
+            select(model.car_id, year, month, *fields.values())
+            .where(model.date.is_not(None))
+            .group_by(model.car_id, year, month)
+        ).all()
+        for car_id, row_year, row_month, *values in rows:
+            totals[(car_id, int(row_year), int(row_month))].update(
+                {field: value or 0 for field, value in zip(fields, values)}
+            )
+    if totals:
+        conn.execute(MonthlyCarExpense.__table__.insert(), [
+            {"car_id": car_id, "year": year, "month": month, **values}
+            for (car_id, year, month), values in totals.items()
+        ])
+
+def upgrade_schema(conn):
+    """create_all не меняет существующие таблицы: добавляем новые колонки и индексы вручную."""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def backfill_next_due(conn):
+    """Заполняет next_due_* для строк, созданных до появления этих колонок."""
+    conn.execute(update(Car).where(Car.notified_to_mileage.is_(None)).values(notified_to_mileage=False))
+    conn.execute(update(Car).where(Car.notified_to_date.is_(None)).values(notified_to_date=False))
+    conn.execute(update(Part).where(Part.notified.is_(None)).values(notified=False))
+    for model, last_mileage, interval_mileage, last_date, interval_months in (
+        (Car, Car.last_maintenance_mileage, Car.to_mileage_interval, Car.last_maintenance_date, Car.to_months_interval),
+        (Part, Part.last_mileage, Part.interval_mileage, Part.last_date, Part.interval_months),
+    ):
+        rows = conn.execute(
+            select(model.id, last_mileage, interval_mileage, last_date, interval_months).where(
+                (and_(model.next_due_mileage.is_(None), interval_mileage > 0, last_mileage.is_not(None))) |
+                (and_(model.next_due_date.is_(None), interval_months > 0, last_date.is_not(None)))
+            )
+        ).all()
+        for row_id, *inputs in rows:
+            due_mileage, due_date = next_due(*inputs)
+            conn.execute(update(model).where(model.id == row_id).values(
+                next_due_mileage=due_mileage, next_due_date=due_date
+            ))
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        upgrade_schema(conn)
+        backfill_next_due(conn)
+        rebuild_monthly_expenses(conn, only_if_empty=True)
+
+async def init_db_async():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+        await conn.run_sync(backfill_next_due)
+        await conn.run_sync(rebuild_monthly_expenses, only_if_empty=True)
@@ -1,5 +1,4 @@
 import logging
-import asyncio
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
@@ -7,14 +6,19 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from database import SessionLocal, User, Car, FuelEvent, MaintenanceEvent, Insurance, Admin, BannedUser
+from sqlalchemy import select, func
+from database import AsyncSessionLocal, User, Car, FuelEvent, MaintenanceEvent, Insurance, Admin, BannedUser, OutboxMessage
 from config import config
 from keyboards.main_menu import get_main_menu, get_more_submenu
+from services.bans import ban_list
+from services.identity import identity_cache
+from services.jobs import job_queue, PRIORITY_LOW
+from services.broadcasts import create_campaign, cancel_campaign, run_campaign, render_progress, recent_campaigns
 from handlers.scheduler_functions import (
     check_insurances,
     check_maintenance_reminders,
     check_parts_reminders,
-    send_monthly_reports
+    preview_monthly_report
 )
 
 router = Router()
@@ -32,22 +36,20 @@ class AddAdminStates(StatesGroup):
     waiting_for_id = State()
 
 # ---------- Вспомогательные функции ----------
-def is_admin(user_id: int) -> bool:
-    with SessionLocal() as db:
-        if user_id in config.ADMIN_IDS:
-            return True
-        admin = db.query(Admin).filter(Admin.telegram_id == user_id).first()
+async def is_admin(user_id: int) -> bool:
+    if user_id in config.ADMIN_IDS:
+        return True
+    async with AsyncSessionLocal() as db:
+        admin = await db.scalar(select(Admin).where(Admin.telegram_id == user_id))
         return admin is not None
 
 def is_banned(user_id: int) -> bool:
-    with SessionLocal() as db:
-        banned = db.query(BannedUser).filter(BannedUser.telegram_id == user_id).first()
-        return banned is not None
+    return user_id in ban_list
 
 # ---------- Главное меню админки ----------
 @router.message(F.text == "👑 Админ-панель")
 async def admin_panel(message: types.Message):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав доступа.")
         return
 
@@ -55,6 +57,7 @@ async def admin_panel(message: types.Message):
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="👥 Поиск пользователя", callback_data="admin_find_user")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="📋 Статус рассылок", callback_data="admin_broadcasts")],
         [InlineKeyboardButton(text="👑 Управление админами", callback_data="admin_manage_admins")],
         [InlineKeyboardButton(text="🔨 Заблокированные", callback_data="admin_banned")],
         [InlineKeyboardButton(text="🔔 Проверка оповещений", callback_data="admin_test_notifications")],
@@ -69,18 +72,23 @@ async def admin_panel(message: types.Message):
 # ---------- Статистика ----------
 @router.callback_query(F.data == "admin_stats")
 async def admin_stats(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
 
-    with SessionLocal() as db:
-        total_users = db.query(User).count()
-        total_cars = db.query(Car).count()
-        total_fuel = db.query(FuelEvent).count()
-        total_maintenance = db.query(MaintenanceEvent).count()
-        total_insurance = db.query(Insurance).count()
-        premium_users = db.query(User).filter(User.is_premium == True).count()
-        banned_count = db.query(BannedUser).count()
+    async with AsyncSessionLocal() as db:
+        total_users = await db.scalar(select(func.count()).select_from(User))
+        total_cars = await db.scalar(select(func.count()).select_from(Car))
+        total_fuel = await db.scalar(select(func.count()).select_from(FuelEvent))
+        total_maintenance = await db.scalar(select(func.count()).select_from(MaintenanceEvent))
+        total_insurance = await db.scalar(select(func.count()).select_from(Insurance))
+        premium_users = await db.scalar(select(func.count()).select_from(User).where(User.is_premium == True))
+        banned_count = await db.scalar(select(func.count()).select_from(BannedUser))
+        outbox_counts = dict((await db.execute(
+            select(OutboxMessage.status, func.count())
+            .where(OutboxMessage.status.in_(("pending", "sending", "dead")))
+            .group_by(OutboxMessage.status)
+        )).all())
 
     stats_text = (
         f"📊 *Статистика бота*\n\n"
@@ -90,7 +98,9 @@ async def admin_stats(callback: types.CallbackQuery):
         f"🔧 Обслуживаний: {total_maintenance}\n"
         f"📄 Страховок: {total_insurance}\n"
         f"💎 Премиум: {premium_users}\n"
-        f"🔨 Заблокировано: {banned_count}"
+        f"🔨 Заблокировано: {banned_count}\n"
+        f"📮 Уведомлений в очереди: {outbox_counts.get('pending', 0) + outbox_counts.get('sending', 0)}, "
+        f"не доставлено: {outbox_counts.get('dead', 0)}"
     )
     await callback.message.edit_text(stats_text, parse_mode="Markdown")
     await callback.answer()
@@ -98,7 +108,7 @@ async def admin_stats(callback: types.CallbackQuery):
 # ---------- Поиск пользователя по ID ----------
 @router.callback_query(F.data == "admin_find_user")
 async def find_user_start(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await state.set_state(FindUserStates.waiting_for_id)
@@ -110,7 +120,7 @@ async def find_user_start(callback: types.CallbackQuery, state: FSMContext):
 
 @router.message(FindUserStates.waiting_for_id)
 async def find_user_by_id(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав.")
         await state.clear()
         return
@@ -120,14 +130,14 @@ async def find_user_by_id(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите корректное число.")
         return
 
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == user_id))
         if not user:
             await message.answer("❌ Пользователь с таким ID не найден.")
             await state.clear()
             return
 
-        cars = db.query(Car).filter(Car.user_id == user.id).count()
+        cars = await db.scalar(select(func.count()).select_from(Car).where(Car.user_id == user.id))
         premium_status = "✅ Да" if user.is_premium else "❌ Нет"
         premium_until = user.premium_until.strftime('%d.%m.%Y') if user.premium_until else "—"
         banned = is_banned(user_id)
@@ -163,12 +173,12 @@ async def find_user_by_id(message: types.Message, state: FSMContext):
 # ---------- Переключение премиум-статуса (исправлено) ----------
 @router.callback_query(F.data.startswith("admin_toggle_premium_"))
 async def toggle_premium(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     target_id = int(callback.data.split("_")[-1])
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == target_id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == target_id))
         if user:
             user.is_premium = not user.is_premium
             if user.is_premium:
@@ -180,7 +190,8 @@ async def toggle_premium(callback: types.CallbackQuery):
                 user.premium_until = base_date + timedelta(days=365)
             else:
                 user.premium_until = None
-            db.commit()
+            await db.commit()
+            identity_cache.invalidate(target_id)
             await callback.answer(f"Статус премиума изменён: {'включён' if user.is_premium else 'отключён'}", show_alert=True)
         else:
             await callback.answer("❌ Пользователь не найден", show_alert=True)
@@ -195,15 +206,16 @@ async def toggle_premium(callback: types.CallbackQuery):
 # ---------- Блокировка/разблокировка ----------
 @router.callback_query(F.data.startswith("admin_toggle_ban_"))
 async def toggle_ban(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     target_id = int(callback.data.split("_")[-1])
-    with SessionLocal() as db:
-        banned = db.query(BannedUser).filter(BannedUser.telegram_id == target_id).first()
+    async with AsyncSessionLocal() as db:
+        banned = await db.scalar(select(BannedUser).where(BannedUser.telegram_id == target_id))
         if banned:
-            db.delete(banned)
-            db.commit()
+            await db.delete(banned)
+            await db.commit()
+            ban_list.remove(target_id)
             await callback.answer("✅ Пользователь разблокирован", show_alert=True)
         else:
             new_ban = BannedUser(
@@ -212,7 +224,8 @@ async def toggle_ban(callback: types.CallbackQuery):
                 reason="Заблокирован администратором"
             )
             db.add(new_ban)
-            db.commit()
+            await db.commit()
+            ban_list.add(target_id)
             await callback.answer("❌ Пользователь заблокирован", show_alert=True)
     await callback.message.edit_text("✅ Статус обновлён.")
     await callback.message.answer(
@@ -225,12 +238,12 @@ async def toggle_ban(callback: types.CallbackQuery):
 # ---------- Управление администраторами ----------
 @router.callback_query(F.data == "admin_manage_admins")
 async def manage_admins(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
 
-    with SessionLocal() as db:
-        admins = db.query(Admin).all()
+    async with AsyncSessionLocal() as db:
+        admins = (await db.scalars(select(Admin))).all()
         admin_list = "\n".join([f"• `{a.telegram_id}` (добавлен {a.added_at.strftime('%d.%m.%Y')})" for a in admins])
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -248,7 +261,7 @@ async def manage_admins(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "admin_add")
 async def add_admin_start(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await state.set_state(AddAdminStates.waiting_for_id)
@@ -259,7 +272,7 @@ async def add_admin_start(callback: types.CallbackQuery, state: FSMContext):
 
 @router.message(AddAdminStates.waiting_for_id)
 async def add_admin_by_id(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав.")
         await state.clear()
         return
@@ -269,26 +282,26 @@ async def add_admin_by_id(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите корректное число.")
         return
 
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == new_admin_id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == new_admin_id))
         if not user:
             await message.answer("❌ Пользователь с таким ID не найден в базе. Сначала он должен зарегистрироваться (отправить /start).")
             await state.clear()
             return
-        existing = db.query(Admin).filter(Admin.telegram_id == new_admin_id).first()
+        existing = await db.scalar(select(Admin).where(Admin.telegram_id == new_admin_id))
         if existing:
             await message.answer("❌ Этот пользователь уже является администратором.")
             await state.clear()
             return
         new_admin = Admin(telegram_id=new_admin_id, added_by=message.from_user.id)
         db.add(new_admin)
-        db.commit()
+        await db.commit()
         await message.answer(f"✅ Пользователь `{new_admin_id}` теперь администратор.", parse_mode="Markdown")
     await state.clear()
 
 @router.callback_query(F.data == "admin_remove")
 async def remove_admin_start(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await state.set_state(AddAdminStates.waiting_for_id)
@@ -299,7 +312,7 @@ async def remove_admin_start(callback: types.CallbackQuery, state: FSMContext):
 
 @router.message(AddAdminStates.waiting_for_id)
 async def remove_admin_by_id(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав.")
         await state.clear()
         return
@@ -314,21 +327,21 @@ async def remove_admin_by_id(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    with SessionLocal() as db:
-        admin = db.query(Admin).filter(Admin.telegram_id == admin_id).first()
+    async with AsyncSessionLocal() as db:
+        admin = await db.scalar(select(Admin).where(Admin.telegram_id == admin_id))
         if not admin:
             await message.answer("❌ Администратор с таким ID не найден.")
             await state.clear()
             return
-        db.delete(admin)
-        db.commit()
+        await db.delete(admin)
+        await db.commit()
         await message.answer(f"✅ Администратор `{admin_id}` удалён.", parse_mode="Markdown")
     await state.clear()
 
 # ---------- Рассылка ----------
 @router.callback_query(F.data == "admin_broadcast")
 async def broadcast_start(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await state.set_state(BroadcastStates.waiting_for_message)
@@ -340,7 +353,7 @@ async def broadcast_start(callback: types.CallbackQuery, state: FSMContext):
 
 @router.message(BroadcastStates.waiting_for_message)
 async def broadcast_receive(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав.")
         await state.clear()
         return
@@ -358,7 +371,7 @@ async def broadcast_receive(message: types.Message, state: FSMContext):
 
 @router.callback_query(F.data == "broadcast_confirm")
 async def broadcast_confirm(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     data = await state.get_data()
@@ -368,25 +381,53 @@ async def broadcast_confirm(callback: types.CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    await callback.message.edit_text("⏳ Начинаю рассылку...")
-    sent = 0
-    failed = 0
-    with SessionLocal() as db:
-        users = db.query(User).all()
-        for user in users:
-            if is_banned(user.telegram_id):
-                continue
-            try:
-                await callback.bot.send_message(user.telegram_id, text, parse_mode="Markdown")
-                sent += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Ошибка отправки пользователю {user.telegram_id}: {e}")
-                failed += 1
-    await callback.message.edit_text(
-        f"✅ Рассылка завершена.\nУспешно: {sent}\nОшибок: {failed}"
+    # Рассылка выполняется фоновой задачей и переживает перезапуск бота
+    campaign = await create_campaign(text, callback.from_user.id)
+    job_id = await job_queue.enqueue(
+        callback.bot, "broadcast", callback.message.chat.id, {"campaign_id": campaign.id},
+        priority=PRIORITY_LOW, text=render_progress(campaign)
     )
+    if job_id is None:
+        await cancel_campaign(campaign.id)
+        await callback.message.edit_text("❌ Дождитесь окончания текущей рассылки.")
+    else:
+        await callback.message.edit_text(f"✅ Рассылка #{campaign.id} запущена, прогресс — в следующем сообщении.")
     await state.clear()
+    await callback.answer()
+
+# Долгая рассылка не должна занимать лимит задач администратора (выгрузки, AI-советы)
+@job_queue.handler("broadcast", user_limit=False)
+async def broadcast_job(ctx):
+    await run_campaign(ctx.bot, ctx.payload["campaign_id"], ctx.progress)
+
+@job_queue.on_failure("broadcast")
+async def broadcast_job_failed(ctx):
+    # Иначе рассылка навсегда осталась бы «идёт» с кнопкой остановки
+    await cancel_campaign(ctx.payload["campaign_id"], status="failed")
+
+@router.callback_query(F.data.startswith("broadcast_stop_"))
+async def broadcast_stop(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+    campaign_id = int(callback.data.split("_")[-1])
+    if await cancel_campaign(campaign_id):
+        await callback.answer("Рассылка будет остановлена после текущей пачки.", show_alert=True)
+    else:
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
+
+@router.callback_query(F.data == "admin_broadcasts")
+async def broadcasts_status(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+    campaigns = await recent_campaigns()
+    if not campaigns:
+        text = "📋 Рассылок пока не было."
+    else:
+        text = "\n\n".join(render_progress(campaign) for campaign in campaigns)
+    await callback.message.edit_text(text)
+    await callback.answer()
 
 @router.callback_query(F.data == "broadcast_cancel")
 async def broadcast_cancel(callback: types.CallbackQuery, state: FSMContext):
@@ -397,11 +438,11 @@ async def broadcast_cancel(callback: types.CallbackQuery, state: FSMContext):
 # ---------- Список заблокированных ----------
 @router.callback_query(F.data == "admin_banned")
 async def banned_list(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
-    with SessionLocal() as db:
-        banned = db.query(BannedUser).all()
+    async with AsyncSessionLocal() as db:
+        banned = (await db.scalars(select(BannedUser))).all()
         if not banned:
             await callback.message.edit_text("✅ Заблокированных пользователей нет.")
             return
@@ -417,7 +458,7 @@ async def banned_list(callback: types.CallbackQuery):
 # ---------- Проверка оповещений ----------
 @router.callback_query(F.data == "admin_test_notifications")
 async def admin_test_notifications(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
 
@@ -425,7 +466,7 @@ async def admin_test_notifications(callback: types.CallbackQuery):
         [InlineKeyboardButton(text="📅 Страховки", callback_data="test_insurances")],
         [InlineKeyboardButton(text="🔧 ТО", callback_data="test_maintenance")],
         [InlineKeyboardButton(text="⚙️ Детали/жидкости", callback_data="test_parts")],
-        [InlineKeyboardButton(text="📊 Ежемесячные отчёты", callback_data="test_monthly")],
+        [InlineKeyboardButton(text="📊 Ежемесячный отчёт (себе)", callback_data="test_monthly")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel_back")]
     ])
     await callback.message.edit_text(
@@ -438,7 +479,7 @@ async def admin_test_notifications(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "test_insurances")
 async def test_insurances_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await callback.message.edit_text("⏳ Проверяю страховки...")
@@ -450,7 +491,7 @@ async def test_insurances_callback(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "test_maintenance")
 async def test_maintenance_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await callback.message.edit_text("⏳ Проверяю напоминания ТО...")
@@ -462,7 +503,7 @@ async def test_maintenance_callback(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "test_parts")
 async def test_parts_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await callback.message.edit_text("⏳ Проверяю замены деталей...")
@@ -474,12 +515,19 @@ async def test_parts_callback(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "test_monthly")
 async def test_monthly_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
-    await callback.message.edit_text("⏳ Отправляю ежемесячные отчёты...")
-    await send_monthly_reports(callback.bot)
-    await callback.message.edit_text("✅ Ежемесячные отчёты отправлены.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+    # Пользователям отчёты рассылает планировщик 1-го числа; здесь администратор получает только свой,
+    # напрямую, без outbox, чтобы не занять ключ настоящего отчёта
+    report = await preview_monthly_report(callback.from_user.id)
+    if report is None:
+        status = "❌ Вы не зарегистрированы как пользователь бота — отчёт не сформирован."
+    else:
+        text, options = report
+        await callback.message.answer(text, **options)
+        status = "✅ Ваш ежемесячный отчёт отправлен вам. Пользователям отчёты рассылаются 1-го числа."
+    await callback.message.edit_text(status, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_test_notifications")]
     ]))
     await callback.answer()
@@ -487,7 +535,7 @@ async def test_monthly_callback(callback: types.CallbackQuery):
 # ---------- Кнопка "Назад" в админ-панель ----------
 @router.callback_query(F.data == "admin_panel_back")
 async def back_to_admin_panel(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     await admin_panel(callback.message)
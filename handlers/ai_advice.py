@@ -1,79 +1,64 @@
-import logging
 import asyncio
-import uuid
-import time
-import httpx
+import logging
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
-from openai import AsyncOpenAI
-from sqlalchemy import func
+from sqlalchemy import select, func
 
-from database import SessionLocal, User, Car, FuelEvent, MaintenanceEvent, Insurance, Part
+from database import AsyncSessionLocal, Car, FuelEvent, MaintenanceEvent, Insurance, Part
 from keyboards.main_menu import get_stats_submenu
 from config import config
+from services.jobs import job_queue, PRIORITY_NORMAL
+from services.identity import Identity
+from services.gigachat import gigachat, GigaChatAuthError
+from services.advice_cache import advice_cache, advice_fingerprint
+from utils.streaming import StreamingMessage
 
 router = Router()
 logger = logging.getLogger(__name__)
 
-GIGACHAT_AUTH_KEY = config.GIGACHAT_AUTH_KEY
-GIGACHAT_API_URL = "https://gigachat.devices.sberbank.ru/api/v1"
-TOKEN_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+# Меняется вместе с текстом промпта, чтобы старые советы в кеше не использовались
+PROMPT_VERSION = 2
 
-# Кеш для токена
-_token_cache = {
-    "access_token": None,
-    "expires_at": 0
-}
+# Совет хранится в кеше до недели, поэтому в промпт попадают не точные дни до срока, а грубые интервалы:
+# точное число дней в кешированном тексте быстро устарело бы
+DUE_BUCKETS = ((0, "срок истёк"), (7, "меньше недели"), (30, "меньше месяца"), (90, "меньше трёх месяцев"))
 
-# Единый HTTP-клиент
-http_client = httpx.AsyncClient(verify=False, timeout=30.0)
+def due_bucket(days_left: int) -> str:
+    for limit, label in DUE_BUCKETS:
+        if days_left < limit:
+            return label
+    return "больше трёх месяцев"
 
-async def get_gigachat_access_token() -> str | None:
-    if _token_cache["access_token"] and time.time() < _token_cache["expires_at"]:
-        return _token_cache["access_token"]
-
-    if not GIGACHAT_AUTH_KEY:
-        logger.error("GIGACHAT_AUTH_KEY не задан")
-        return None
+def render_due(car_data: dict, today=None) -> dict:
+    """Сроки относительно текущей даты в виде интервалов; входят в ключ кеша, поэтому совет
+    пересчитывается, когда срок переходит в следующий интервал."""
+    today = today or datetime.utcnow().date()
+    if car_data["insurance_end"]:
+        end_date = datetime.fromisoformat(car_data["insurance_end"]).date()
+        insurance_date = end_date.strftime('%d.%m.%Y')
+        insurance_left = due_bucket((end_date - today).days)
+    else:
+        insurance_date = "не оформлена"
+        insurance_left = "—"
 
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-        "RqUID": str(uuid.uuid4()),
-        "Authorization": f"Basic {GIGACHAT_AUTH_KEY}"
+    parts_list = []
+    for name, remaining, next_date in car_data["parts"]:
+        if remaining is not None and 0 < remaining < 10000:
+            parts_list.append(f"{name} (осталось {remaining:,.0f} км)")
+        if next_date is not None:
+            days_left = (datetime.fromisoformat(next_date).date() - today).days
+            if 0 < days_left < 90:
+                parts_list.append(f"{name} (до замены {due_bucket(days_left)})")
+    return {
+        "insurance_date": insurance_date,
+        "insurance_left": insurance_left,
+        "parts_list": ", ".join(parts_list) if parts_list else "нет ближайших замен",
     }
-    payload = "scope=GIGACHAT_API_PERS"
-
-    try:
-        async with httpx.AsyncClient(verify=False) as session:
-            response = await session.post(TOKEN_URL, headers=headers, data=payload)
-            if response.status_code == 200:
-                data = response.json()
-                access_token = data.get("access_token")
-                expires_in = data.get("expires_in", 1800)
-                _token_cache["access_token"] = access_token
-                _token_cache["expires_at"] = time.time() + expires_in - 60
-                logger.info("GigaChat access token получен успешно")
-                return access_token
-            else:
-                logger.error(f"Ошибка получения токена GigaChat: {response.status_code} - {response.text}")
-                return None
-    except Exception as e:
-        logger.exception(f"Исключение при получении токена GigaChat: {e}")
-        return None
 
-async def get_ai_advice(car_data: dict) -> str:
-    access_token = await get_gigachat_access_token()
-    if not access_token:
-        return "❌ Не удалось авторизоваться в GigaChat. Попробуйте позже."
-
-    openai_client = AsyncOpenAI(
-        base_url=GIGACHAT_API_URL,
-        api_key=access_token,
-        http_client=http_client
-    )
-
-    prompt = (
+def build_prompt(car_data: dict) -> str:
+    due = render_due(car_data)
+    return (
         "Ты – опытный автомеханик с 20-летним стажем. Проанализируй данные автомобиля и дай подробные, практические рекомендации по его обслуживанию. "
         "Учитывай пробег, возраст, расход топлива, историю ТО, страховки, предстоящие замены деталей. Если какие-то данные отсутствуют – отметь это. "
         "Пиши дружелюбно, профессионально, но понятно для обычного водителя. Не выдумывай несуществующие проблемы, но укажи на возможные риски. "
@@ -86,96 +71,195 @@ async def get_ai_advice(car_data: dict) -> str:
         f"- Средний расход топлива: {car_data['consumption']} л/100км\n"
         f"- Последнее ТО: пробег {car_data['last_to_mileage']}, дата {car_data['last_to_date']}\n"
         f"- Интервалы ТО: по пробегу {car_data['to_mileage_interval']}, по времени {car_data['to_months_interval']}\n"
-        f"- Страховка: действует до {car_data['insurance_date']}, дней осталось {car_data['insurance_days']}\n"
-        f"- Детали к замене (ближайшие): {car_data['parts_list']}\n\n"
+        f"- Страховка: действует до {due['insurance_date']}, до окончания {due['insurance_left']}\n"
+        f"- Детали к замене (ближайшие): {due['parts_list']}\n\n"
         "Дай советы по дальнейшей эксплуатации и обслуживанию."
     )
 
+def advice_messages(car_data: dict) -> list[dict]:
+    return [
+        {"role": "system", "content": "Ты – опытный автомеханик, дающий полезные советы."},
+        {"role": "user", "content": build_prompt(car_data)}
+    ]
+
+def car_fingerprint(car_data: dict) -> str:
+    return advice_fingerprint({**car_data, "due": render_due(car_data)}, config.GIGACHAT_MODEL, PROMPT_VERSION)
+
+async def save_advice(fingerprint: str, advice: str):
+    # В кеш попадают только успешные ответы; сбой кеша не должен стоить пользователю совета
     try:
-        response = await openai_client.chat.completions.create(
-            model="GigaChat-2",
-            messages=[
-                {"role": "system", "content": "Ты – опытный автомеханик, дающий полезные советы."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1000
-        )
-        advice = response.choices[0].message.content
-        return advice.strip() if advice else "❌ Не удалось получить совет от GigaChat."
+        await advice_cache.put(fingerprint, advice, config.GIGACHAT_MODEL)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить AI-совет в кеш: {e}")
+
+async def generate_advice(car_data: dict, fingerprint: str | None = None) -> str | None:
+    """Запрашивает совет у GigaChat в обход кеша и сохраняет успешный ответ. Ошибки API пробрасываются."""
+    response = await gigachat.chat(advice_messages(car_data), temperature=0.7, max_tokens=1000)
+    advice = (response.choices[0].message.content or "").strip()
+    if not advice:
+        return None
+    await save_advice(fingerprint or car_fingerprint(car_data), advice)
+    return advice
+
+async def get_ai_advice(car_data: dict) -> str:
+    fingerprint = car_fingerprint(car_data)
+    cached = await advice_cache.get(fingerprint)
+    if cached:
+        return cached
+
+    try:
+        advice = await generate_advice(car_data, fingerprint)
+        return advice or "❌ Не удалось получить совет от GigaChat."
+    except GigaChatAuthError as e:
+        logger.error(f"Ошибка получения токена GigaChat: {e}")
+        return "❌ Не удалось авторизоваться в GigaChat. Попробуйте позже."
     except Exception as e:
         logger.exception(f"Ошибка при запросе к GigaChat: {e}")
         return "❌ Произошла ошибка при генерации совета. Попробуйте позже."
 
+async def stream_ai_advice(reply: StreamingMessage, car_data: dict):
+    """Дописывает совет в reply по мере генерации; готовый ответ сохраняется в кеш."""
+    parts = []
+    try:
+        async for delta in gigachat.stream(advice_messages(car_data), temperature=0.7, max_tokens=1000):
+            parts.append(delta)
+            await reply.append(delta)
+    except GigaChatAuthError as e:
+        logger.error(f"Ошибка получения токена GigaChat: {e}")
+        await reply.append("❌ Не удалось авторизоваться в GigaChat. Попробуйте позже.")
+    except Exception as e:
+        logger.exception(f"Ошибка при потоковом запросе к GigaChat: {e}")
+        if parts:
+            await reply.append("\n\n⚠️ Ответ прерван, попробуйте запросить совет ещё раз.")
+        else:
+            await reply.append("❌ Произошла ошибка при генерации совета. Попробуйте позже.")
+    else:
+        advice = "".join(parts).strip()
+        if advice:
+            await save_advice(car_fingerprint(car_data), advice)
+        else:
+            await reply.append("❌ Не удалось получить совет от GigaChat.")
+    await reply.finish(parse_mode="Markdown", reply_markup=get_stats_submenu())
+
 # --- Обработчик кнопки ---
 @router.message(F.text == "🤖 AI-совет (Premium)")
-async def premium_stats(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
+async def premium_stats(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
 
-        is_admin = message.from_user.id in config.ADMIN_IDS
-        if not user.is_premium and not is_admin:
-            await message.answer(
-                "❌ *AI-советы* доступны только для премиум-пользователей.\n\n"
-                "Оформите подписку, чтобы получать персональные рекомендации по обслуживанию авто.",
-                parse_mode="Markdown",
-                reply_markup=get_stats_submenu()
-            )
-            return
+    is_admin = message.from_user.id in config.ADMIN_IDS
+    if not identity.is_premium and not is_admin:
+        await message.answer(
+            "❌ *AI-советы* доступны только для премиум-пользователей.\n\n"
+            "Оформите подписку, чтобы получать персональные рекомендации по обслуживанию авто.",
+            parse_mode="Markdown",
+            reply_markup=get_stats_submenu()
+        )
+        return
 
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_stats_submenu())
-            return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_stats_submenu())
+        return
 
-        wait_msg = await message.answer("⏳ Запрос обрабатывается, это может занять несколько секунд...")
-
-        car = cars[0]  # берём первый авто
-
-        # Расчёт среднего расхода
-        fuel_events = db.query(FuelEvent).filter(FuelEvent.car_id == car.id).order_by(FuelEvent.date.desc()).limit(10).all()
-        if len(fuel_events) >= 2:
-            total_liters = sum(ev.liters for ev in fuel_events if ev.liters)
-            total_distance = 0
-            prev = None
-            for ev in sorted(fuel_events, key=lambda x: x.date):
-                if prev and ev.mileage and prev.mileage and ev.mileage > prev.mileage:
-                    total_distance += ev.mileage - prev.mileage
-                prev = ev
-            avg_consumption = (total_liters / total_distance * 100) if total_distance > 0 else 0
-        else:
-            avg_consumption = 0
-
-        # Страховка
-        insurances = db.query(Insurance).filter(Insurance.car_id == car.id).all()
-        if insurances:
-            nearest = min(insurances, key=lambda x: x.end_date)
-            insurance_date = nearest.end_date.strftime('%d.%m.%Y')
-            insurance_days = (nearest.end_date.date() - datetime.utcnow().date()).days
-        else:
-            insurance_date = "не оформлена"
-            insurance_days = "—"
+    if len(identity.cars) > 1:
+        await message.answer("Для какого автомобиля подготовить совет?", reply_markup=cars_choice_keyboard(identity.cars))
+        return
+
+    await enqueue_advice(message.bot, message.chat.id, identity.user_id, [identity.cars[0].id])
+
+def cars_choice_keyboard(cars):
+    keyboard = [
+        [types.InlineKeyboardButton(text=f"{car.brand} {car.model}", callback_data=f"ai_car_{car.id}")]
+        for car in cars
+    ]
+    keyboard.append([types.InlineKeyboardButton(text="🚘 Все автомобили", callback_data="ai_car_all")])
+    return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def enqueue_advice(bot, chat_id: int, user_id: int, car_ids: list[int]):
+    await job_queue.enqueue(
+        bot, "ai_advice", chat_id, {"user_id": user_id, "car_ids": car_ids},
+        priority=PRIORITY_NORMAL, text="⏳ Запрос обрабатывается, это может занять несколько секунд..."
+    )
+
+@router.callback_query(F.data.startswith("ai_car_"))
+async def choose_advice_car(callback: types.CallbackQuery, identity: Identity | None):
+    if not identity or (not identity.is_premium and callback.from_user.id not in config.ADMIN_IDS):
+        await callback.answer("❌ AI-советы доступны только для премиум-пользователей", show_alert=True)
+        return
+    choice = callback.data.removeprefix("ai_car_")
+    car_ids = identity.car_ids if choice == "all" else [int(choice)]
+    if not car_ids or not set(car_ids) <= set(identity.car_ids):
+        await callback.answer("Автомобиль не найден", show_alert=True)
+        return
+    await callback.message.delete()
+    await enqueue_advice(callback.bot, callback.message.chat.id, identity.user_id, car_ids)
+    await callback.answer()
+
+# Сколько последних заправок учитывать при расчёте расхода
+FUEL_EVENTS_FOR_CONSUMPTION = 10
+
+def average_consumption(fuel_events) -> float:
+    """Средний расход по заправкам (date, liters, mileage) одной машины."""
+    if len(fuel_events) < 2:
+        return 0
+    total_liters = sum(ev.liters for ev in fuel_events if ev.liters)
+    total_distance = 0
+    prev = None
+    for ev in sorted(fuel_events, key=lambda x: x.date):
+        if prev and ev.mileage and prev.mileage and ev.mileage > prev.mileage:
+            total_distance += ev.mileage - prev.mileage
+        prev = ev
+    return (total_liters / total_distance * 100) if total_distance > 0 else 0
+
+async def build_cars_data(db, cars) -> dict:
+    """Сводки для промпта GigaChat сразу по нескольким машинам: {car.id: car_data}.
+    Заправки, страховки и детали читаются тремя групповыми запросами, а не по запросу на машину.
+    car_data содержит только данные машины без отсчёта от сегодняшней даты — по ним строится ключ кеша."""
+    car_ids = [car.id for car in cars]
+    if not car_ids:
+        return {}
+
+    ranked = (
+        select(
+            FuelEvent.car_id, FuelEvent.date, FuelEvent.liters, FuelEvent.mileage,
+            func.row_number().over(partition_by=FuelEvent.car_id, order_by=FuelEvent.date.desc()).label("rn")
+        )
+        .where(FuelEvent.car_id.in_(car_ids))
+        .subquery()
+    )
+    fuel_by_car = {}
+    for row in (await db.execute(select(ranked).where(ranked.c.rn <= FUEL_EVENTS_FOR_CONSUMPTION))).all():
+        fuel_by_car.setdefault(row.car_id, []).append(row)
+
+    # Ближайшая по дате окончания страховка
+    insurance_by_car = dict((await db.execute(
+        select(Insurance.car_id, func.min(Insurance.end_date))
+        .where(Insurance.car_id.in_(car_ids))
+        .group_by(Insurance.car_id)
+    )).all())
+
+    parts_by_car = {}
+    for part in (await db.scalars(select(Part).where(Part.car_id.in_(car_ids)))).all():
+        parts_by_car.setdefault(part.car_id, []).append(part)
 
-        # Детали к замене
-        parts = db.query(Part).filter(Part.car_id == car.id).all()
-        parts_list = []
-        for part in parts:
+    result = {}
+    for car in cars:
+        avg_consumption = average_consumption(fuel_by_car.get(car.id, []))
+
+        # Только сроки и остатки, не зависящие от текущей даты: иначе ключ кеша менялся бы каждый день
+        parts = []
+        for part in parts_by_car.get(car.id, []):
+            remaining = next_date = None
             if part.interval_mileage and part.last_mileage is not None:
-                next_mileage = part.last_mileage + part.interval_mileage
-                remaining = next_mileage - car.current_mileage
-                if 0 < remaining < 10000:
-                    parts_list.append(f"{part.name} (осталось {remaining:,.0f} км)")
+                remaining = part.last_mileage + part.interval_mileage - car.current_mileage
             if part.interval_months and part.last_date is not None:
-                next_date = part.last_date + timedelta(days=30 * part.interval_months)
-                days_left = (next_date.date() - datetime.utcnow().date()).days
-                if 0 < days_left < 90:
-                    parts_list.append(f"{part.name} (осталось {days_left} дн.)")
-        parts_str = ", ".join(parts_list) if parts_list else "нет ближайших замен"
+                next_date = (part.last_date + timedelta(days=30 * part.interval_months)).date().isoformat()
+            if remaining is not None or next_date is not None:
+                parts.append([part.name, remaining, next_date])
+        end_date = insurance_by_car.get(car.id)
 
-        car_data = {
+        result[car.id] = {
             "brand": car.brand,
             "model": car.model,
             "year": car.year,
@@ -185,16 +269,61 @@ async def premium_stats(message: types.Message):
             "last_to_date": car.last_maintenance_date.strftime('%d.%m.%Y') if car.last_maintenance_date else "нет данных",
             "to_mileage_interval": f"{car.to_mileage_interval:,.0f}" if car.to_mileage_interval else "не задан",
             "to_months_interval": f"{car.to_months_interval}" if car.to_months_interval else "не задан",
-            "insurance_date": insurance_date,
-            "insurance_days": str(insurance_days),
-            "parts_list": parts_str
+            "insurance_end": end_date.date().isoformat() if end_date else None,
+            "parts": sorted(parts, key=lambda p: (p[0], p[1] or 0, p[2] or ""))
         }
+    return result
 
-        advice = await get_ai_advice(car_data)
+async def send_car_advice(ctx, car, car_data: dict, use_progress: bool = False):
+    """Совет по одной машине: из кеша сразу, иначе потоково или одним сообщением.
+    С use_progress сообщение с прогрессом задачи заменяется ответом."""
+    header = f"🤖 *AI-совет для {car.brand} {car.model}:*\n\n"
+    advice = await advice_cache.get(car_fingerprint(car_data))
+    if advice is None and config.AI_STREAMING:
+        message_id = None
+        if use_progress:
+            # Сообщение с прогрессом превращается в ответ, который дописывается по мере генерации
+            message_id, ctx.message_id = ctx.message_id, None
+        reply = StreamingMessage(ctx.bot, ctx.chat_id, header, message_id=message_id,
+                                 interval=config.AI_STREAM_EDIT_INTERVAL)
+        await stream_ai_advice(reply, car_data)
+        return
+    advice = advice or await get_ai_advice(car_data)
+    if use_progress:
+        await ctx.delete_progress()
+    await ctx.bot.send_message(ctx.chat_id, header + advice, parse_mode="Markdown", reply_markup=get_stats_submenu())
 
-        await wait_msg.delete()
-        await message.answer(
-            f"🤖 *AI-совет для {car.brand} {car.model}:*\n\n{advice}",
-            parse_mode="Markdown",
-            reply_markup=get_stats_submenu()
-        )
+@job_queue.handler("ai_advice")
+async def ai_advice_job(ctx):
+    async with AsyncSessionLocal() as db:
+        stmt = select(Car).where(Car.user_id == ctx.payload["user_id"], Car.is_active == True).order_by(Car.id)
+        # Задачи, поставленные до выбора машины, содержат только user_id — берём первый авто
+        if ctx.payload.get("car_ids"):
+            stmt = stmt.where(Car.id.in_(ctx.payload["car_ids"]))
+        else:
+            stmt = stmt.limit(1)
+        cars = (await db.scalars(stmt)).all()
+        if not cars:
+            await ctx.progress("У вас нет автомобилей.")
+            return
+        cars_data = await build_cars_data(db, cars)
+
+    # Запрос к GigaChat идёт долго, поэтому соединение с БД к этому моменту уже возвращено в пул
+    if len(cars) == 1:
+        await ctx.progress("🤖 Готовлю рекомендации...")
+        await send_car_advice(ctx, cars[0], cars_data[cars[0].id], use_progress=True)
+        return
+
+    # Несколько машин: запросы идут параллельно, каждый совет приходит отдельным сообщением по готовности
+    await ctx.progress(f"🤖 Готовлю рекомендации для {len(cars)} автомобилей...")
+    semaphore = asyncio.Semaphore(config.AI_CARS_CONCURRENCY)
+
+    async def advise(car):
+        async with semaphore:
+            await send_car_advice(ctx, car, cars_data[car.id])
+
+    results = await asyncio.gather(*(advise(car) for car in cars), return_exceptions=True)
+    for car, result in zip(cars, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка AI-совета для машины {car.id}: {result}")
+    await ctx.delete_progress()
@@ -6,8 +6,11 @@ from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime
 from config import config
 
-from database import SessionLocal, Car, User
+from sqlalchemy import select
+from database import AsyncSessionLocal, Car, User
 from keyboards.main_menu import get_cars_submenu, get_cancel_keyboard, get_skip_keyboard
+from services.stats_cache import stats_cache
+from services.identity import Identity, identity_cache
 from car_data import BRANDS, MODELS_BY_BRAND
 
 router = Router()
@@ -25,16 +28,15 @@ class CarStates(StatesGroup):
     waiting_for_new_mileage = State()
 
 @router.message(F.text == "🚗 Список авто")
-async def list_cars(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет добавленных автомобилей.", reply_markup=get_cars_submenu())
-            return
+async def list_cars(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет добавленных автомобилей.", reply_markup=get_cars_submenu())
+        return
+    async with AsyncSessionLocal() as db:
+        cars = (await db.scalars(select(Car).where(Car.user_id == identity.user_id, Car.is_active == True))).all()
         text = "🚗 *Ваши автомобили:*\n\n"
         for car in cars:
             text += f"• {car.brand} {car.model} {car.year}г.\n"
@@ -44,21 +46,17 @@ async def list_cars(message: types.Message):
         await message.answer(text, parse_mode="Markdown", reply_markup=get_cars_submenu())
 
 @router.message(F.text == "➕ Добавить авто")
-async def add_car_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        if not user.is_premium and message.from_user.id not in config.ADMIN_IDS:
-            car_count = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).count()
-            if car_count >= 1:
-                await message.answer(
-                    "❌ В бесплатной версии можно добавить только один автомобиль.\n"
-                    "Чтобы добавить больше, оформите Premium-подписку.",
-                    reply_markup=get_cars_submenu()
-                )
-                return
+async def add_car_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.is_premium and message.from_user.id not in config.ADMIN_IDS and len(identity.cars) >= 1:
+        await message.answer(
+            "❌ В бесплатной версии можно добавить только один автомобиль.\n"
+            "Чтобы добавить больше, оформите Premium-подписку.",
+            reply_markup=get_cars_submenu()
+        )
+        return
     await state.set_state(CarStates.waiting_for_brand)
     await message.answer("Выберите марку автомобиля:", reply_markup=get_brands_keyboard())
 
@@ -176,8 +174,8 @@ async def fuel_chosen(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == callback.from_user.id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == callback.from_user.id))
         if not user:
             await callback.message.answer("❌ Ошибка: пользователь не найден.")
             await state.clear()
@@ -194,7 +192,9 @@ async def fuel_chosen(callback: types.CallbackQuery, state: FSMContext):
             is_active=True
         )
         db.add(new_car)
-        db.commit()
+        await db.commit()
+        await stats_cache.invalidate(user.id)
+        identity_cache.invalidate(callback.from_user.id)
         logger.info(f"Добавлен автомобиль {new_car.brand} {new_car.model} для пользователя {user.telegram_id}")
     await state.clear()
     await callback.message.answer(
@@ -204,23 +204,20 @@ async def fuel_chosen(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(F.text == "🔄 Обновить пробег")
-async def update_mileage_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_cars_submenu())
-            return
-        cars_list = [(car.id, f"{car.brand} {car.model} {car.year}") for car in cars]
-        await state.update_data(cars=cars_list)
-        await state.set_state(CarStates.waiting_for_car_to_update_mileage)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
-        ])
-        await message.answer("Выберите автомобиль для обновления пробега:", reply_markup=keyboard)
+async def update_mileage_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_cars_submenu())
+        return
+    cars_list = [(car.id, f"{car.brand} {car.model} {car.year}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(CarStates.waiting_for_car_to_update_mileage)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль для обновления пробега:", reply_markup=keyboard)
 
 @router.callback_query(CarStates.waiting_for_car_to_update_mileage, F.data.startswith("car_"))
 async def car_selected_for_mileage(callback: types.CallbackQuery, state: FSMContext):
@@ -241,11 +238,12 @@ async def new_mileage_entered(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     car_id = data.get("selected_car_id")
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id))
         if car:
             car.current_mileage = new_mileage
-            db.commit()
+            await db.commit()
+            await stats_cache.invalidate(car.user_id)
             await message.answer(f"✅ Пробег автомобиля {car.brand} {car.model} обновлён до {new_mileage:,.0f} км.")
         else:
             await message.answer("❌ Автомобиль не найден.")
@@ -253,32 +251,31 @@ async def new_mileage_entered(message: types.Message, state: FSMContext):
     await message.answer("Меню автомобилей:", reply_markup=get_cars_submenu())
 
 @router.message(F.text == "🗑 Удалить авто")
-async def delete_car_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_cars_submenu())
-            return
-        cars_list = [(car.id, f"{car.brand} {car.model} {car.year}") for car in cars]
-        await state.update_data(cars=cars_list)
-        await state.set_state(CarStates.waiting_for_car_to_delete)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"del_{car_id}")] for car_id, name in cars_list
-        ])
-        await message.answer("Выберите автомобиль для удаления (скрытия):", reply_markup=keyboard)
+async def delete_car_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_cars_submenu())
+        return
+    cars_list = [(car.id, f"{car.brand} {car.model} {car.year}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(CarStates.waiting_for_car_to_delete)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"del_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль для удаления (скрытия):", reply_markup=keyboard)
 
 @router.callback_query(CarStates.waiting_for_car_to_delete, F.data.startswith("del_"))
 async def delete_car_confirm(callback: types.CallbackQuery, state: FSMContext):
     car_id = int(callback.data.split("_")[1])
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id))
         if car:
             car.is_active = False
-            db.commit()
+            await db.commit()
+            await stats_cache.invalidate(car.user_id)
+            identity_cache.invalidate(callback.from_user.id)
             await callback.message.edit_text(f"✅ Автомобиль {car.brand} {car.model} удалён из списка.")
         else:
             await callback.message.edit_text("❌ Автомобиль не найден.")
@@ -4,10 +4,12 @@ from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from sqlalchemy import func
+from sqlalchemy import select, func
 
-from database import SessionLocal, Car, User, FuelEvent, MaintenanceEvent, Insurance
+from database import AsyncSessionLocal, FuelEvent, MaintenanceEvent, Insurance
 from keyboards.main_menu import get_main_menu, get_cancel_keyboard, get_fuel_types_keyboard
+from services.stats_cache import stats_cache
+from services.identity import Identity
 from config import config
 
 router = Router()
@@ -97,29 +99,26 @@ async def edit_main_menu(message: types.Message):
 
 # ------------------- Редактирование заправок -------------------
 @router.message(F.text == "⛽ Заправка")
-async def edit_fuel_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        if len(cars) == 1:
-            await state.update_data(car_id=cars[0].id)
-            await show_fuel_events(message, state, cars[0].id)
-        else:
-            await state.set_state(EditFuel.waiting_for_car)
-            await message.answer(
-                "Выберите автомобиль:",
-                reply_markup=make_car_keyboard(cars, "edit_fuel")
-            )
+async def edit_fuel_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    if len(identity.cars) == 1:
+        await state.update_data(car_id=identity.cars[0].id)
+        await show_fuel_events(message, state, identity.cars[0].id)
+    else:
+        await state.set_state(EditFuel.waiting_for_car)
+        await message.answer(
+            "Выберите автомобиль:",
+            reply_markup=make_car_keyboard(identity.cars, "edit_fuel")
+        )
 
 async def show_fuel_events(message: types.Message, state: FSMContext, car_id: int):
-    with SessionLocal() as db:
-        events = db.query(FuelEvent).filter(FuelEvent.car_id == car_id).order_by(FuelEvent.date.desc()).limit(10).all()
+    async with AsyncSessionLocal() as db:
+        events = (await db.scalars(select(FuelEvent).where(FuelEvent.car_id == car_id).order_by(FuelEvent.date.desc()).limit(10))).all()
         if not events:
             await message.answer("Нет заправок для этого авто.")
             await state.clear()
@@ -238,8 +237,8 @@ async def save_edited_fuel(message: types.Message, state: FSMContext):
     new_fuel_type = data.get('fuel_type')
     new_photo = data.get('photo_id')
 
-    with SessionLocal() as db:
-        event = db.query(FuelEvent).filter(FuelEvent.id == event_id).first()
+    async with AsyncSessionLocal() as db:
+        event = await db.scalar(select(FuelEvent).where(FuelEvent.id == event_id))
         if not event:
             await message.answer("❌ Запись не найдена")
             await state.clear()
@@ -254,36 +253,34 @@ async def save_edited_fuel(message: types.Message, state: FSMContext):
             event.fuel_type = new_fuel_type
         if new_photo is not None:
             event.photo_id = new_photo if new_photo else None
-        db.commit()
+        await db.commit()
+        await stats_cache.invalidate_car(db, event.car_id)
 
     await message.answer("✅ Заправка отредактирована!", reply_markup=get_main_menu())
     await state.clear()
 
 # ------------------- Редактирование обслуживания -------------------
 @router.message(F.text == "🔧 Обслуживание")
-async def edit_maint_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        if len(cars) == 1:
-            await state.update_data(car_id=cars[0].id)
-            await show_maint_events(message, state, cars[0].id)
-        else:
-            await state.set_state(EditMaintenance.waiting_for_car)
-            await message.answer(
-                "Выберите автомобиль:",
-                reply_markup=make_car_keyboard(cars, "edit_maint")
-            )
+async def edit_maint_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    if len(identity.cars) == 1:
+        await state.update_data(car_id=identity.cars[0].id)
+        await show_maint_events(message, state, identity.cars[0].id)
+    else:
+        await state.set_state(EditMaintenance.waiting_for_car)
+        await message.answer(
+            "Выберите автомобиль:",
+            reply_markup=make_car_keyboard(identity.cars, "edit_maint")
+        )
 
 async def show_maint_events(message: types.Message, state: FSMContext, car_id: int):
-    with SessionLocal() as db:
-        events = db.query(MaintenanceEvent).filter(MaintenanceEvent.car_id == car_id).order_by(MaintenanceEvent.date.desc()).limit(10).all()
+    async with AsyncSessionLocal() as db:
+        events = (await db.scalars(select(MaintenanceEvent).where(MaintenanceEvent.car_id == car_id).order_by(MaintenanceEvent.date.desc()).limit(10))).all()
         if not events:
             await message.answer("Нет событий обслуживания для этого авто.")
             await state.clear()
@@ -398,8 +395,8 @@ async def save_edited_maint(message: types.Message, state: FSMContext):
     new_mileage = data.get('mileage')
     new_photo = data.get('photo_id')
 
-    with SessionLocal() as db:
-        event = db.query(MaintenanceEvent).filter(MaintenanceEvent.id == event_id).first()
+    async with AsyncSessionLocal() as db:
+        event = await db.scalar(select(MaintenanceEvent).where(MaintenanceEvent.id == event_id))
         if not event:
             await message.answer("❌ Запись не найдена")
             await state.clear()
@@ -414,36 +411,34 @@ async def save_edited_maint(message: types.Message, state: FSMContext):
             event.mileage = new_mileage
         if new_photo is not None:
             event.photo_id = new_photo if new_photo else None
-        db.commit()
+        await db.commit()
+        await stats_cache.invalidate_car(db, event.car_id)
 
     await message.answer("✅ Обслуживание отредактировано!", reply_markup=get_main_menu())
     await state.clear()
 
 # ------------------- Редактирование страховок -------------------
 @router.message(F.text == "📄 Страховка")
-async def edit_ins_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        if len(cars) == 1:
-            await state.update_data(car_id=cars[0].id)
-            await show_ins_events(message, state, cars[0].id)
-        else:
-            await state.set_state(EditInsurance.waiting_for_car)
-            await message.answer(
-                "Выберите автомобиль:",
-                reply_markup=make_car_keyboard(cars, "edit_ins")
-            )
+async def edit_ins_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    if len(identity.cars) == 1:
+        await state.update_data(car_id=identity.cars[0].id)
+        await show_ins_events(message, state, identity.cars[0].id)
+    else:
+        await state.set_state(EditInsurance.waiting_for_car)
+        await message.answer(
+            "Выберите автомобиль:",
+            reply_markup=make_car_keyboard(identity.cars, "edit_ins")
+        )
 
 async def show_ins_events(message: types.Message, state: FSMContext, car_id: int):
-    with SessionLocal() as db:
-        events = db.query(Insurance).filter(Insurance.car_id == car_id).order_by(Insurance.end_date.desc()).limit(10).all()
+    async with AsyncSessionLocal() as db:
+        events = (await db.scalars(select(Insurance).where(Insurance.car_id == car_id).order_by(Insurance.end_date.desc()).limit(10))).all()
         if not events:
             await message.answer("Нет страховок для этого авто.")
             await state.clear()
@@ -579,8 +574,8 @@ async def save_edited_ins(message: types.Message, state: FSMContext):
     new_notes = data.get('notes')
     new_photo = data.get('photo_id')
 
-    with SessionLocal() as db:
-        event = db.query(Insurance).filter(Insurance.id == event_id).first()
+    async with AsyncSessionLocal() as db:
+        event = await db.scalar(select(Insurance).where(Insurance.id == event_id))
         if not event:
             await message.answer("❌ Запись не найдена")
             await state.clear()
@@ -597,7 +592,8 @@ async def save_edited_ins(message: types.Message, state: FSMContext):
             event.notes = new_notes
         if new_photo is not None:
             event.photo_id = new_photo if new_photo else None
-        db.commit()
+        await db.commit()
+        await stats_cache.invalidate_car(db, event.car_id)
 
     await message.answer("✅ Страховка отредактирована!", reply_markup=get_main_menu())
     await state.clear()
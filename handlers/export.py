@@ -1,140 +1,225 @@
+import asyncio
+import codecs
 import csv
 import io
+import os
+import shutil
+import tempfile
 import zipfile
 from datetime import datetime
 from aiogram import Router, types, F
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile
+from aiogram.types import FSInputFile
 
-from database import SessionLocal, User, Car, FuelEvent, MaintenanceEvent, Insurance, Part
+from sqlalchemy import select
+from database import AsyncSessionLocal, Car, FuelEvent, MaintenanceEvent, Insurance, Part
 from keyboards.main_menu import get_stats_submenu
 from config import config
+from services.jobs import job_queue, PRIORITY_LOW
+from services.identity import Identity
 
 router = Router()
 
 # Лимит Telegram на отправку документов (50 МБ)
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+# Сколько строк за раз читается с серверного курсора
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_HEADER = [
+    'Тип', 'Автомобиль', 'Дата', 'Описание/Деталь', 'Пробег', 'Стоимость',
+    'Литры', 'Категория', 'Номер полиса/Компания', 'Интервал км', 'Интервал мес.'
+]
+
+def fuel_row(ev, car_name):
+    return [
+        'Заправка',
+        car_name,
+        ev.date.strftime('%Y-%m-%d %H:%M'),
+        '',
+        ev.mileage if ev.mileage else '',
+        float(ev.cost),
+        float(ev.liters),
+        ev.fuel_type or '',
+        '',
+        '',
+        ''
+    ]
+
+def maintenance_row(ev, car_name):
+    return [
+        'Обслуживание',
+        car_name,
+        ev.date.strftime('%Y-%m-%d %H:%M'),
+        ev.description,
+        ev.mileage if ev.mileage else '',
+        float(ev.cost),
+        '',
+        ev.category,
+        '',
+        '',
+        ''
+    ]
+
+def insurance_row(ins, car_name):
+    return [
+        'Страховка',
+        car_name,
+        ins.end_date.strftime('%Y-%m-%d'),
+        ins.notes or '',
+        '',
+        float(ins.cost),
+        '',
+        '',
+        f"{ins.policy_number or ''} / {ins.company or ''}",
+        '',
+        ''
+    ]
+
+def part_row(part, car_name):
+    return [
+        'Деталь/Жидкость',
+        car_name,
+        part.last_date.strftime('%Y-%m-%d') if part.last_date else '',
+        part.name,
+        part.last_mileage if part.last_mileage else '',
+        '',
+        '',
+        '',
+        '',
+        part.interval_mileage or '',
+        part.interval_months or ''
+    ]
+
+# Один запрос на тип записей по всем машинам пользователя
+EXPORT_SOURCES = (
+    (FuelEvent, FuelEvent.date, fuel_row),
+    (MaintenanceEvent, MaintenanceEvent.date, maintenance_row),
+    (Insurance, Insurance.end_date, insurance_row),
+    (Part, Part.id, part_row),
+)
+
+async def iter_export_rows(db, car_names):
+    """Строки CSV по машинам {car_id: название}, читаемые порциями с серверного курсора."""
+    yield EXPORT_HEADER
+    for model, order_column, to_row in EXPORT_SOURCES:
+        result = await db.stream_scalars(
+            select(model)
+            .where(model.car_id.in_(list(car_names)))
+            .order_by(model.car_id, order_column)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for obj in result:
+            yield to_row(obj, car_names[obj.car_id])
+
+class ExportWriter:
+    """Пишет CSV порциями; методы write и close вызываются в отдельном потоке через asyncio.to_thread.
+
+    Пока файл укладывается в лимит Telegram, это обычный CSV. Порция, которая выводит его за лимит,
+    переключает запись в ZIP: уже записанное начало переносится в архив, а остальные строки
+    сжимаются на лету, без второго прохода по готовому файлу.
+    """
+
+    def __init__(self, directory, filename_base):
+        self.csv_name = f"{filename_base}.csv"
+        self.csv_path = os.path.join(directory, self.csv_name)
+        self.zip_path = os.path.join(directory, f"{filename_base}.zip")
+        self.size = 0
+        self._file = open(self.csv_path, 'wb')
+        self._file.write(codecs.BOM_UTF8)
+        self._stream = self._file
+        self._zip = None
+
+    def write(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=';', quoting=csv.QUOTE_MINIMAL).writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        if self._zip is None and self._file.tell() + len(data) > MAX_FILE_SIZE:
+            self._switch_to_zip()
+        self._stream.write(data)
+
+    def _switch_to_zip(self):
+        self._file.close()
+        self._zip = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED)
+        self._stream = self._zip.open(self.csv_name, 'w', force_zip64=True)
+        with open(self.csv_path, 'rb') as f:
+            shutil.copyfileobj(f, self._stream)
+        os.remove(self.csv_path)
+
+    def close(self):
+        """Возвращает (путь к файлу, упакован ли он)."""
+        if self._zip is None:
+            self._file.close()
+            return self.csv_path, False
+        self._stream.close()
+        self._zip.close()
+        return self.zip_path, True
+
+async def build_export_file(db, cars, directory):
+    """Пишет CSV во временный каталог, при превышении лимита Telegram — сразу в ZIP.
+    Строки читаются порциями, а форматирование и запись каждой порции идут в отдельном потоке,
+    чтобы большая выгрузка не задерживала обработку остальных апдейтов.
+    Возвращает (путь к файлу, упакован ли он)."""
+    car_names = {car.id: f"{car.brand} {car.model} ({car.year})" for car in cars}
+    filename_base = f"carwise_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    writer = await asyncio.to_thread(ExportWriter, directory, filename_base)
+    try:
+        batch = []
+        async for row in iter_export_rows(db, car_names):
+            batch.append(row)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                await asyncio.to_thread(writer.write, batch)
+                batch = []
+        if batch:
+            await asyncio.to_thread(writer.write, batch)
+    finally:
+        path, zipped = await asyncio.to_thread(writer.close)
+    return path, zipped
 
 @router.message(F.text == "📤 Экспорт данных (Premium)")
 @router.message(Command("export"))
-async def export_data(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-
-        is_admin = message.from_user.id in config.ADMIN_IDS
-        if not user.is_premium and not is_admin:
-            await message.answer(
-                "❌ *Экспорт данных* доступен только для премиум-пользователей.\n\n"
-                "Оформите подписку, чтобы выгружать все свои данные в CSV для анализа в Excel.",
-                parse_mode="Markdown",
-                reply_markup=get_stats_submenu()
-            )
-            return
-
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей для экспорта.", reply_markup=get_stats_submenu())
-            return
-
-        # Создаём CSV в памяти
-        output = io.StringIO()
-        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow([
-            'Тип', 'Автомобиль', 'Дата', 'Описание/Деталь', 'Пробег', 'Стоимость',
-            'Литры', 'Категория', 'Номер полиса/Компания', 'Интервал км', 'Интервал мес.'
-        ])
-
-        for car in cars:
-            car_name = f"{car.brand} {car.model} ({car.year})"
-
-            # Заправки
-            fuel_events = db.query(FuelEvent).filter(FuelEvent.car_id == car.id).all()
-            for ev in fuel_events:
-                writer.writerow([
-                    'Заправка',
-                    car_name,
-                    ev.date.strftime('%Y-%m-%d %H:%M'),
-                    '',
-                    ev.mileage if ev.mileage else '',
-                    float(ev.cost),
-                    float(ev.liters),
-                    ev.fuel_type or '',
-                    '',
-                    '',
-                    ''
-                ])
-
-            # Обслуживание
-            maint_events = db.query(MaintenanceEvent).filter(MaintenanceEvent.car_id == car.id).all()
-            for ev in maint_events:
-                writer.writerow([
-                    'Обслуживание',
-                    car_name,
-                    ev.date.strftime('%Y-%m-%d %H:%M'),
-                    ev.description,
-                    ev.mileage if ev.mileage else '',
-                    float(ev.cost),
-                    '',
-                    ev.category,
-                    '',
-                    '',
-                    ''
-                ])
-
-            # Страховки
-            insurances = db.query(Insurance).filter(Insurance.car_id == car.id).all()
-            for ins in insurances:
-                writer.writerow([
-                    'Страховка',
-                    car_name,
-                    ins.end_date.strftime('%Y-%m-%d'),
-                    ins.notes or '',
-                    '',
-                    float(ins.cost),
-                    '',
-                    '',
-                    f"{ins.policy_number or ''} / {ins.company or ''}",
-                    '',
-                    ''
-                ])
-
-            # Детали и жидкости
-            parts = db.query(Part).filter(Part.car_id == car.id).all()
-            for part in parts:
-                writer.writerow([
-                    'Деталь/Жидкость',
-                    car_name,
-                    part.last_date.strftime('%Y-%m-%d') if part.last_date else '',
-                    part.name,
-                    part.last_mileage if part.last_mileage else '',
-                    '',
-                    '',
-                    '',
-                    '',
-                    part.interval_mileage or '',
-                    part.interval_months or ''
-                ])
-
-        output.seek(0)
-        csv_data = output.getvalue().encode('utf-8-sig')
-        csv_size = len(csv_data)
-
-        filename_base = f"carwise_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+async def export_data(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+
+    is_admin = message.from_user.id in config.ADMIN_IDS
+    if not identity.is_premium and not is_admin:
+        await message.answer(
+            "❌ *Экспорт данных* доступен только для премиум-пользователей.\n\n"
+            "Оформите подписку, чтобы выгружать все свои данные в CSV для анализа в Excel.",
+            parse_mode="Markdown",
+            reply_markup=get_stats_submenu()
+        )
+        return
+
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей для экспорта.", reply_markup=get_stats_submenu())
+        return
+
+    await job_queue.enqueue(
+        message.bot, "export", message.chat.id, {"user_id": identity.user_id},
+        priority=PRIORITY_LOW, text="⏳ Готовлю экспорт, файл придёт отдельным сообщением..."
+    )
+
+@job_queue.handler("export")
+async def export_job(ctx):
+    directory = tempfile.mkdtemp(prefix="carwise_export_")
+    try:
+        async with AsyncSessionLocal() as db:
+            cars = (await db.scalars(select(Car).where(Car.user_id == ctx.payload["user_id"], Car.is_active == True))).all()
+            if not cars:
+                await ctx.progress("У вас нет автомобилей для экспорта.")
+                return
+            await ctx.progress("⏳ Формирую CSV-файл...")
+            path, zipped = await build_export_file(db, cars, directory)
+
+        # Файл отправляется с диска уже после возврата соединения с БД в пул
         caption = "📊 Ваши данные в формате CSV. Открыть можно в Excel или любом табличном редакторе."
-
-        # Если размер CSV превышает лимит, упаковываем в ZIP
-        if csv_size > MAX_FILE_SIZE:
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                zip_file.writestr(f"{filename_base}.csv", csv_data)
-            zip_buffer.seek(0)
-            document = BufferedInputFile(zip_buffer.read(), filename=f"{filename_base}.zip")
+        if zipped:
             caption = f"📦 Файл CSV превысил лимит Telegram, поэтому упакован в ZIP.\n{caption}"
-        else:
-            document = BufferedInputFile(csv_data, filename=f"{filename_base}.csv")
-
-        await message.answer_document(document=document, caption=caption)
-        await message.answer("Выберите действие:", reply_markup=get_stats_submenu())
+        await ctx.progress("📤 Отправляю файл...")
+        await ctx.bot.send_document(ctx.chat_id, document=FSInputFile(path), caption=caption)
+        await ctx.delete_progress()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    await ctx.bot.send_message(ctx.chat_id, "Выберите действие:", reply_markup=get_stats_submenu())
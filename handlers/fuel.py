@@ -4,8 +4,11 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime
 
-from database import SessionLocal, Car, FuelEvent, User
+from sqlalchemy import select
+from database import AsyncSessionLocal, Car, FuelEvent
 from keyboards.main_menu import get_fuel_submenu, get_cancel_keyboard, get_skip_keyboard
+from services.stats_cache import stats_cache
+from services.identity import Identity
 from config import config
 
 router = Router()
@@ -20,29 +23,26 @@ class FuelStates(StatesGroup):
     waiting_for_photo = State()
 
 @router.message(F.text == "⛽ Добавить заправку")
-async def add_fuel_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей. Сначала добавьте авто.", reply_markup=get_fuel_submenu())
-            return
-        cars_list = [(car.id, f"{car.brand} {car.model}") for car in cars]
-        await state.update_data(cars=cars_list)
-        await state.set_state(FuelStates.waiting_for_car)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
-        ])
-        await message.answer("Выберите автомобиль:", reply_markup=keyboard)
+async def add_fuel_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей. Сначала добавьте авто.", reply_markup=get_fuel_submenu())
+        return
+    cars_list = [(car.id, f"{car.brand} {car.model}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(FuelStates.waiting_for_car)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль:", reply_markup=keyboard)
 
 @router.callback_query(FuelStates.waiting_for_car, F.data.startswith("car_"))
 async def car_selected(callback: types.CallbackQuery, state: FSMContext):
     car_id = int(callback.data.split("_")[1])
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id, Car.is_active == True).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id, Car.is_active == True))
         if not car:
             await callback.message.edit_text("❌ Автомобиль не найден. Возможно, он был удалён. Попробуйте заново.")
             await state.clear()
@@ -122,8 +122,8 @@ async def mileage_entered(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id, Car.is_active == True).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id, Car.is_active == True))
         if not car:
             await message.answer("❌ Автомобиль не найден.")
             await state.clear()
@@ -218,8 +218,8 @@ async def save_fuel_event(message: types.Message, state: FSMContext, photo_id=No
     mileage = data.get("mileage")
     fuel_type = data.get("fuel_type")
 
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id))
         if car and mileage:
             if mileage < car.current_mileage:
                 await message.answer(
@@ -238,8 +238,9 @@ async def save_fuel_event(message: types.Message, state: FSMContext, photo_id=No
             photo_id=photo_id
         )
         db.add(fuel_event)
-        db.commit()
+        await db.commit()
         logger.info(f"Заправка добавлена для авто {car_id}")
+        await stats_cache.invalidate_car(db, car_id)
 
     price_per_liter = cost / liters if liters else 0
     response = f"✅ Заправка сохранена!\nЛитров: {liters:.2f}\nСумма: {cost:.2f} руб.\nЦена за литр: {price_per_liter:.2f} руб."
@@ -252,18 +253,16 @@ async def save_fuel_event(message: types.Message, state: FSMContext, photo_id=No
     await state.clear()
 
 @router.message(F.text == "📸 Мои чеки заправок")
-async def my_fuel_photos(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        car_ids = [car.id for car in cars]
-        fuel_events = db.query(FuelEvent).filter(FuelEvent.car_id.in_(car_ids), FuelEvent.photo_id != None).order_by(FuelEvent.date.desc()).limit(10).all()
+async def my_fuel_photos(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    async with AsyncSessionLocal() as db:
+        car_ids = identity.car_ids
+        fuel_events = (await db.scalars(select(FuelEvent).where(FuelEvent.car_id.in_(car_ids), FuelEvent.photo_id != None).order_by(FuelEvent.date.desc()).limit(10))).all()
         if not fuel_events:
             await message.answer("У вас нет сохранённых чеков заправок.", reply_markup=get_fuel_submenu())
             return
@@ -5,8 +5,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime, timedelta
 
-from database import SessionLocal, Car, User, Insurance
+from sqlalchemy import select, update
+from sqlalchemy.orm import selectinload
+from database import AsyncSessionLocal, Insurance
 from keyboards.main_menu import get_insurance_submenu, get_cancel_keyboard, get_skip_keyboard
+from services.stats_cache import stats_cache
+from services.identity import Identity
 from config import config
 
 router = Router()
@@ -24,23 +28,20 @@ class InsuranceStates(StatesGroup):
     waiting_for_delete = State()
 
 @router.message(F.text == "📄 Добавить страховку")
-async def add_insurance_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_insurance_submenu())
-            return
-        cars_list = [(car.id, f"{car.brand} {car.model}") for car in cars]
-        await state.update_data(cars=cars_list)
-        await state.set_state(InsuranceStates.waiting_for_car)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
-        ])
-        await message.answer("Выберите автомобиль:", reply_markup=keyboard)
+async def add_insurance_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_insurance_submenu())
+        return
+    cars_list = [(car.id, f"{car.brand} {car.model}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(InsuranceStates.waiting_for_car)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль:", reply_markup=keyboard)
 
 @router.callback_query(InsuranceStates.waiting_for_car, F.data.startswith("car_"))
 async def car_selected(callback: types.CallbackQuery, state: FSMContext):
@@ -153,9 +154,9 @@ async def save_insurance(message: types.Message, state: FSMContext, photo_id=Non
     cost = data.get("cost")
     notes = data.get("notes")
 
-    with SessionLocal() as db:
+    async with AsyncSessionLocal() as db:
         # Деактивируем все предыдущие страховки для этого автомобиля
-        db.query(Insurance).filter(Insurance.car_id == car_id).update({"is_active": False})
+        await db.execute(update(Insurance).where(Insurance.car_id == car_id).values(is_active=False))
 
         insurance = Insurance(
             car_id=car_id,
@@ -172,8 +173,9 @@ async def save_insurance(message: types.Message, state: FSMContext, photo_id=Non
             notified_expired=False
         )
         db.add(insurance)
-        db.commit()
+        await db.commit()
         logger.info(f"Страховка добавлена для авто {car_id}, старые страховки деактивированы")
+        await stats_cache.invalidate_car(db, car_id)
 
     await message.answer(
         f"✅ Страховка добавлена!\n"
@@ -186,19 +188,17 @@ async def save_insurance(message: types.Message, state: FSMContext, photo_id=Non
     await state.clear()
 
 @router.message(F.text == "📄 Список страховок")
-async def list_insurances(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_insurance_submenu())
-            return
-        car_ids = [car.id for car in cars]
+async def list_insurances(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_insurance_submenu())
+        return
+    async with AsyncSessionLocal() as db:
+        car_ids = identity.car_ids
         # Показываем все страховки (и активные, и неактивные) для истории
-        insurances = db.query(Insurance).filter(Insurance.car_id.in_(car_ids)).order_by(Insurance.end_date.desc()).all()
+        insurances = (await db.scalars(select(Insurance).options(selectinload(Insurance.car)).where(Insurance.car_id.in_(car_ids)).order_by(Insurance.end_date.desc()))).all()
         if not insurances:
             await message.answer("У вас нет страховок.", reply_markup=get_insurance_submenu())
             return
@@ -218,18 +218,16 @@ async def list_insurances(message: types.Message):
         await message.answer(text, parse_mode="Markdown", reply_markup=get_insurance_submenu())
 
 @router.message(F.text == "📸 Мои чеки страховок")
-async def my_insurance_photos(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        car_ids = [car.id for car in cars]
-        insurances = db.query(Insurance).filter(Insurance.car_id.in_(car_ids), Insurance.photo_id != None).order_by(Insurance.end_date.desc()).limit(10).all()
+async def my_insurance_photos(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    async with AsyncSessionLocal() as db:
+        car_ids = identity.car_ids
+        insurances = (await db.scalars(select(Insurance).where(Insurance.car_id.in_(car_ids), Insurance.photo_id != None).order_by(Insurance.end_date.desc()).limit(10))).all()
         if not insurances:
             await message.answer("У вас нет сохранённых фото страховок.", reply_markup=get_insurance_submenu())
             return
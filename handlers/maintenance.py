@@ -5,8 +5,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime, timedelta
 
-from database import SessionLocal, Car, MaintenanceEvent, User, Part
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from database import AsyncSessionLocal, Car, MaintenanceEvent, Part
 from keyboards.main_menu import get_maintenance_submenu, get_cancel_keyboard, get_skip_keyboard
+from services.stats_cache import stats_cache
+from services.identity import Identity
 from config import config
 
 router = Router()
@@ -27,23 +31,20 @@ class MaintenanceStates(StatesGroup):
     waiting_for_photo = State()
 
 @router.message(F.text == "🔧 Добавить событие")
-async def add_maintenance_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей. Сначала добавьте авто.", reply_markup=get_maintenance_submenu())
-            return
-        cars_list = [(car.id, f"{car.brand} {car.model}") for car in cars]
-        await state.update_data(cars=cars_list)
-        await state.set_state(MaintenanceStates.waiting_for_car)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
-        ])
-        await message.answer("Выберите автомобиль:", reply_markup=keyboard)
+async def add_maintenance_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей. Сначала добавьте авто.", reply_markup=get_maintenance_submenu())
+        return
+    cars_list = [(car.id, f"{car.brand} {car.model}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(MaintenanceStates.waiting_for_car)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль:", reply_markup=keyboard)
 
 @router.callback_query(MaintenanceStates.waiting_for_car, F.data.startswith("car_"))
 async def car_selected(callback: types.CallbackQuery, state: FSMContext):
@@ -289,8 +290,8 @@ async def save_maintenance_event(message: types.Message, state: FSMContext, phot
     cost = data.get("cost")
     mileage = data.get("mileage")
 
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id))
         if car and mileage:
             car.current_mileage = mileage
             if category_key == "to":
@@ -298,7 +299,8 @@ async def save_maintenance_event(message: types.Message, state: FSMContext, phot
                 car.last_maintenance_mileage = mileage
                 car.notified_to_mileage = False
                 car.notified_to_date = False
-            db.commit()
+                car.update_next_due()
+            await db.commit()
 
         maint_event = MaintenanceEvent(
             car_id=car_id,
@@ -309,7 +311,7 @@ async def save_maintenance_event(message: types.Message, state: FSMContext, phot
             photo_id=photo_id
         )
         db.add(maint_event)
-        db.commit()
+        await db.commit()
         logger.info(f"Событие обслуживания добавлено для авто {car_id}")
 
         if category_key == "parts":
@@ -325,8 +327,9 @@ async def save_maintenance_event(message: types.Message, state: FSMContext, phot
                 last_date=datetime.utcnow(),
                 notified=False
             )
+            part.update_next_due()
             db.add(part)
-            db.commit()
+            await db.commit()
             logger.info(f"Деталь {part_name} добавлена в Part")
 
         if category_key == "fluids":
@@ -342,10 +345,13 @@ async def save_maintenance_event(message: types.Message, state: FSMContext, phot
                 last_date=datetime.utcnow(),
                 notified=False
             )
+            part.update_next_due()
             db.add(part)
-            db.commit()
+            await db.commit()
             logger.info(f"Жидкость {liquid_name} добавлена в Part")
 
+        await stats_cache.invalidate_car(db, car_id)
+
     response = f"✅ Событие '{category}' сохранено!\nСтоимость: {cost:.2f} руб."
     if mileage:
         response += f"\nПробег: {mileage:,.0f} км"
@@ -374,18 +380,16 @@ async def to_done_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(F.text == "🔧 Плановые замены")
-async def planned_replacements(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        car_ids = [car.id for car in cars]
-        parts = db.query(Part).filter(Part.car_id.in_(car_ids)).all()
+async def planned_replacements(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    async with AsyncSessionLocal() as db:
+        car_ids = identity.car_ids
+        parts = (await db.scalars(select(Part).options(selectinload(Part.car)).where(Part.car_id.in_(car_ids)))).all()
         if not parts:
             await message.answer("Нет данных о плановых заменах.", reply_markup=get_maintenance_submenu())
             return
@@ -426,26 +430,24 @@ async def planned_replacements(message: types.Message):
         await message.answer("\n".join(lines), parse_mode="Markdown", reply_markup=get_maintenance_submenu())
 
 @router.message(F.text == "⏰ Напоминания ТО")
-async def to_reminders_settings(message: types.Message, state: FSMContext):
+async def to_reminders_settings(message: types.Message, state: FSMContext, identity: Identity | None):
     from handlers.reminders import set_reminder_start
-    await set_reminder_start(message, state)
+    await set_reminder_start(message, state, identity)
 
 @router.message(F.text == "📸 Мои чеки обслуживания")
-async def my_maintenance_photos(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь.")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
-        car_ids = [car.id for car in cars]
-        events = db.query(MaintenanceEvent).filter(
+async def my_maintenance_photos(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь.")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
+    async with AsyncSessionLocal() as db:
+        car_ids = identity.car_ids
+        events = (await db.scalars(select(MaintenanceEvent).where(
             MaintenanceEvent.car_id.in_(car_ids),
             MaintenanceEvent.photo_id != None
-        ).order_by(MaintenanceEvent.date.desc()).limit(10).all()
+        ).order_by(MaintenanceEvent.date.desc()).limit(10))).all()
         if not events:
             await message.answer("У вас нет сохранённых чеков обслуживания.", reply_markup=get_maintenance_submenu())
             return
@@ -1,56 +1,81 @@
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from sqlalchemy import func, and_
+from sqlalchemy import select, func, and_, or_
 
-from database import SessionLocal, User, Car, FuelEvent, MaintenanceEvent
+from database import AsyncSessionLocal, Car, MonthlyCarExpense
 from config import config
 from keyboards.main_menu import get_stats_submenu
+from services.stats_cache import stats_cache
+from services.jobs import job_queue, PRIORITY_HIGH
+from services.identity import Identity
 
 router = Router()
 logger = logging.getLogger(__name__)
 
-def get_monthly_stats(db, user_id, year, month):
-    start_date = datetime(year, month, 1)
-    if month == 12:
-        end_date = datetime(year+1, 1, 1)
-    else:
-        end_date = datetime(year, month+1, 1)
-
-    cars = db.query(Car).filter(Car.user_id == user_id, Car.is_active == True).all()
-    total_fuel = 0
-    total_maintenance = 0
-
-    for car in cars:
-        fuel = db.query(func.sum(FuelEvent.cost)).filter(
-            FuelEvent.car_id == car.id,
-            FuelEvent.date >= start_date,
-            FuelEvent.date < end_date
-        ).scalar() or 0
-        maint = db.query(func.sum(MaintenanceEvent.cost)).filter(
-            MaintenanceEvent.car_id == car.id,
-            MaintenanceEvent.date >= start_date,
-            MaintenanceEvent.date < end_date
-        ).scalar() or 0
-        total_fuel += fuel
-        total_maintenance += maint
+async def get_monthly_stats(db, user_id, year, month):
+    return await stats_cache.get_or_load(
+        user_id, f"monthly:{year}-{month:02d}", lambda: load_monthly_stats(db, user_id, year, month)
+    )
+
+async def load_monthly_stats(db, user_id, year, month):
+    fuel, maintenance = (await db.execute(
+        select(
+            func.coalesce(func.sum(MonthlyCarExpense.fuel_cost), 0),
+            func.coalesce(func.sum(MonthlyCarExpense.maintenance_cost), 0)
+        )
+        .join(Car, MonthlyCarExpense.car_id == Car.id)
+        .where(
+            Car.user_id == user_id,
+            Car.is_active == True,
+            MonthlyCarExpense.year == year,
+            MonthlyCarExpense.month == month
+        )
+    )).one()
 
     return {
-        "total_fuel": total_fuel,
-        "total_maintenance": total_maintenance
+        "total_fuel": float(fuel),
+        "total_maintenance": float(maintenance)
     }
 
-def format_monthly_report(db, user_id, year, month, with_comparison=False):
-    current = get_monthly_stats(db, user_id, year, month)
+async def load_monthly_totals(db, periods, user_ids=None):
+    """Суммы расходов пользователей user_ids (по умолчанию всех) за несколько месяцев одним запросом.
+    Возвращает {user_id: {(year, month): {"total_fuel": ..., "total_maintenance": ...}}}."""
+    rows = (await db.execute(
+        select(
+            Car.user_id,
+            MonthlyCarExpense.year,
+            MonthlyCarExpense.month,
+            func.sum(MonthlyCarExpense.fuel_cost),
+            func.sum(MonthlyCarExpense.maintenance_cost)
+        )
+        .join(Car, MonthlyCarExpense.car_id == Car.id)
+        .where(
+            Car.is_active == True,
+            or_(*(and_(MonthlyCarExpense.year == year, MonthlyCarExpense.month == month) for year, month in periods)),
+            *(() if user_ids is None else (Car.user_id.in_(user_ids),))
+        )
+        .group_by(Car.user_id, MonthlyCarExpense.year, MonthlyCarExpense.month)
+    )).all()
+    totals = defaultdict(dict)
+    for user_id, year, month, fuel, maintenance in rows:
+        totals[user_id][(year, month)] = {
+            "total_fuel": float(fuel or 0),
+            "total_maintenance": float(maintenance or 0)
+        }
+    return totals
+
+def previous_month(year, month):
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+def render_monthly_report(year, month, current, previous=None):
+    """Текст отчёта за месяц; при переданном previous — со сравнением с прошлым месяцем."""
     month_name = datetime(year, month, 1).strftime('%B %Y')
 
-    if with_comparison:
-        prev_month = month - 1 if month > 1 else 12
-        prev_year = year if month > 1 else year - 1
-        previous = get_monthly_stats(db, user_id, prev_year, prev_month)
-
+    if previous is not None:
         def format_diff(val):
             if val > 0:
                 return f"📈 +{val:,.2f} ₽"
@@ -79,92 +104,61 @@ def format_monthly_report(db, user_id, year, month, with_comparison=False):
         ]
         return header + "\n" + "\n".join(lines)
 
-async def send_monthly_reports(bot):
-    today = datetime.utcnow()
-    if today.day != 1:
-        return
-
-    if today.month == 1:
-        report_month = 12
-        report_year = today.year - 1
-    else:
-        report_month = today.month - 1
-        report_year = today.year
-
-    logger.info(f"📅 Ежемесячная рассылка за {report_month}.{report_year}")
-
-    with SessionLocal() as db:
-        users = db.query(User).all()
-        for user in users:
-            cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).count()
-            if cars == 0:
-                continue
-
-            if user.is_premium:
-                report_text = format_monthly_report(db, user.id, report_year, report_month, with_comparison=True)
-            else:
-                report_text = format_monthly_report(db, user.id, report_year, report_month, with_comparison=False)
+async def format_monthly_report(db, user_id, year, month, with_comparison=False):
+    current = await get_monthly_stats(db, user_id, year, month)
+    previous = None
+    if with_comparison:
+        prev_year, prev_month = previous_month(year, month)
+        previous = await get_monthly_stats(db, user_id, prev_year, prev_month)
+    return render_monthly_report(year, month, current, previous)
 
-            keyboard = None
-            if not user.is_premium:
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="📈 Сравнить с прошлым месяцем (Premium)", callback_data="compare_premium")]
-                ])
+def compare_premium_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📈 Сравнить с прошлым месяцем (Premium)", callback_data="compare_premium")]
+    ])
 
-            try:
-                await bot.send_message(user.telegram_id, report_text, parse_mode="Markdown", reply_markup=keyboard)
-                logger.debug(f"Отчёт отправлен пользователю {user.telegram_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки пользователю {user.telegram_id}: {e}")
+async def enqueue_comparison(bot, chat_id, user_id):
+    today = datetime.utcnow()
+    report_year, report_month = previous_month(today.year, today.month)
+    await job_queue.enqueue(
+        bot, "monthly_comparison", chat_id,
+        {"user_id": user_id, "year": report_year, "month": report_month},
+        priority=PRIORITY_HIGH, text="⏳ Считаю сравнение расходов..."
+    )
+
+@job_queue.handler("monthly_comparison")
+async def monthly_comparison_job(ctx):
+    async with AsyncSessionLocal() as db:
+        report_text = await format_monthly_report(
+            db, ctx.payload["user_id"], ctx.payload["year"], ctx.payload["month"], with_comparison=True
+        )
+    await ctx.progress(report_text, parse_mode="Markdown")
 
 @router.callback_query(F.data == "compare_premium")
-async def compare_premium_callback(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if user and user.is_premium:
-            today = datetime.utcnow()
-            if today.month == 1:
-                report_month = 12
-                report_year = today.year - 1
-            else:
-                report_month = today.month - 1
-                report_year = today.year
-            report_text = format_monthly_report(db, user.id, report_year, report_month, with_comparison=True)
-            await callback.message.answer(report_text, parse_mode="Markdown")
-        else:
-            await callback.message.answer(
-                "❌ *Сравнение расходов* доступно только для премиум-пользователей.\n\n"
-                "Оформите подписку, чтобы видеть динамику месяц к месяцу.",
-                parse_mode="Markdown"
-            )
+async def compare_premium_callback(callback: types.CallbackQuery, identity: Identity | None):
+    if identity and identity.is_premium:
+        await enqueue_comparison(callback.bot, callback.message.chat.id, identity.user_id)
+    else:
+        await callback.message.answer(
+            "❌ *Сравнение расходов* доступно только для премиум-пользователей.\n\n"
+            "Оформите подписку, чтобы видеть динамику месяц к месяцу.",
+            parse_mode="Markdown"
+        )
     await callback.answer()
 
 @router.message(F.text == "📈 Сравнение расходов (Premium)")
-async def compare_stats_command(message: types.Message):
-    user_id = message.from_user.id
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-
-        if not user.is_premium and message.from_user.id not in config.ADMIN_IDS:
-            await message.answer(
-                "❌ *Сравнение расходов* доступно только для премиум-пользователей.\n\n"
-                "Оформите подписку, чтобы видеть динамику месяц к месяцу.",
-                parse_mode="Markdown",
-                reply_markup=get_stats_submenu()
-            )
-            return
-
-        today = datetime.utcnow()
-        if today.month == 1:
-            report_month = 12
-            report_year = today.year - 1
-        else:
-            report_month = today.month - 1
-            report_year = today.year
-
-        report_text = format_monthly_report(db, user.id, report_year, report_month, with_comparison=True)
-        await message.answer(report_text, parse_mode="Markdown", reply_markup=get_stats_submenu())
+async def compare_stats_command(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+
+    if not identity.is_premium and message.from_user.id not in config.ADMIN_IDS:
+        await message.answer(
+            "❌ *Сравнение расходов* доступно только для премиум-пользователей.\n\n"
+            "Оформите подписку, чтобы видеть динамику месяц к месяцу.",
+            parse_mode="Markdown",
+            reply_markup=get_stats_submenu()
+        )
+        return
+
+    await enqueue_comparison(message.bot, message.chat.id, identity.user_id)
@@ -7,7 +7,8 @@ from keyboards.main_menu import (
     get_maintenance_submenu,
     get_insurance_submenu,
     get_more_submenu,
-    get_stats_submenu
+    get_stats_submenu,
+    is_admin
 )
 
 router = Router()
@@ -35,7 +36,7 @@ async def go_to_insurance(message: types.Message, state: FSMContext):
 @router.message(F.text == "⚙️ Ещё")
 async def go_to_more(message: types.Message, state: FSMContext):
     await state.clear()
-    await message.answer("Дополнительные функции:", reply_markup=get_more_submenu(message.from_user.id))
+    await message.answer("Дополнительные функции:", reply_markup=get_more_submenu(await is_admin(message.from_user.id)))
 
 @router.message(F.text == "◀️ Назад")
 async def back_to_main(message: types.Message, state: FSMContext):
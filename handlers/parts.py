@@ -3,30 +3,31 @@ from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
 
-from database import SessionLocal, Car, Part, User
+from sqlalchemy import select
+from database import AsyncSessionLocal, Car, Part
 from keyboards.main_menu import get_main_menu, get_maintenance_submenu
+from services.identity import Identity
 
 router = Router()
 logger = logging.getLogger(__name__)
 
 @router.message(F.text == "🔧 Плановые замены")
 @router.message(Command("parts"))
-async def show_parts(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь", reply_markup=get_maintenance_submenu())
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=get_maintenance_submenu())
-            return
+async def show_parts(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь", reply_markup=get_maintenance_submenu())
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=get_maintenance_submenu())
+        return
 
+    async with AsyncSessionLocal() as db:
+        cars = (await db.scalars(select(Car).where(Car.user_id == identity.user_id, Car.is_active == True))).all()
         lines = ["🔧 *Плановые замены деталей и жидкостей*\n"]
         found = False
         today = datetime.utcnow().date()
         for car in cars:
-            parts = db.query(Part).filter(Part.car_id == car.id).all()
+            parts = (await db.scalars(select(Part).where(Part.car_id == car.id))).all()
             car_has_items = False
             for part in parts:
                 reasons = []
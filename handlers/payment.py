@@ -4,9 +4,11 @@ from aiogram.filters import Command
 from aiogram.types import LabeledPrice, PreCheckoutQuery
 from datetime import datetime, timedelta
 
-from database import SessionLocal, User
+from sqlalchemy import select
+from database import AsyncSessionLocal, User
 from config import config
 from keyboards.main_menu import get_main_menu, get_more_submenu
+from services.identity import Identity, identity_cache
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -15,19 +17,17 @@ CURRENCY = "XTR"
 
 @router.message(F.text == "💎 Купить Premium")
 @router.message(Command("buy"))
-async def buy_premium(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if user and user.is_premium:
-            if user.premium_until and user.premium_until > datetime.utcnow():
-                await message.answer(
-                    "💎 *У вас уже активна премиум-подписка*\n\n"
-                    f"Действует до: {user.premium_until.strftime('%d.%m.%Y')}\n\n"
-                    "Спасибо за поддержку!",
-                    parse_mode="Markdown",
-                    reply_markup=get_more_submenu()
-                )
-                return
+async def buy_premium(message: types.Message, identity: Identity | None):
+    if identity and identity.is_premium:
+        if identity.premium_until and identity.premium_until > datetime.utcnow():
+            await message.answer(
+                "💎 *У вас уже активна премиум-подписка*\n\n"
+                f"Действует до: {identity.premium_until.strftime('%d.%m.%Y')}\n\n"
+                "Спасибо за поддержку!",
+                parse_mode="Markdown",
+                reply_markup=get_more_submenu()
+            )
+            return
 
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="1 месяц (50 ⭐)", callback_data="buy_month")],
@@ -95,14 +95,14 @@ async def successful_payment_handler(message: types.Message):
 
     days = 30 if "month" in payload else 365
 
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == message.from_user.id))
         if user:
             # Определяем базовую дату: если подписка активна, продлеваем от неё, иначе от сейчас
             base_date = user.premium_until if user.premium_until and user.premium_until > datetime.utcnow() else datetime.utcnow()
             user.premium_until = base_date + timedelta(days=days)
             user.is_premium = True
-            db.commit()
+            await db.commit()
         else:
             user = User(
                 telegram_id=message.from_user.id,
@@ -113,7 +113,8 @@ async def successful_payment_handler(message: types.Message):
                 premium_until=datetime.utcnow() + timedelta(days=days)
             )
             db.add(user)
-            db.commit()
+            await db.commit()
+    identity_cache.invalidate(message.from_user.id)
 
     await message.answer(
         f"🎉 *Поздравляем!* Вы стали премиум-пользователем на {days} дней!\n\n"
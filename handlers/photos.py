@@ -3,8 +3,10 @@ from aiogram import Router, types, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from database import SessionLocal, Car, User, FuelEvent, MaintenanceEvent, Insurance
-from keyboards.main_menu import get_more_submenu
+from sqlalchemy import select
+from database import AsyncSessionLocal, FuelEvent, MaintenanceEvent, Insurance
+from keyboards.main_menu import get_more_submenu, is_admin
+from services.identity import Identity
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -13,27 +15,25 @@ class PhotoStates(StatesGroup):
     waiting_for_car_selection = State()
     waiting_for_category_selection = State()
 
-async def start_car_selection(message: types.Message, state: FSMContext, back_menu):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.", reply_markup=back_menu)
-            return
-        # Сохраняем список авто как кортежи (id, название)
-        await state.update_data(cars=[(car.id, f"{car.brand} {car.model}") for car in cars])
-        await state.set_state(PhotoStates.waiting_for_car_selection)
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars
-        ])
-        await message.answer("Выберите автомобиль:", reply_markup=keyboard)
+async def start_car_selection(message: types.Message, state: FSMContext, back_menu, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.", reply_markup=back_menu)
+        return
+    # Сохраняем список авто как кортежи (id, название)
+    cars_list = [(car.id, f"{car.brand} {car.model}") for car in identity.cars]
+    await state.update_data(cars=cars_list)
+    await state.set_state(PhotoStates.waiting_for_car_selection)
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=name, callback_data=f"car_{car_id}")] for car_id, name in cars_list
+    ])
+    await message.answer("Выберите автомобиль:", reply_markup=keyboard)
         
 @router.message(F.text == "📸 Все чеки")
-async def view_all_photos(message: types.Message, state: FSMContext):
-    await start_car_selection(message, state, get_more_submenu)
+async def view_all_photos(message: types.Message, state: FSMContext, identity: Identity | None):
+    await start_car_selection(message, state, get_more_submenu, identity)
 
 @router.callback_query(PhotoStates.waiting_for_car_selection, F.data.startswith("car_"))
 async def car_selected_for_photos(callback: types.CallbackQuery, state: FSMContext):
@@ -56,13 +56,13 @@ async def category_selected_for_photos(callback: types.CallbackQuery, state: FSM
     car_id = data.get("selected_car_id")
     category = callback.data.split("_")[1]  # fuel, maintenance, insurance
 
-    with SessionLocal() as db:
+    async with AsyncSessionLocal() as db:
         if category == "fuel":
-            events = db.query(FuelEvent).filter(FuelEvent.car_id == car_id, FuelEvent.photo_id != None).order_by(FuelEvent.date.desc()).all()
+            events = (await db.scalars(select(FuelEvent).where(FuelEvent.car_id == car_id, FuelEvent.photo_id != None).order_by(FuelEvent.date.desc()))).all()
         elif category == "maintenance":
-            events = db.query(MaintenanceEvent).filter(MaintenanceEvent.car_id == car_id, MaintenanceEvent.photo_id != None).order_by(MaintenanceEvent.date.desc()).all()
+            events = (await db.scalars(select(MaintenanceEvent).where(MaintenanceEvent.car_id == car_id, MaintenanceEvent.photo_id != None).order_by(MaintenanceEvent.date.desc()))).all()
         elif category == "insurance":
-            events = db.query(Insurance).filter(Insurance.car_id == car_id, Insurance.photo_id != None).order_by(Insurance.date.desc()).all()
+            events = (await db.scalars(select(Insurance).where(Insurance.car_id == car_id, Insurance.photo_id != None).order_by(Insurance.date.desc()))).all()
         else:
             events = []
 
@@ -106,5 +106,5 @@ async def back_to_cars(callback: types.CallbackQuery, state: FSMContext):
         await callback.message.edit_text("Выберите автомобиль:", reply_markup=keyboard)
     else:
         await state.clear()
-        await callback.message.edit_text("Просмотр чеков завершён.", reply_markup=get_more_submenu(callback.from_user.id))
+        await callback.message.edit_text("Просмотр чеков завершён.", reply_markup=get_more_submenu(await is_admin(callback.from_user.id)))
     await callback.answer()
@@ -1,16 +1,23 @@
 import logging
+import re
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from database import SessionLocal, Car, User
+from sqlalchemy import select, update
+from database import AsyncSessionLocal, Car, User
 from keyboards.main_menu import get_main_menu, get_maintenance_submenu, get_cancel_keyboard
+from config import config
+from services.identity import Identity
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+# «9», «9:00», «9 +3», «09:00 UTC+5:30»
+REMINDER_TIME_RE = re.compile(r"^(\d{1,2})(?::00)?(?:\s+(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::(\d{2}))?)?$", re.IGNORECASE)
+
 class SetReminder(StatesGroup):
     waiting_for_car = State()
     waiting_for_mileage_interval = State()
@@ -29,40 +36,38 @@ def make_car_keyboard(cars):
 
 @router.message(F.text == "⏰ Напоминания ТО")
 @router.message(Command("set_to_reminder"))
-async def set_reminder_start(message: types.Message, state: FSMContext):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала добавьте автомобиль через /add_car")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
+async def set_reminder_start(message: types.Message, state: FSMContext, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала добавьте автомобиль через /add_car")
+        return
+    cars = identity.cars
+    if not cars:
+        await message.answer("У вас нет автомобилей.")
+        return
 
-        if len(cars) == 1:
-            await state.update_data(car_id=cars[0].id)
-            await state.set_state(SetReminder.waiting_for_mileage_interval)
-            await message.answer(
-                f"⏰ Настройка напоминаний для {cars[0].brand} {cars[0].model}\n\n"
-                "Введите интервал ТО по пробегу в километрах (например, 10000).\n"
-                "Если не хотите получать напоминания по пробегу, отправьте 0:",
-                reply_markup=get_cancel_keyboard()
-            )
-        else:
-            await state.set_state(SetReminder.waiting_for_car)
-            await message.answer(
-                "Выберите автомобиль:",
-                reply_markup=make_car_keyboard(cars)
-            )
+    if len(cars) == 1:
+        await state.update_data(car_id=cars[0].id)
+        await state.set_state(SetReminder.waiting_for_mileage_interval)
+        await message.answer(
+            f"⏰ Настройка напоминаний для {cars[0].brand} {cars[0].model}\n\n"
+            "Введите интервал ТО по пробегу в километрах (например, 10000).\n"
+            "Если не хотите получать напоминания по пробегу, отправьте 0:",
+            reply_markup=get_cancel_keyboard()
+        )
+    else:
+        await state.set_state(SetReminder.waiting_for_car)
+        await message.answer(
+            "Выберите автомобиль:",
+            reply_markup=make_car_keyboard(cars)
+        )
 
 @router.callback_query(F.data.startswith("remind_car_"))
 async def process_car_choice(callback: types.CallbackQuery, state: FSMContext):
     car_id = int(callback.data.split("_")[-1])
     await state.update_data(car_id=car_id)
     await state.set_state(SetReminder.waiting_for_mileage_interval)
-    with SessionLocal() as db:
-        car = db.query(Car).filter(Car.id == car_id).first()
+    async with AsyncSessionLocal() as db:
+        car = await db.scalar(select(Car).where(Car.id == car_id))
         if car:
             await callback.message.edit_text(
                 f"⏰ Настройка напоминаний для {car.brand} {car.model}\n\n"
@@ -110,14 +115,15 @@ async def process_months_interval(message: types.Message, state: FSMContext):
         car_id = data['car_id']
         mileage_int = data['mileage_int']
 
-        with SessionLocal() as db:
-            car = db.query(Car).filter(Car.id == car_id).first()
+        async with AsyncSessionLocal() as db:
+            car = await db.scalar(select(Car).where(Car.id == car_id))
             if car:
                 car.to_mileage_interval = mileage_int if mileage_int > 0 else None
                 car.to_months_interval = months_int if months_int > 0 else None
                 car.notified_to_mileage = False
                 car.notified_to_date = False
-                db.commit()
+                car.update_next_due()
+                await db.commit()
                 car_brand = car.brand
                 car_model = car.model
                 mileage_display = f"{mileage_int} км" if mileage_int > 0 else "не установлен"
@@ -139,17 +145,16 @@ async def process_months_interval(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите целое число (например, 12)")
 
 @router.message(Command("show_reminders"))
-async def show_reminders(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь")
-            return
-        cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).all()
-        if not cars:
-            await message.answer("У вас нет автомобилей.")
-            return
+async def show_reminders(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь")
+        return
+    if not identity.cars:
+        await message.answer("У вас нет автомобилей.")
+        return
 
+    async with AsyncSessionLocal() as db:
+        cars = (await db.scalars(select(Car).where(Car.user_id == identity.user_id, Car.is_active == True))).all()
         lines = ["⏰ Текущие настройки напоминаний:\n"]
         for car in cars:
             mileage_int = car.to_mileage_interval if car.to_mileage_interval else "не установлен"
@@ -162,4 +167,76 @@ async def show_reminders(message: types.Message):
                 f"  Интервал по пробегу: {mileage_int} км\n"
                 f"  Интервал по времени: {months_int} мес."
             )
+        user = await db.get(User, identity.user_id)
+        lines.append(
+            f"📬 Сводка напоминаний: {'включена' if user.reminder_digest is not False else 'выключена'}\n"
+            f"  /digest — переключить\n"
+            f"🕘 Время напоминаний: {format_reminder_time(user.reminder_hour, user.utc_offset)}\n"
+            f"  /reminder_time — изменить"
+        )
         await message.answer("\n\n".join(lines), reply_markup=get_maintenance_submenu())
+
+@router.message(Command("digest"))
+async def toggle_digest(message: types.Message, identity: Identity | None):
+    """Включает или выключает сводку: несколько напоминаний за день приходят одним сообщением."""
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь")
+        return
+    async with AsyncSessionLocal() as db:
+        digest = await db.scalar(select(User.reminder_digest).where(User.id == identity.user_id))
+        enabled = digest is False
+        await db.execute(update(User).where(User.id == identity.user_id).values(reminder_digest=enabled))
+        await db.commit()
+    if enabled:
+        await message.answer("📬 Сводка включена: все напоминания за день придут одним сообщением.")
+    else:
+        await message.answer("📭 Сводка выключена: каждое напоминание придёт отдельным сообщением.")
+
+def format_offset(offset: int) -> str:
+    sign = "+" if offset >= 0 else "-"
+    hours, minutes = divmod(abs(offset), 60)
+    return f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+
+def format_reminder_time(hour: int | None, offset: int | None) -> str:
+    hour = config.DEFAULT_REMINDER_HOUR if hour is None else hour
+    offset = config.DEFAULT_UTC_OFFSET if offset is None else offset
+    return f"{hour:02d}:00 ({format_offset(offset)})"
+
+def parse_reminder_time(text: str):
+    """Возвращает (час, смещение в минутах или None) либо None, если формат не распознан."""
+    match = REMINDER_TIME_RE.match(text.strip())
+    if not match:
+        return None
+    hour = int(match.group(1))
+    offset = None
+    if match.group(2):
+        offset = int(match.group(3)) * 60 + int(match.group(4) or 0)
+        if match.group(2) == "-":
+            offset = -offset
+    if hour > 23 or (offset is not None and not -12 * 60 <= offset <= 14 * 60):
+        return None
+    return hour, offset
+
+@router.message(Command("reminder_time"))
+async def set_reminder_time(message: types.Message, command: CommandObject, identity: Identity | None):
+    """Час, в который приходят напоминания, и часовой пояс пользователя."""
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь")
+        return
+    async with AsyncSessionLocal() as db:
+        user = await db.get(User, identity.user_id)
+        parsed = parse_reminder_time(command.args) if command.args else None
+        if parsed is None:
+            await message.answer(
+                f"🕘 Напоминания приходят в {format_reminder_time(user.reminder_hour, user.utc_offset)}.\n\n"
+                f"Чтобы изменить, укажите час и часовой пояс:\n"
+                f"/reminder_time 8 +3 — в 08:00 по Москве\n"
+                f"/reminder_time 20 — в 20:00, пояс без изменений"
+            )
+            return
+        hour, offset = parsed
+        user.reminder_hour = hour
+        if offset is not None:
+            user.utc_offset = offset
+        await db.commit()
+        await message.answer(f"✅ Напоминания будут приходить в {format_reminder_time(user.reminder_hour, user.utc_offset)}.")
@@ -1,20 +1,31 @@
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
-from sqlalchemy import func
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
 from decimal import Decimal
 
-from database import SessionLocal, Car, FuelEvent, MaintenanceEvent, User, Insurance, Part
+from database import AsyncSessionLocal, Car, FuelEvent, MaintenanceEvent, Insurance, Part
 from keyboards.main_menu import get_stats_submenu
+from services.stats_cache import stats_cache
+from services.identity import Identity
 from config import config
 
 router = Router()
 logger = logging.getLogger(__name__)
 
 # ------------------- Вспомогательные функции -------------------
-def get_last_fuel_events(db, car_id, limit=3):
-    events = db.query(FuelEvent).filter(FuelEvent.car_id == car_id).order_by(FuelEvent.date.desc()).limit(limit).all()
+def latest_per_car(model, car_ids, order_by, limit):
+    """Последние limit записей model по каждой машине одним запросом (ROW_NUMBER по car_id)."""
+    rn = func.row_number().over(partition_by=model.car_id, order_by=order_by).label("rn")
+    ranked = select(model, rn).where(model.car_id.in_(car_ids)).subquery()
+    entity = aliased(model, ranked)
+    return select(entity).where(ranked.c.rn <= limit).order_by(ranked.c.car_id, ranked.c.rn)
+
+def format_last_fuel_events(events):
+    """events — заправки одной машины, от новых к старым."""
     result = []
     events_asc = sorted(events, key=lambda x: x.date)
     for i, ev in enumerate(events_asc):
@@ -34,15 +45,30 @@ def get_last_fuel_events(db, car_id, limit=3):
         })
     return list(reversed(result))
 
-def get_upcoming_parts(db, car_id):
+def avg_consumption_of(events):
+    if len(events) < 2:
+        return None
+    sorted_events = sorted(events, key=lambda x: x.date)
+    total_liters = 0
+    total_distance = 0
+    prev = None
+    for ev in sorted_events:
+        if prev and ev.mileage and prev.mileage and ev.mileage > prev.mileage:
+            total_distance += ev.mileage - prev.mileage
+            total_liters += ev.liters
+        prev = ev
+    if total_distance > 0:
+        return (float(total_liters) / total_distance) * 100
+    return None
+
+def format_upcoming_parts(parts, current_mileage):
     today = datetime.utcnow().date()
-    parts = db.query(Part).filter(Part.car_id == car_id).all()
     upcoming = []
     for part in parts:
         reasons = []
         if part.interval_mileage and part.last_mileage is not None:
             next_mileage = part.last_mileage + part.interval_mileage
-            remaining_km = next_mileage - part.car.current_mileage
+            remaining_km = next_mileage - current_mileage
             if remaining_km <= 0:
                 reasons.append("⚠️ пора менять")
             elif remaining_km <= 10000:
@@ -58,8 +84,7 @@ def get_upcoming_parts(db, car_id):
             upcoming.append(f"• {part.name}: {', '.join(reasons)}")
     return upcoming
 
-def get_insurance_info(db, car_id):
-    ins = db.query(Insurance).filter(Insurance.car_id == car_id).order_by(Insurance.end_date.desc()).first()
+def format_insurance_info(ins):
     if not ins:
         return "не оформлена"
     today = datetime.utcnow().date()
@@ -67,45 +92,59 @@ def get_insurance_info(db, car_id):
     status = "⚠️ истекла" if days_left < 0 else f"✅ {days_left} дн."
     return f"{ins.company} (до {ins.end_date.strftime('%d.%m.%Y')}) – {status}"
 
-def get_detailed_stats(db, user_id):
-    cars = db.query(Car).filter(Car.user_id == user_id, Car.is_active == True).all()
+def as_float(value):
+    return float(value) if isinstance(value, Decimal) else (value or 0)
+
+async def get_detailed_stats(db, user_id):
+    return await stats_cache.get_or_load(user_id, "detailed", lambda: load_detailed_stats(db, user_id))
+
+async def load_detailed_stats(db, user_id):
+    """Статистика по всем активным машинам пользователя за фиксированное число запросов."""
+    cars = (await db.scalars(select(Car).where(Car.user_id == user_id, Car.is_active == True))).all()
+    if not cars:
+        return []
+    car_ids = [car.id for car in cars]
+
+    fuel_totals = dict((await db.execute(
+        select(FuelEvent.car_id, func.sum(FuelEvent.cost))
+        .where(FuelEvent.car_id.in_(car_ids))
+        .group_by(FuelEvent.car_id)
+    )).all())
+    maint_totals = dict((await db.execute(
+        select(MaintenanceEvent.car_id, func.sum(MaintenanceEvent.cost))
+        .where(MaintenanceEvent.car_id.in_(car_ids))
+        .group_by(MaintenanceEvent.car_id)
+    )).all())
+
+    # Последние 10 заправок по каждой машине: из них считается средний расход, первые 3 идут в список
+    fuel_by_car = defaultdict(list)
+    for ev in (await db.scalars(latest_per_car(FuelEvent, car_ids, FuelEvent.date.desc(), 10))).all():
+        fuel_by_car[ev.car_id].append(ev)
+
+    parts_by_car = defaultdict(list)
+    for part in (await db.scalars(select(Part).where(Part.car_id.in_(car_ids)).order_by(Part.id))).all():
+        parts_by_car[part.car_id].append(part)
+
+    insurance_by_car = {
+        ins.car_id: ins
+        for ins in (await db.scalars(latest_per_car(Insurance, car_ids, Insurance.end_date.desc(), 1))).all()
+    }
+
     result = []
     for car in cars:
-        total_fuel = db.query(func.sum(FuelEvent.cost)).filter(FuelEvent.car_id == car.id).scalar() or 0
-        total_maint = db.query(func.sum(MaintenanceEvent.cost)).filter(MaintenanceEvent.car_id == car.id).scalar() or 0
-        total_fuel = float(total_fuel) if isinstance(total_fuel, Decimal) else total_fuel
-        total_maint = float(total_maint) if isinstance(total_maint, Decimal) else total_maint
-        total_expenses = total_fuel + total_maint
-
-        fuel_events = db.query(FuelEvent).filter(FuelEvent.car_id == car.id).order_by(FuelEvent.date.desc()).limit(10).all()
-        avg_consumption = None
-        if len(fuel_events) >= 2:
-            sorted_events = sorted(fuel_events, key=lambda x: x.date)
-            total_liters = 0
-            total_distance = 0
-            prev = None
-            for ev in sorted_events:
-                if prev and ev.mileage and prev.mileage and ev.mileage > prev.mileage:
-                    total_distance += ev.mileage - prev.mileage
-                    total_liters += ev.liters
-                prev = ev
-            if total_distance > 0:
-                avg_consumption = (float(total_liters) / total_distance) * 100
-
-        last_fuel = get_last_fuel_events(db, car.id)
-        upcoming_parts = get_upcoming_parts(db, car.id)
-        insurance_info = get_insurance_info(db, car.id)
-
+        total_fuel = as_float(fuel_totals.get(car.id))
+        total_maint = as_float(maint_totals.get(car.id))
+        fuel_events = fuel_by_car[car.id]
         result.append({
             "car": f"{car.brand} {car.model} ({car.year})",
             "mileage": car.current_mileage,
             "total_fuel": total_fuel,
             "total_maint": total_maint,
-            "total_expenses": total_expenses,
-            "avg_consumption": avg_consumption,
-            "last_fuel": last_fuel,
-            "upcoming_parts": upcoming_parts,
-            "insurance": insurance_info
+            "total_expenses": total_fuel + total_maint,
+            "avg_consumption": avg_consumption_of(fuel_events),
+            "last_fuel": format_last_fuel_events(fuel_events[:3]),
+            "upcoming_parts": format_upcoming_parts(parts_by_car[car.id], car.current_mileage),
+            "insurance": format_insurance_info(insurance_by_car.get(car.id))
         })
     return result
 
@@ -137,13 +176,12 @@ async def send_long_message(message: types.Message, text: str, reply_markup=None
             await message.answer(part, parse_mode="Markdown")
 
 @router.message(F.text == "📊 Статистика")
-async def show_stats(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь, отправив /start")
-            return
-        stats = get_detailed_stats(db, user.id)
+async def show_stats(message: types.Message, identity: Identity | None):
+    if not identity:
+        await message.answer("Сначала зарегистрируйтесь, отправив /start")
+        return
+    async with AsyncSessionLocal() as db:
+        stats = await get_detailed_stats(db, identity.user_id)
         if not stats:
             await message.answer("У вас нет автомобилей.", reply_markup=get_stats_submenu())
             return
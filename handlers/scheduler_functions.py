@@ -1,179 +1,433 @@
+import asyncio
+import hashlib
 import logging
-from datetime import datetime, timedelta
-from sqlalchemy import and_
+from datetime import datetime, timedelta, time
+from typing import NamedTuple
+from sqlalchemy import select, update, exists, case, and_, or_, func
 from sqlalchemy.orm import selectinload
-from database import SessionLocal, Insurance, Car, User, Part, BannedUser
+from database import AsyncSessionLocal, Insurance, Car, User, Part, BannedUser
 from config import config
+from handlers.ai_advice import build_cars_data, car_fingerprint, generate_advice
+from handlers.monthly_reports import load_monthly_totals, previous_month, render_monthly_report, compare_premium_keyboard
+from services.advice_cache import advice_cache
+from services.outbox import outbox
+from services.scheduler import advisory_lock, get_cursor, set_cursor
 
 logger = logging.getLogger(__name__)
 
-async def is_user_banned(user_id: int) -> bool:
-    with SessionLocal() as db:
-        banned = db.query(BannedUser).filter(BannedUser.telegram_id == user_id).first()
-        return banned is not None
+MONTHLY_REPORTS_PAGE_SIZE = 500
+# Имя задачи для блокировки и курсора обработанных слотов
+REMINDERS_JOB = "reminders"
+AI_PRECOMPUTE_JOB = "ai_precompute"
+# Машин на страницу ночного расчёта AI-советов
+AI_PRECOMPUTE_PAGE_SIZE = 100
+# Сводка напоминаний режется на сообщения не длиннее лимита Telegram
+DIGEST_MAX_LENGTH = 4000
+DIGEST_SEPARATOR = "\n\n———\n\n"
+
+SLOTS_PER_DAY = 24 * 60 // config.REMINDER_SLOT_MINUTES
+# Пользователи одного часа распределяются по слотам внутри часа по id
+SLOTS_PER_HOUR = max(1, 60 // config.REMINDER_SLOT_MINUTES)
+
+def user_slot():
+    """SQL-выражение: номер слота суток по UTC, в который пользователь получает напоминания."""
+    local_minute = func.coalesce(User.reminder_hour, config.DEFAULT_REMINDER_HOUR) * 60
+    utc_minute = (local_minute - func.coalesce(User.utc_offset, config.DEFAULT_UTC_OFFSET) + 2 * 1440) % 1440
+    return (utc_minute // config.REMINDER_SLOT_MINUTES + User.id % SLOTS_PER_HOUR) % SLOTS_PER_DAY
+
+def current_slot(now: datetime | None = None) -> int:
+    now = now or datetime.utcnow()
+    return (now.hour * 60 + now.minute) // config.REMINDER_SLOT_MINUTES
+
+def slot_filter(slot: int | None):
+    return () if slot is None else (user_slot() == slot,)
+
+def not_banned():
+    """Заблокированные пропускаются без отметки notified_*, чтобы после разбана напоминание всё же пришло."""
+    return ~exists().where(BannedUser.telegram_id == User.telegram_id)
+
+def insurance_message(bucket: str, brand: str, model: str, end_date: datetime, days_left: int) -> str:
+    if bucket == "7d":
+        return (
+            f"⚠️ Напоминание о страховке!\n\n"
+            f"Автомобиль: {brand} {model}\n"
+            f"Срок действия истекает через {days_left} дн. ({end_date.strftime('%d.%m.%Y')}).\n"
+            f"Не забудьте продлить."
+        )
+    if bucket == "3d":
+        return (
+            f"⚠️⚠️ СРОЧНО! Страховка на {brand} {model} "
+            f"истекает через {days_left} дн. ({end_date.strftime('%d.%m.%Y')}).\n"
+            f"Продлите полис, чтобы избежать проблем."
+        )
+    return (
+        f"❗️ СРОК СТРАХОВКИ ИСТЁК!\n\n"
+        f"Автомобиль: {brand} {model}\n"
+        f"Страховка закончилась {end_date.strftime('%d.%m.%Y')}.\n"
+        f"Необходимо приобрести новый полис."
+    )
+
+# Какие флаги выставляются после отправки уведомления из корзины.
+# Более срочное уведомление закрывает и менее срочные, чтобы они не пришли после него.
+INSURANCE_BUCKET_FLAGS = {
+    "7d": {"notified_7d": True},
+    "3d": {"notified_7d": True, "notified_3d": True},
+    "expired": {"notified_7d": True, "notified_3d": True, "notified_expired": True},
+}
+
+class ReminderItem(NamedTuple):
+    """Одно напоминание: куда отправить, текст и какой флаг notified_* выставить после постановки в очередь."""
+    key: str
+    telegram_id: int
+    digest: bool
+    text: str
+    model: type
+    record_id: int
+    flags: dict
+
+def reminder_window(today):
+    """Граница «наступило сегодня» для дат ТО и деталей."""
+    return datetime.combine(today, time.min) + timedelta(days=1)
+
+async def collect_insurances(db, today, user_filter=()) -> list[ReminderItem]:
+    day_start = datetime.combine(today, time.min)
+    # Границы по end_date эквивалентны days_left <= 0 / <= 3 / <= 7 и используют индекс по end_date
+    expired_before = day_start + timedelta(days=1)
+    in_3d_before = day_start + timedelta(days=4)
+    in_7d_before = day_start + timedelta(days=8)
+
+    bucket = case(
+        (and_(Insurance.end_date < expired_before, Insurance.notified_expired.is_not(True)), "expired"),
+        (and_(Insurance.end_date >= expired_before, Insurance.end_date < in_3d_before,
+              Insurance.notified_3d.is_not(True)), "3d"),
+        (and_(Insurance.end_date >= expired_before, Insurance.end_date < in_7d_before,
+              Insurance.notified_7d.is_not(True)), "7d"),
+    )
+    stmt = (
+        select(Insurance.id, Insurance.end_date, Car.brand, Car.model, User.telegram_id,
+               User.reminder_digest, bucket.label("bucket"))
+        .join(Car, Insurance.car_id == Car.id)
+        .join(User, Car.user_id == User.id)
+        .where(
+            Insurance.is_active == True,
+            Insurance.end_date < in_7d_before,
+            bucket.is_not(None),
+            User.is_reachable.is_not(False),
+            not_banned(),
+            *user_filter
+        )
+    )
+    items = []
+    for row in (await db.execute(stmt)).all():
+        days_left = (row.end_date.date() - today).days
+        items.append(ReminderItem(
+            f"insurance:{row.id}:{row.end_date:%Y-%m-%d}:{row.bucket}", row.telegram_id, row.reminder_digest is not False,
+            insurance_message(row.bucket, row.brand, row.model, row.end_date, days_left),
+            Insurance, row.id, INSURANCE_BUCKET_FLAGS[row.bucket],
+        ))
+    return items
+
+async def collect_maintenance(db, today, user_filter=()) -> list[ReminderItem]:
+    due_date_before = reminder_window(today)
+    due_by_mileage = and_(Car.notified_to_mileage == False, Car.next_due_mileage <= Car.current_mileage)
+    due_by_date = and_(Car.notified_to_date == False, Car.next_due_date < due_date_before)
+    # Индексы ix_cars_due_* отдают только машины, по которым пора отправлять напоминание
+    stmt = (
+        select(Car, User.telegram_id, User.reminder_digest)
+        .join(User, Car.user_id == User.id)
+        .where(
+            Car.is_active == True,
+            due_by_mileage | due_by_date,
+            User.is_reachable.is_not(False),
+            not_banned(),
+            *user_filter
+        )
+    )
+    items = []
+    for car, telegram_id, digest in (await db.execute(stmt)).all():
+        digest = digest is not False
+        if (not car.notified_to_mileage and car.next_due_mileage is not None
+                and car.current_mileage >= car.next_due_mileage):
+            items.append(ReminderItem(
+                f"to_mileage:{car.id}:{car.next_due_mileage:.0f}", telegram_id, digest,
+                f"⚠️ Напоминание о ТО по пробегу!\n\n"
+                f"Автомобиль: {car.brand} {car.model}\n"
+                f"Пробег: {car.current_mileage:,.0f} км\n"
+                f"Последнее ТО было при пробеге {car.last_maintenance_mileage:,.0f} км.\n"
+                f"Интервал: {car.to_mileage_interval:,.0f} км.\n"
+                f"Рекомендуется пройти ТО.",
+                Car, car.id, {"notified_to_mileage": True},
+            ))
+        if not car.notified_to_date and car.next_due_date is not None and car.next_due_date < due_date_before:
+            items.append(ReminderItem(
+                f"to_date:{car.id}:{car.next_due_date:%Y-%m-%d}", telegram_id, digest,
+                f"⚠️ Напоминание о ТО по времени!\n\n"
+                f"Автомобиль: {car.brand} {car.model}\n"
+                f"Последнее ТО было {car.last_maintenance_date.strftime('%d.%m.%Y')}.\n"
+                f"Интервал: {car.to_months_interval} мес.\n"
+                f"Рекомендуется пройти ТО.",
+                Car, car.id, {"notified_to_date": True},
+            ))
+    return items
+
+async def collect_parts(db, today, user_filter=()) -> list[ReminderItem]:
+    due_date_before = reminder_window(today)
+    stmt = (
+        select(Part, Car.brand, Car.model, Car.current_mileage, User.telegram_id, User.reminder_digest)
+        .join(Car, Part.car_id == Car.id)
+        .join(User, Car.user_id == User.id)
+        .where(
+            Part.notified == False,
+            (Part.next_due_mileage <= Car.current_mileage) | (Part.next_due_date < due_date_before),
+            User.is_reachable.is_not(False),
+            not_banned(),
+            *user_filter
+        )
+    )
+    items = []
+    for part, brand, model, current_mileage, telegram_id, digest in (await db.execute(stmt)).all():
+        reasons = []
+        if part.next_due_mileage is not None and current_mileage >= part.next_due_mileage:
+            reasons.append("пробег")
+        if part.next_due_date is not None and part.next_due_date < due_date_before:
+            reasons.append("время")
+        items.append(ReminderItem(
+            f"part:{part.id}:{part.next_due_mileage}:{part.next_due_date}", telegram_id, digest is not False,
+            f"⚠️ Напоминание о замене детали!\n\n"
+            f"Автомобиль: {brand} {model}\n"
+            f"Деталь/жидкость: {part.name}\n"
+            f"Причина: истёк интервал по {', '.join(reasons)}.\n"
+            f"Рекомендуется заменить.",
+            Part, part.id, {"notified": True},
+        ))
+    return items
+
+def render_digest(items: list[ReminderItem]) -> list[str]:
+    """Сводка напоминаний одного пользователя; длинная сводка делится на несколько сообщений."""
+    header = f"🔔 Напоминания на сегодня ({len(items)}):"
+    messages, current = [], header
+    for item in items:
+        if len(current) + len(DIGEST_SEPARATOR) + len(item.text) > DIGEST_MAX_LENGTH:
+            messages.append(current)
+            current = item.text
+        else:
+            current += DIGEST_SEPARATOR + item.text
+    messages.append(current)
+    return messages
+
+def build_notifications(items: list[ReminderItem]):
+    """Группирует напоминания по пользователям: одно сообщение-сводка вместо нескольких.
+    Пользователи, отключившие сводку, и единственное напоминание уходят как есть."""
+    by_user = {}
+    for item in items:
+        by_user.setdefault(item.telegram_id, []).append(item)
+    notifications = []
+    for telegram_id, user_items in by_user.items():
+        if len(user_items) == 1 or not user_items[0].digest:
+            notifications.extend((item.key, telegram_id, item.text) for item in user_items)
+            continue
+        # Ключ сводки зависит от состава, поэтому новое напоминание в тот же день не потеряется
+        digest_id = hashlib.sha1("|".join(sorted(item.key for item in user_items)).encode()).hexdigest()[:16]
+        for i, text in enumerate(render_digest(user_items)):
+            notifications.append((f"digest:{telegram_id}:{digest_id}:{i}", telegram_id, text))
+    return notifications
+
+async def process_reminders(collectors, title: str, slot: int | None = None):
+    """Собирает напоминания, ставит их в outbox и выставляет флаги notified_* одной транзакцией.
+    slot ограничивает обработку пользователями одного временного слота."""
+    today = datetime.utcnow().date()
+    async with AsyncSessionLocal() as db:
+        items = []
+        for collect in collectors:
+            items.extend(await collect(db, today, slot_filter(slot)))
+        notifications = build_notifications(items)
+
+        flagged = {}
+        for item in items:
+            flagged.setdefault((item.model, tuple(sorted(item.flags.items()))), []).append(item.record_id)
+        # Флаги выставляются в той же транзакции, поэтому повтор ключа означает, что напоминание взведено заново
+        await outbox.add(db, notifications, requeue=True)
+        for (model, flags), ids in flagged.items():
+            await db.execute(update(model).where(model.id.in_(ids)).values(**dict(flags)))
+        await db.commit()
+    if notifications:
+        outbox.wake()
+    if items or slot is None:
+        logger.info(f"{title}: напоминаний {len(items)}, в очереди {len(notifications)}")
+
+async def process_all_reminders(slot: int | None = None):
+    """Страховки, ТО и детали одной сводкой; без slot — для всех пользователей сразу."""
+    title = "Напоминания" if slot is None else f"Напоминания (слот {slot})"
+    await process_reminders((collect_insurances, collect_maintenance, collect_parts), title, slot)
+
+def slot_start(now: datetime) -> datetime:
+    return now.replace(minute=now.minute - now.minute % config.REMINDER_SLOT_MINUTES, second=0, microsecond=0)
+
+async def reminders_tick():
+    """Запускается каждые REMINDER_SLOT_MINUTES минут и обрабатывает только пользователей текущего слота,
+    поэтому нагрузка на БД и Telegram распределяется по суткам.
+
+    Слоты обрабатываются под блокировкой, а последний обработанный хранится в БД: при нескольких
+    репликах каждый слот отрабатывает ровно одна, а слоты, пропущенные за время простоя, досылаются.
+    Курсор сдвигается только после успешной обработки слота; слот с ошибкой повторяется на следующем
+    запуске — повтор безопасен, так как флаги notified_* и ключи outbox не дают отправить уведомление дважды.
+    """
+    async with advisory_lock(REMINDERS_JOB) as acquired:
+        if not acquired:
+            logger.debug("Слоты напоминаний обрабатывает другая реплика")
+            return
+        step = timedelta(minutes=config.REMINDER_SLOT_MINUTES)
+        current = slot_start(datetime.utcnow())
+        last = await get_cursor(REMINDERS_JOB)
+        start = current if last is None else max(last + step, current - timedelta(hours=config.SCHEDULER_CATCHUP_HOURS))
+        if start < current:
+            logger.info(f"Досылаем пропущенные слоты напоминаний с {start:%d.%m %H:%M} UTC")
+        while start <= current:
+            slot = current_slot(start)
+            try:
+                await process_all_reminders(slot)
+                if start.day == 1:
+                    await queue_monthly_reports(start, slot)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки слота {start:%d.%m %H:%M} UTC, повторим на следующем запуске: {e}")
+                return
+            await set_cursor(REMINDERS_JOB, start)
+            start += step
 
 async def check_insurances(bot):
     logger.info("🔍 Проверка сроков страховок...")
     try:
-        with SessionLocal() as db:
-            today = datetime.utcnow().date()
-            # Загружаем только активные страховки, которые истекают в ближайшие 7 дней
-            insurances = db.query(Insurance).options(
-                selectinload(Insurance.car).selectinload(Car.owner)
-            ).filter(
-                Insurance.is_active == True,
-                Insurance.end_date <= today + timedelta(days=7)
-            ).all()
-
-            for ins in insurances:
-                car = ins.car
-                if not car or not car.owner:
-                    continue
-                user_id = car.owner.telegram_id
-                if await is_user_banned(user_id):
-                    continue
-
-                days_left = (ins.end_date.date() - today).days
-
-                if 0 < days_left <= 7 and not ins.notified_7d:
-                    await bot.send_message(
-                        user_id,
-                        f"⚠️ Напоминание о страховке!\n\n"
-                        f"Автомобиль: {car.brand} {car.model}\n"
-                        f"Срок действия истекает через {days_left} дн. ({ins.end_date.strftime('%d.%m.%Y')}).\n"
-                        f"Не забудьте продлить."
-                    )
-                    ins.notified_7d = True
-                    db.commit()
-                    logger.info(f"Уведомление за 7 дней отправлено пользователю {user_id}")
-
-                elif 0 < days_left <= 3 and not ins.notified_3d:
-                    await bot.send_message(
-                        user_id,
-                        f"⚠️⚠️ СРОЧНО! Страховка на {car.brand} {car.model} "
-                        f"истекает через {days_left} дн. ({ins.end_date.strftime('%d.%m.%Y')}).\n"
-                        f"Продлите полис, чтобы избежать проблем."
-                    )
-                    ins.notified_3d = True
-                    db.commit()
-                    logger.info(f"Уведомление за 3 дня отправлено пользователю {user_id}")
-
-                elif days_left <= 0 and not ins.notified_expired:
-                    await bot.send_message(
-                        user_id,
-                        f"❗️ СРОК СТРАХОВКИ ИСТЁК!\n\n"
-                        f"Автомобиль: {car.brand} {car.model}\n"
-                        f"Страховка закончилась {ins.end_date.strftime('%d.%m.%Y')}.\n"
-                        f"Необходимо приобрести новый полис."
-                    )
-                    ins.notified_expired = True
-                    db.commit()
-                    logger.info(f"Уведомление об истечении отправлено пользователю {user_id}")
+        await process_reminders((collect_insurances,), "Уведомления о страховках")
     except Exception as e:
         logger.exception(f"Ошибка в check_insurances: {e}")
 
 async def check_maintenance_reminders(bot):
     logger.info("🔧 Проверка сроков ТО...")
     try:
-        with SessionLocal() as db:
-            today = datetime.utcnow().date()
-            cars = db.query(Car).options(selectinload(Car.owner)).filter(
-                Car.is_active == True,
-                (Car.to_mileage_interval != None) | (Car.to_months_interval != None)
-            ).all()
-            for car in cars:
-                if not car.owner:
-                    continue
-                user_id = car.owner.telegram_id
-                if await is_user_banned(user_id):
-                    continue
-
-                if car.to_mileage_interval and car.last_maintenance_mileage is not None:
-                    next_mileage = car.last_maintenance_mileage + car.to_mileage_interval
-                    if car.current_mileage >= next_mileage and not car.notified_to_mileage:
-                        await bot.send_message(
-                            user_id,
-                            f"⚠️ Напоминание о ТО по пробегу!\n\n"
-                            f"Автомобиль: {car.brand} {car.model}\n"
-                            f"Пробег: {car.current_mileage:,.0f} км\n"
-                            f"Последнее ТО было при пробеге {car.last_maintenance_mileage:,.0f} км.\n"
-                            f"Интервал: {car.to_mileage_interval:,.0f} км.\n"
-                            f"Рекомендуется пройти ТО."
-                        )
-                        car.notified_to_mileage = True
-                        db.commit()
-                        logger.info(f"Уведомление о ТО по пробегу отправлено пользователю {user_id}")
-
-                if car.to_months_interval and car.last_maintenance_date is not None:
-                    next_date = car.last_maintenance_date + timedelta(days=30 * car.to_months_interval)
-                    days_left = (next_date.date() - today).days
-                    if days_left <= 0 and not car.notified_to_date:
-                        await bot.send_message(
-                            user_id,
-                            f"⚠️ Напоминание о ТО по времени!\n\n"
-                            f"Автомобиль: {car.brand} {car.model}\n"
-                            f"Последнее ТО было {car.last_maintenance_date.strftime('%d.%m.%Y')}.\n"
-                            f"Интервал: {car.to_months_interval} мес.\n"
-                            f"Рекомендуется пройти ТО."
-                        )
-                        car.notified_to_date = True
-                        db.commit()
-                        logger.info(f"Уведомление о ТО по дате отправлено пользователю {user_id}")
+        await process_reminders((collect_maintenance,), "Напоминания о ТО")
     except Exception as e:
         logger.exception(f"Ошибка в check_maintenance_reminders: {e}")
 
 async def check_parts_reminders(bot):
     logger.info("🔧 Проверка сроков замены деталей...")
     try:
-        with SessionLocal() as db:
-            today = datetime.utcnow().date()
-            parts = db.query(Part).options(
-                selectinload(Part.car).selectinload(Car.owner)
-            ).filter(
-                (Part.interval_mileage != None) | (Part.interval_months != None),
-                Part.notified == False
-            ).all()
-            for part in parts:
-                car = part.car
-                if not car or not car.owner:
-                    continue
-                user_id = car.owner.telegram_id
-                if await is_user_banned(user_id):
-                    continue
-
-                need_notify = False
-                reasons = []
-
-                if part.interval_mileage and part.last_mileage is not None:
-                    next_mileage = part.last_mileage + part.interval_mileage
-                    if car.current_mileage >= next_mileage:
-                        need_notify = True
-                        reasons.append("пробег")
-                if part.interval_months and part.last_date is not None:
-                    next_date = part.last_date + timedelta(days=30 * part.interval_months)
-                    if next_date.date() <= today:
-                        need_notify = True
-                        reasons.append("время")
-
-                if need_notify:
-                    await bot.send_message(
-                        user_id,
-                        f"⚠️ Напоминание о замене детали!\n\n"
-                        f"Автомобиль: {car.brand} {car.model}\n"
-                        f"Деталь/жидкость: {part.name}\n"
-                        f"Причина: истёк интервал по {', '.join(reasons)}.\n"
-                        f"Рекомендуется заменить."
-                    )
-                    part.notified = True
-                    db.commit()
-                    logger.info(f"Уведомление о детали '{part.name}' отправлено пользователю {user_id}")
+        await process_reminders((collect_parts,), "Напоминания о деталях")
     except Exception as e:
         logger.exception(f"Ошибка в check_parts_reminders: {e}")
 
-async def send_monthly_reports(bot):
-    logger.info("📅 Ежемесячные отчёты...")
-    try:
-        # Здесь будет логика отправки отчётов (можно оставить заглушку)
-        pass
-    except Exception as e:
-        logger.exception(f"Ошибка в send_monthly_reports: {e}")
+def monthly_report_message(report_year, report_month, user_totals, is_premium, keyboard):
+    """Текст и параметры отправки ежемесячного отчёта одного пользователя."""
+    empty = {"total_fuel": 0.0, "total_maintenance": 0.0}
+    current = user_totals.get((report_year, report_month), empty)
+    if is_premium:
+        prev_period = previous_month(report_year, report_month)
+        text = render_monthly_report(report_year, report_month, current, user_totals.get(prev_period, empty))
+        return text, {"parse_mode": "Markdown"}
+    text = render_monthly_report(report_year, report_month, current)
+    return text, {"parse_mode": "Markdown", "reply_markup": keyboard}
+
+async def preview_monthly_report(telegram_id: int, today: datetime | None = None):
+    """Отчёт за прошлый месяц для одного пользователя без постановки в outbox: (текст, параметры) или None."""
+    today = today or datetime.utcnow()
+    report_year, report_month = previous_month(today.year, today.month)
+    async with AsyncSessionLocal() as db:
+        user = (await db.execute(
+            select(User.id, User.is_premium).where(User.telegram_id == telegram_id)
+        )).first()
+        if user is None:
+            return None
+        totals = await load_monthly_totals(
+            db, [(report_year, report_month), previous_month(report_year, report_month)], [user.id]
+        )
+    return monthly_report_message(report_year, report_month, totals.get(user.id, {}), user.is_premium,
+                                  compare_premium_keyboard())
+
+async def queue_monthly_reports(today: datetime, slot: int | None = None):
+    """Ставит в outbox отчёты за месяц, предшествующий today; суммы читаются только для пользователей страницы."""
+    report_year, report_month = previous_month(today.year, today.month)
+    prev_period = previous_month(report_year, report_month)
+    keyboard = compare_premium_keyboard()
+    has_active_car = exists().where(Car.user_id == User.id, Car.is_active == True)
+    last_id = 0
+    total = 0
+    # Пользователи читаются страницами по id, чтобы не держать весь список в памяти
+    while True:
+        async with AsyncSessionLocal() as db:
+            users = (await db.execute(
+                select(User.id, User.telegram_id, User.is_premium)
+                .where(User.id > last_id, User.telegram_id.is_not(None), User.is_reachable.is_not(False), has_active_car,
+                       *slot_filter(slot))
+                .order_by(User.id)
+                .limit(MONTHLY_REPORTS_PAGE_SIZE)
+            )).all()
+            if not users:
+                break
+            last_id = users[-1].id
+            totals = await load_monthly_totals(db, [(report_year, report_month), prev_period], [u.id for u in users])
+
+        notifications = []
+        for user_id, telegram_id, is_premium in users:
+            text, options = monthly_report_message(report_year, report_month, totals.get(user_id, {}), is_premium, keyboard)
+            notifications.append((f"monthly:{report_year}-{report_month}:{user_id}", telegram_id, text, options))
+
+        async with AsyncSessionLocal() as db:
+            await outbox.add(db, notifications)
+            await db.commit()
+        outbox.wake()
+        total += len(notifications)
+    if total or slot is None:
+        logger.info(f"Ежемесячные отчёты за {report_month}.{report_year}: в очереди {total}")
+
+async def precompute_ai_advice():
+    """Ночью заранее готовит AI-советы для машин премиум-пользователей, чтобы днём они
+    отдавались из кеша. Запрашиваются только машины, для данных которых в кеше нет свежего совета."""
+    async with advisory_lock(AI_PRECOMPUTE_JOB) as acquired:
+        if not acquired:
+            return
+        logger.info("🤖 Ночной расчёт AI-советов...")
+        try:
+            semaphore = asyncio.Semaphore(config.AI_PRECOMPUTE_CONCURRENCY)
+            now = datetime.utcnow()
+            generated = failed = total = unchanged = 0
+
+            async def generate(fingerprint, car_data):
+                async with semaphore:
+                    try:
+                        return await generate_advice(car_data, fingerprint) is not None
+                    except Exception as e:
+                        logger.warning(f"Не удалось заранее получить AI-совет: {e}")
+                        return False
+
+            last_id = 0
+            while True:
+                async with AsyncSessionLocal() as db:
+                    cars = (await db.scalars(
+                        select(Car)
+                        .join(User, Car.user_id == User.id)
+                        .where(
+                            Car.id > last_id,
+                            Car.is_active == True,
+                            User.is_premium == True,
+                            or_(User.premium_until.is_(None), User.premium_until > now)
+                        )
+                        .order_by(Car.id)
+                        .limit(AI_PRECOMPUTE_PAGE_SIZE)
+                    )).all()
+                    if not cars:
+                        break
+                    last_id = cars[-1].id
+                    cars_data = await build_cars_data(db, cars)
+
+                total += len(cars)
+                # Одинаковые данные дают один запрос
+                pending = {car_fingerprint(car_data): car_data for car_data in cars_data.values()}
+                fresh = await advice_cache.fresh(pending.keys())
+                unchanged += len(fresh)
+                for fingerprint in fresh:
+                    del pending[fingerprint]
+                results = await asyncio.gather(*(generate(fp, data) for fp, data in pending.items()))
+                generated += sum(results)
+                failed += len(results) - sum(results)
+            logger.info(f"AI-советы: машин {total}, без изменений {unchanged}, получено новых {generated}, ошибок {failed}")
+        except Exception as e:
+            logger.exception(f"Ошибка в precompute_ai_advice: {e}")
@@ -3,12 +3,17 @@ from datetime import datetime
 from aiogram import Bot, Router
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from database import SessionLocal, User, Car
+from sqlalchemy import select, exists
+from database import AsyncSessionLocal, User, Car, BannedUser
 from config import config
+from services.outbox import outbox
+from services.sender import PRIORITY_BROADCAST
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+SEASONAL_PAGE_SIZE = 500
+
 # Словарь с сезонными напоминаниями: месяц-день -> текст
 SEASONAL_REMINDERS = {
     # Осень
@@ -38,18 +43,30 @@ async def send_seasonal_reminders(bot: Bot):
     text = SEASONAL_REMINDERS[key]
     logger.info(f"Отправка сезонного напоминания на {today.strftime('%d.%m')}")
     
-    with SessionLocal() as db:
-        users = db.query(User).all()
-        sent_count = 0
-        for user in users:
-            # Проверяем, есть ли у пользователя активные авто (чтобы не спамить тем, у кого нет машин)
-            cars = db.query(Car).filter(Car.user_id == user.id, Car.is_active == True).count()
-            if cars == 0:
-                continue
-            try:
-                await bot.send_message(user.telegram_id, text, parse_mode="Markdown")
-                sent_count += 1
-                logger.debug(f"Отправлено пользователю {user.telegram_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки пользователю {user.telegram_id}: {e}")
-        logger.info(f"Сезонные напоминания отправлены {sent_count} пользователям")
+    # Только пользователям с активными авто (чтобы не спамить тем, у кого нет машин).
+    # Получатели читаются страницами по id и ставятся в outbox: доставка идёт с общим лимитом,
+    # а ключ с датой не даёт отправить напоминание дважды при повторном запуске
+    has_active_car = exists().where(Car.user_id == User.id, Car.is_active == True)
+    not_banned = ~exists().where(BannedUser.telegram_id == User.telegram_id)
+    last_id = 0
+    total = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            users = (await db.execute(
+                select(User.id, User.telegram_id)
+                .where(User.id > last_id, User.telegram_id.is_not(None), User.is_reachable.is_not(False),
+                       has_active_car, not_banned)
+                .order_by(User.id)
+                .limit(SEASONAL_PAGE_SIZE)
+            )).all()
+            if not users:
+                break
+            last_id = users[-1].id
+            await outbox.add(db, [
+                (f"seasonal:{today:%Y-%m-%d}:{user_id}", telegram_id, text, {"parse_mode": "Markdown"})
+                for user_id, telegram_id in users
+            ], PRIORITY_BROADCAST)
+            await db.commit()
+        outbox.wake()
+        total += len(users)
+    logger.info(f"Сезонные напоминания поставлены в очередь: {total}")
@@ -1,7 +1,9 @@
 from aiogram import Router, types, F
 from aiogram.filters import Command
+from sqlalchemy import select
 from keyboards.main_menu import get_main_menu
-from database import SessionLocal, User
+from database import AsyncSessionLocal, User
+from services.identity import identity_cache, set_reachable
 import logging
 
 logger = logging.getLogger(__name__)
@@ -9,8 +11,8 @@ router = Router()
 
 @router.message(Command("start"))
 async def cmd_start(message: types.Message):
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == message.from_user.id))
         if not user:
             user = User(
                 telegram_id=message.from_user.id,
@@ -19,9 +21,11 @@ async def cmd_start(message: types.Message):
                 last_name=message.from_user.last_name
             )
             db.add(user)
-            db.commit()
-            db.refresh(user)
+            await db.commit()
+            await db.refresh(user)
             logger.info(f"Новый пользователь зарегистрирован: {message.from_user.id}")
+    # /start сбрасывает запись в кеше: она могла устареть после изменений на другой реплике
+    identity_cache.invalidate(message.from_user.id)
 
     await message.answer(
         "🚗 *Добро пожаловать в CarWise Bot – ваш персональный авто-помощник!*\n\n"
@@ -63,3 +67,8 @@ async def cmd_help(message: types.Message):
         "© 2026 CarWise Bot. Все права защищены. Не для коммерческого использования."
     )
     await message.answer(help_text, parse_mode="Markdown", reply_markup=get_main_menu())
+
+@router.my_chat_member(F.chat.type == "private")
+async def bot_blocked_or_unblocked(event: types.ChatMemberUpdated):
+    """Telegram сообщает о блокировке бота пользователем — исключаем его из рассылок сразу."""
+    await set_reachable([event.from_user.id], event.new_chat_member.status != "kicked")
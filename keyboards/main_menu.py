@@ -1,12 +1,13 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select
 from config import config
-from database import SessionLocal, Admin
+from database import AsyncSessionLocal, Admin
 
-def is_admin(user_id: int) -> bool:
+async def is_admin(user_id: int) -> bool:
     if user_id in config.ADMIN_IDS:
         return True
-    with SessionLocal() as db:
-        admin = db.query(Admin).filter(Admin.telegram_id == user_id).first()
+    async with AsyncSessionLocal() as db:
+        admin = await db.scalar(select(Admin).where(Admin.telegram_id == user_id))
         return admin is not None
 
 def get_main_menu():
@@ -79,7 +80,7 @@ def get_stats_submenu():
         resize_keyboard=True
     )
 
-def get_more_submenu(user_id: int = None):
+def get_more_submenu(show_admin: bool = False):
     buttons = [
         [KeyboardButton(text="📸 Все чеки")],
         [KeyboardButton(text="💎 Купить Premium")],
@@ -87,7 +88,7 @@ def get_more_submenu(user_id: int = None):
         [KeyboardButton(text="✉️ Связаться с админом")],
         [KeyboardButton(text="◀️ Назад")]
     ]
-    if user_id and is_admin(user_id):
+    if show_admin:
         buttons.insert(0, [KeyboardButton(text="👑 Админ-панель")])
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
@@ -3,15 +3,23 @@ import logging
 import logging.handlers
 import os
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timedelta
-from sqlalchemy import and_
+from sqlalchemy import select, and_
 from sqlalchemy.orm import selectinload
 
 from config import config
-from database import SessionLocal, init_db, Insurance, Car, User, Part, Admin, BannedUser
+from database import AsyncSessionLocal, async_engine, init_db_async, Insurance, Car, User, Part, Admin, BannedUser
+from services.jobs import job_queue
+from services.bans import ban_list
+from services.fsm_storage import make_storage
+from services.webhook import run_webhook
+from services.sender import sender
+from services.outbox import outbox
+from services.scheduler import create_scheduler
+from services.gigachat import gigachat
+from middlewares.ban import BanMiddleware
+from middlewares.identity import IdentityMiddleware
 
 # Импорты всех роутеров
 from handlers.start import router as start_router
@@ -34,12 +42,7 @@ from handlers.payment import router as payment_router
 from handlers.admin import router as admin_router
 
 # Импорт функций планировщика из отдельного модуля
-from handlers.scheduler_functions import (
-    check_insurances,
-    check_maintenance_reminders,
-    check_parts_reminders,
-    send_monthly_reports
-)
+from handlers.scheduler_functions import reminders_tick, precompute_ai_advice
 
 # ------------------- Настройка логирования -------------------
 log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -68,7 +71,7 @@ async def main():
         return
 
     try:
-        init_db()
+        await init_db_async()
         logger.info("✅ База данных инициализирована")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
@@ -76,13 +79,13 @@ async def main():
 
     # Синхронизация администраторов
     try:
-        with SessionLocal() as db:
+        async with AsyncSessionLocal() as db:
             for aid in config.ADMIN_IDS:
-                admin = db.query(Admin).filter(Admin.telegram_id == aid).first()
+                admin = await db.scalar(select(Admin).where(Admin.telegram_id == aid))
                 if not admin:
                     new_admin = Admin(telegram_id=aid, added_by=0)
                     db.add(new_admin)
-            db.commit()
+            await db.commit()
             logger.info(f"Синхронизировано {len(config.ADMIN_IDS)} администраторов")
     except Exception as e:
         logger.error(f"Ошибка синхронизации администраторов: {e}")
@@ -91,10 +94,18 @@ async def main():
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode='Markdown')
     )
+    # Все исходящие сообщения проходят через общий лимитер
+    bot.session.middleware(sender)
     
-    storage = MemoryStorage()
+    # Диалоги хранятся вне процесса и переживают перезапуск
+    storage = make_storage()
     dp = Dispatcher(storage=storage)
 
+    # Апдейты заблокированных пользователей отсекаются до роутеров
+    await ban_list.start()
+    dp.update.outer_middleware(BanMiddleware())
+    dp.update.outer_middleware(IdentityMiddleware())
+
     # Подключаем роутеры
     dp.include_router(navigation_router)
     dp.include_router(start_router)
@@ -115,22 +126,40 @@ async def main():
     dp.include_router(payment_router)
     dp.include_router(admin_router)
 
-    # Удаляем вебхук (если был установлен ранее)
-    await bot.delete_webhook(drop_pending_updates=True)
-    
     # Настройка планировщика
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_insurances, 'cron', hour=10, minute=0, args=(bot,))
-    scheduler.add_job(check_maintenance_reminders, 'cron', hour=9, minute=0, args=(bot,))
-    scheduler.add_job(check_parts_reminders, 'cron', hour=8, minute=0, args=(bot,))
-    scheduler.add_job(send_monthly_reports, 'cron', hour=10, minute=0, args=(bot,))
+    # Планировщик работает в каждой реплике; задача сама берёт блокировку, поэтому слот отрабатывает одна
+    scheduler = create_scheduler()
+    # Напоминания и ежемесячные отчёты (1-го числа) рассылаются по слотам в местное время пользователей
+    scheduler.add_job(reminders_tick, 'cron', minute=f"*/{config.REMINDER_SLOT_MINUTES}",
+                      id="reminders_tick", replace_existing=True)
+    # AI-советы для премиум-пользователей считаются заранее, в часы наименьшей нагрузки
+    scheduler.add_job(precompute_ai_advice, 'cron', hour=config.AI_PRECOMPUTE_HOUR, minute=30,
+                      id="ai_precompute", replace_existing=True)
     scheduler.start()
     logger.info("⏰ Планировщик напоминаний запущен")
 
+    # Воркеры фоновых задач (экспорт, AI-советы, сравнения)
+    await job_queue.start(bot)
+    # Доставка уведомлений, которые ставит в очередь планировщик
+    await outbox.start(bot)
+
     logger.info("🚀 CarWise Bot запущен на Railway!")
     
-    # Запуск polling
-    await dp.start_polling(bot)
+    try:
+        if config.BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Удаляем вебхук (если был установлен ранее)
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        scheduler.shutdown(wait=False)
+        await job_queue.stop()
+        await outbox.stop()
+        await ban_list.stop()
+        await storage.close()
+        await gigachat.close()
+        await async_engine.dispose()
 
 if __name__ == "__main__":
     try:
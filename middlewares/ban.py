@@ -0,0 +1,25 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import config
+from services.bans import ban_list
+
+logger = logging.getLogger(__name__)
+
+class BanMiddleware(BaseMiddleware):
+    """Отбрасывает апдейты заблокированных пользователей до того, как они дойдут до хендлеров."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user and user.id in ban_list and user.id not in config.ADMIN_IDS:
+            logger.debug(f"Апдейт от заблокированного пользователя {user.id} пропущен")
+            return None
+        return await handler(event, data)
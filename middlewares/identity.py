@@ -0,0 +1,27 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from services.identity import identity_cache, set_reachable
+
+class IdentityMiddleware(BaseMiddleware):
+    """Кладёт в данные хендлера identity — закешированную запись о пользователе и его машинах.
+
+    Заодно возвращает в рассылки пользователя, который был отмечен недоступным.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        identity = await identity_cache.get(user.id) if user else None
+        if identity is not None and not identity.is_reachable:
+            # Пользователь написал боту — значит, снова получает сообщения
+            await set_reachable([user.id], True)
+            identity = await identity_cache.get(user.id)
+        data["identity"] = identity
+        return await handler(event, data)
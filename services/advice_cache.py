@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import config
+from database import AsyncSessionLocal, AdviceCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять просроченные советы
+CLEANUP_INTERVAL = 3600
+
+def normalize_car_data(value):
+    """Сводка по машине в каноническом виде: строки без лишних пробелов и в одном регистре, вложенные списки и словари тоже."""
+    if isinstance(value, dict):
+        return {key: normalize_car_data(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_car_data(item) for item in value]
+    if isinstance(value, str):
+        return " ".join(value.split()).lower()
+    return value
+
+def advice_fingerprint(car_data: dict, model: str, prompt_version: int) -> str:
+    """Ключ кеша: одинаковые данные машины при той же модели и версии промпта дают тот же совет."""
+    payload = json.dumps(
+        {"car": normalize_car_data(car_data), "model": model, "prompt": prompt_version},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class AdviceCache:
+    """Кеш ответов GigaChat в таблице ai_advice_cache, общий для всех реплик.
+
+    Запрос к модели идёт 5–20 секунд и тарифицируется, поэтому совет по неизменившимся
+    данным машины берётся из кеша, пока не истечёт ttl.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._last_cleanup = 0.0
+
+    async def get(self, fingerprint: str) -> str | None:
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(select(AdviceCacheEntry.advice).where(
+                AdviceCacheEntry.fingerprint == fingerprint,
+                AdviceCacheEntry.expires_at > datetime.utcnow(),
+            ))
+
+    async def fresh(self, fingerprints) -> set[str]:
+        """Какие из отпечатков уже есть в кеше и не истекли."""
+        if not fingerprints:
+            return set()
+        async with AsyncSessionLocal() as db:
+            return set((await db.scalars(select(AdviceCacheEntry.fingerprint).where(
+                AdviceCacheEntry.fingerprint.in_(list(fingerprints)),
+                AdviceCacheEntry.expires_at > datetime.utcnow(),
+            ))).all())
+
+    async def put(self, fingerprint: str, advice: str, model: str):
+        now = datetime.utcnow()
+        row = {"fingerprint": fingerprint, "advice": advice, "model": model,
+               "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}
+        async with AsyncSessionLocal() as db:
+            dialect = db.bind.dialect.name
+            if dialect in ("postgresql", "sqlite"):
+                insert = pg_insert if dialect == "postgresql" else sqlite_insert
+                stmt = insert(AdviceCacheEntry).values(**row)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["fingerprint"],
+                    set_={c: stmt.excluded[c] for c in ("advice", "model", "created_at", "expires_at")},
+                )
+                await db.execute(stmt)
+            else:
+                result = await db.execute(
+                    update(AdviceCacheEntry).where(AdviceCacheEntry.fingerprint == fingerprint).values(**row)
+                )
+                if result.rowcount == 0:
+                    db.add(AdviceCacheEntry(**row))
+            if time.monotonic() - self._last_cleanup > CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                await db.execute(delete(AdviceCacheEntry).where(AdviceCacheEntry.expires_at < now))
+            await db.commit()
+
+advice_cache = AdviceCache(config.AI_ADVICE_CACHE_TTL)
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+from sqlalchemy import select
+
+from config import config
+from database import AsyncSessionLocal, BannedUser
+
+logger = logging.getLogger(__name__)
+
+class BanList:
+    """Telegram ID заблокированных пользователей в памяти процесса.
+
+    Загружается при старте и перечитывается из таблицы banned_users каждые refresh секунд,
+    поэтому бан, выданный на другой реплике, вступает в силу с задержкой не больше refresh.
+    toggle_ban меняет локальный список сразу.
+    """
+
+    def __init__(self, refresh: float):
+        self.refresh = refresh
+        self.ids = set()
+        self._task = None
+
+    async def load(self):
+        async with AsyncSessionLocal() as db:
+            self.ids = set((await db.scalars(select(BannedUser.telegram_id))).all())
+
+    async def start(self):
+        await self.load()
+        logger.info(f"Загружено заблокированных пользователей: {len(self.ids)}")
+        self._task = asyncio.create_task(self._reload())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _reload(self):
+        while True:
+            await asyncio.sleep(self.refresh)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.warning(f"Не удалось обновить список заблокированных: {e}")
+
+    def add(self, telegram_id: int):
+        self.ids.add(telegram_id)
+
+    def remove(self, telegram_id: int):
+        self.ids.discard(telegram_id)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self.ids
+
+ban_list = BanList(config.BAN_LIST_REFRESH)
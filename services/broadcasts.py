@@ -0,0 +1,130 @@
+import logging
+import time
+from datetime import datetime
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select, update, func
+
+from config import config
+from database import AsyncSessionLocal, User, BroadcastCampaign, BroadcastDelivery
+from services.bans import ban_list
+from services.sender import sender, PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+# Недоступные (заблокировавшие бота) пользователи в рассылку не попадают
+RECIPIENT_FILTER = (User.telegram_id.is_not(None), User.is_reachable.is_not(False))
+
+# Как часто обновлять сообщение с прогрессом, секунд
+PROGRESS_INTERVAL = 5
+
+def render_progress(campaign: BroadcastCampaign) -> str:
+    processed = campaign.sent + campaign.failed + campaign.skipped
+    percent = min(100, processed * 100 // campaign.total) if campaign.total else 100
+    status = {"running": "⏳ Идёт", "done": "✅ Завершена", "cancelled": "⏹ Остановлена",
+              "failed": "❌ Прервана из-за ошибки"}.get(campaign.status, campaign.status)
+    return (
+        f"📢 Рассылка #{campaign.id}: {status}\n"
+        f"Обработано: {processed} из {campaign.total} ({percent}%)\n"
+        f"Успешно: {campaign.sent}\nОшибок: {campaign.failed}\nПропущено (бан): {campaign.skipped}"
+    )
+
+def progress_keyboard(campaign: BroadcastCampaign):
+    if campaign.status != "running":
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"broadcast_stop_{campaign.id}")]
+    ])
+
+async def create_campaign(text: str, created_by: int) -> BroadcastCampaign:
+    async with AsyncSessionLocal() as db:
+        total = await db.scalar(select(func.count()).select_from(User).where(*RECIPIENT_FILTER))
+        campaign = BroadcastCampaign(text=text, created_by=created_by, total=total)
+        db.add(campaign)
+        await db.commit()
+    logger.info(f"Создана рассылка #{campaign.id} на {total} получателей")
+    return campaign
+
+async def cancel_campaign(campaign_id: int, status: str = "cancelled") -> bool:
+    """Останавливает идущую рассылку; status="failed" — когда её задача завершилась ошибкой."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(BroadcastCampaign)
+            .where(BroadcastCampaign.id == campaign_id, BroadcastCampaign.status == "running")
+            .values(status=status, finished_at=datetime.utcnow())
+        )
+        await db.commit()
+    return result.rowcount == 1
+
+async def run_campaign(bot, campaign_id: int, progress):
+    """Рассылает кампанию страницами по User.id, начиная с сохранённого курсора.
+
+    После каждой страницы в одной транзакции пишутся статусы получателей, счётчики и курсор,
+    поэтому после перезапуска рассылка продолжается с места остановки; повторно может
+    уйти не больше одной страницы. progress(text, **kwargs) обновляет сообщение администратору.
+    """
+    last_progress = 0.0
+    while True:
+        async with AsyncSessionLocal() as db:
+            campaign = await db.get(BroadcastCampaign, campaign_id)
+            if campaign is None or campaign.status != "running":
+                break
+            recipients = (await db.execute(
+                select(User.id, User.telegram_id)
+                .where(User.id > campaign.last_user_id, *RECIPIENT_FILTER)
+                .order_by(User.id)
+                .limit(config.BROADCAST_PAGE_SIZE)
+            )).all()
+        if not recipients:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(BroadcastCampaign)
+                    .where(BroadcastCampaign.id == campaign_id, BroadcastCampaign.status == "running")
+                    .values(status="done", finished_at=datetime.utcnow())
+                )
+                await db.commit()
+            break
+
+        notifications = [
+            (user_id, telegram_id, campaign.text, {"parse_mode": "Markdown"})
+            for user_id, telegram_id in recipients if telegram_id not in ban_list
+        ]
+        delivered = set(await sender.send_many(bot, notifications, PRIORITY_BROADCAST))
+        statuses = {
+            user_id: "skipped" if telegram_id in ban_list else "sent" if user_id in delivered else "failed"
+            for user_id, telegram_id in recipients
+        }
+        counts = {name: sum(1 for s in statuses.values() if s == name) for name in ("sent", "failed", "skipped")}
+
+        async with AsyncSessionLocal() as db:
+            db.add_all(BroadcastDelivery(campaign_id=campaign_id, user_id=user_id, status=status)
+                       for user_id, status in statuses.items())
+            await db.execute(
+                update(BroadcastCampaign)
+                .where(BroadcastCampaign.id == campaign_id)
+                .values(
+                    last_user_id=recipients[-1].id,
+                    sent=BroadcastCampaign.sent + counts["sent"],
+                    failed=BroadcastCampaign.failed + counts["failed"],
+                    skipped=BroadcastCampaign.skipped + counts["skipped"],
+                )
+            )
+            await db.commit()
+
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            async with AsyncSessionLocal() as db:
+                campaign = await db.get(BroadcastCampaign, campaign_id)
+            await progress(render_progress(campaign), reply_markup=progress_keyboard(campaign))
+
+    async with AsyncSessionLocal() as db:
+        campaign = await db.get(BroadcastCampaign, campaign_id)
+    if campaign is not None:
+        logger.info(f"Рассылка #{campaign.id}: {campaign.status}, успешно {campaign.sent}, ошибок {campaign.failed}")
+        await progress(render_progress(campaign))
+
+async def recent_campaigns(limit: int = 5):
+    async with AsyncSessionLocal() as db:
+        return (await db.scalars(
+            select(BroadcastCampaign).order_by(BroadcastCampaign.id.desc()).limit(limit)
+        )).all()
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import config
+from database import AsyncSessionLocal, FsmRecord
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять брошенные диалоги из таблицы
+CLEANUP_INTERVAL = 3600
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Нельзя сохранить в FSM значение типа {type(value).__name__}")
+
+def _object_hook(value):
+    if len(value) == 1 and "$dt" in value:
+        return datetime.fromisoformat(value["$dt"])
+    return value
+
+def dumps_data(data: Dict[str, Any]) -> str:
+    """Компактный JSON без пробелов; datetime сохраняется как {"$dt": iso}."""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+def loads_data(raw: str | None) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_object_hook) if raw else {}
+
+class DatabaseStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states, общее для всех процессов бота.
+
+    Записи не идут в БД по одной: изменения копятся в буфере и раз в flush_interval
+    (или при накоплении batch_size ключей) пишутся одной транзакцией. Чтение сначала
+    смотрит в буфер, поэтому процесс всегда видит свои последние изменения.
+    Диалоги, не менявшиеся дольше ttl, считаются брошенными и удаляются.
+    """
+
+    def __init__(self, ttl: int, flush_interval: float, batch_size: int):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending = {}
+        # Пачка, которая сейчас пишется в БД: до коммита читатели берут значения из неё
+        self._inflight = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self._last_cleanup = 0.0
+
+    def _put(self, key: StorageKey, field: str, value):
+        self._pending.setdefault(self.key_builder.build(key), {})[field] = value
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _buffered(self, key: str, field: str):
+        """Значение поля из буфера (ещё не записанное в БД) или KeyError."""
+        for buffer in (self._pending, self._inflight):
+            fields = buffer.get(key, {})
+            if field in fields:
+                return fields[field]
+        raise KeyError(field)
+
+    async def _load(self, key: str) -> Optional[FsmRecord]:
+        async with AsyncSessionLocal() as db:
+            record = await db.scalar(select(FsmRecord).where(FsmRecord.key == key))
+        if record is None or record.updated_at < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return None
+        return record
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        self._put(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        try:
+            return self._buffered(self.key_builder.build(key), "state")
+        except KeyError:
+            pass
+        record = await self._load(self.key_builder.build(key))
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._put(key, "data", dumps_data(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        try:
+            return loads_data(self._buffered(self.key_builder.build(key), "data"))
+        except KeyError:
+            pass
+        record = await self._load(self.key_builder.build(key))
+        return loads_data(record.data) if record else {}
+
+    async def flush(self):
+        """Пишет накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            now = datetime.utcnow()
+            # Одинаковый набор полей — один executemany
+            groups = {}
+            for key, fields in batch.items():
+                groups.setdefault(tuple(sorted(fields)), []).append({"key": key, "updated_at": now, **fields})
+            try:
+                async with AsyncSessionLocal() as db:
+                    for fields, rows in groups.items():
+                        await self._upsert(db, fields, rows)
+                    await db.commit()
+            except Exception as e:
+                logger.exception(f"Не удалось сохранить состояния FSM: {e}")
+                # Возвращаем в буфер то, что не было перезаписано за время сбоя
+                for key, fields in batch.items():
+                    self._pending[key] = {**fields, **self._pending.get(key, {})}
+            finally:
+                self._inflight = {}
+
+    async def _upsert(self, db, fields, rows):
+        columns = fields + ("updated_at",)
+        dialect = db.bind.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            insert = pg_insert if dialect == "postgresql" else sqlite_insert
+            stmt = insert(FsmRecord)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["key"], set_={column: stmt.excluded[column] for column in columns}
+            )
+            await db.execute(stmt, rows)
+            return
+        for row in rows:
+            result = await db.execute(
+                update(FsmRecord).where(FsmRecord.key == row["key"]).values({c: row[c] for c in columns})
+            )
+            if result.rowcount == 0:
+                db.add(FsmRecord(**row))
+
+    async def cleanup(self):
+        """Удаляет брошенные диалоги и пустые записи."""
+        expired_at = datetime.utcnow() - timedelta(seconds=self.ttl)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(FsmRecord).where(
+                (FsmRecord.updated_at < expired_at) | (FsmRecord.state.is_(None) & FsmRecord.data.is_(None))
+            ))
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"Удалено устаревших состояний FSM: {result.rowcount}")
+
+    async def _flush_loop(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if time.monotonic() - self._last_cleanup > CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                try:
+                    await self.cleanup()
+                except Exception as e:
+                    logger.warning(f"Не удалось очистить устаревшие состояния FSM: {e}")
+
+    async def close(self) -> None:
+        # Цикл не отменяется, а останавливается после текущей записи, чтобы не потерять пачку
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+
+def make_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE."""
+    if config.FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if config.FSM_STORAGE == "redis" and config.REDIS_URL:
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+            return RedisStorage.from_url(
+                config.REDIS_URL,
+                key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+                state_ttl=config.FSM_STATE_TTL,
+                data_ttl=config.FSM_STATE_TTL,
+                json_dumps=dumps_data,
+                json_loads=loads_data,
+            )
+        except ImportError:
+            logger.warning("FSM_STORAGE=redis, но пакет redis не установлен — состояния хранятся в БД")
+    return DatabaseStorage(config.FSM_STATE_TTL, config.FSM_FLUSH_INTERVAL, config.FSM_FLUSH_BATCH)
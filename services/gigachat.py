@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+import uuid
+
+import httpx
+from openai import AsyncOpenAI
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+GIGACHAT_API_URL = "https://gigachat.devices.sberbank.ru/api/v1"
+TOKEN_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+
+# Токен обновляется заранее, если до истечения осталось меньше REFRESH_MARGIN секунд,
+# и считается непригодным за EXPIRY_MARGIN секунд до истечения
+REFRESH_MARGIN = 300
+EXPIRY_MARGIN = 60
+
+class GigaChatAuthError(Exception):
+    """Не удалось получить access token GigaChat."""
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+class GigaChatClient:
+    """Общий клиент GigaChat для всех запросов бота.
+
+    Один httpx-пул с keep-alive (и HTTP/2, если установлен пакет h2) живёт всё время работы,
+    поэтому TLS-рукопожатие и OAuth-запрос не повторяются на каждый совет. Токен обновляет
+    одна задача, остальные запросы её ждут; незадолго до истечения он обновляется в фоне,
+    не задерживая запросы. Число одновременных запросов к API ограничено concurrency.
+    """
+
+    def __init__(self, auth_key: str, concurrency: int, timeout: float):
+        self.auth_key = auth_key
+        self.semaphore = asyncio.Semaphore(concurrency)
+        http2 = _http2_available()
+        if not http2:
+            logger.info("Пакет h2 не установлен — GigaChat работает по HTTP/1.1")
+        self.http = httpx.AsyncClient(
+            verify=False,
+            http2=http2,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency + 2, max_keepalive_connections=concurrency + 2),
+        )
+        self.openai = AsyncOpenAI(base_url=GIGACHAT_API_URL, api_key="-", http_client=self.http, max_retries=1)
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh = None
+
+    async def _fetch_token(self) -> str:
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "RqUID": str(uuid.uuid4()),
+            "Authorization": f"Basic {self.auth_key}"
+        }
+        response = await self.http.post(TOKEN_URL, headers=headers, data={"scope": "GIGACHAT_API_PERS"})
+        if response.status_code != 200:
+            raise GigaChatAuthError(f"{response.status_code} - {response.text}")
+        data = response.json()
+        # GigaChat отдаёт expires_at в миллисекундах; expires_in — на случай другого формата
+        if data.get("expires_at"):
+            self._expires_at = data["expires_at"] / 1000
+        else:
+            self._expires_at = time.time() + data.get("expires_in", 1800)
+        self._token = data["access_token"]
+        logger.info("GigaChat access token получен успешно")
+        return self._token
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._fetch_token())
+            self._refresh.add_done_callback(self._refresh_done)
+        return self._refresh
+
+    @staticmethod
+    def _refresh_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Ошибка получения токена GigaChat: {task.exception()}")
+
+    async def token(self) -> str:
+        if not self.auth_key:
+            raise GigaChatAuthError("GIGACHAT_AUTH_KEY не задан")
+        left = self._expires_at - time.time()
+        if self._token and left > REFRESH_MARGIN:
+            return self._token
+        if self._token and left > EXPIRY_MARGIN:
+            self._start_refresh()
+            return self._token
+        # shield: отмена одного ожидающего запроса не прерывает общее обновление токена
+        return await asyncio.shield(self._start_refresh())
+
+    async def chat(self, messages: list[dict], **params):
+        """chat.completions.create с актуальным токеном и ограничением параллельных запросов."""
+        async with self.semaphore:
+            client = self.openai.with_options(api_key=await self.token())
+            return await client.chat.completions.create(model=config.GIGACHAT_MODEL, messages=messages, **params)
+
+    async def stream(self, messages: list[dict], **params):
+        """Потоковый ответ (stream=True): отдаёт фрагменты текста по мере генерации."""
+        async with self.semaphore:
+            client = self.openai.with_options(api_key=await self.token())
+            stream = await client.chat.completions.create(
+                model=config.GIGACHAT_MODEL, messages=messages, stream=True, **params
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def close(self):
+        if self._refresh and not self._refresh.done():
+            self._refresh.cancel()
+        await self.http.aclose()
+
+gigachat = GigaChatClient(config.GIGACHAT_AUTH_KEY, config.GIGACHAT_CONCURRENCY, config.GIGACHAT_TIMEOUT)
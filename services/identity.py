@@ -0,0 +1,101 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import select, update, and_
+
+from config import config
+from database import AsyncSessionLocal, User, Car
+
+logger = logging.getLogger(__name__)
+
+class IdentityCar(NamedTuple):
+    id: int
+    brand: str
+    model: str
+    year: int
+
+@dataclass(frozen=True)
+class Identity:
+    """Лёгкая запись о пользователе, которую хендлеры получают вместо запросов User и Car."""
+    user_id: int
+    telegram_id: int
+    is_premium: bool
+    premium_until: datetime | None
+    cars: tuple
+    is_reachable: bool = True
+
+    @property
+    def car_ids(self):
+        return [car.id for car in self.cars]
+
+class IdentityCache:
+    """LRU-кеш Identity по telegram_id с временем жизни записей.
+
+    Кеш живёт в памяти процесса: сбрасывается при /start, добавлении и удалении машины,
+    оплате и смене премиума администратором, в остальных случаях — по TTL. Сброс виден
+    только своей реплике, поэтому TTL короткий: изменение, сделанное на другой реплике,
+    становится видно не позже чем через ttl секунд. Незарегистрированные пользователи
+    не кешируются, чтобы сразу после /start их запись подхватилась любой репликой.
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    async def get(self, telegram_id: int) -> Identity | None:
+        item = self._data.get(telegram_id)
+        if item is not None and item[0] >= time.monotonic():
+            self._data.move_to_end(telegram_id)
+            return item[1]
+        identity = await self.load(telegram_id)
+        if identity is None:
+            self._data.pop(telegram_id, None)
+            return None
+        self._data[telegram_id] = (time.monotonic() + self.ttl, identity)
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+        return identity
+
+    async def load(self, telegram_id: int) -> Identity | None:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(User.id, User.is_premium, User.premium_until, User.is_reachable,
+                       Car.id, Car.brand, Car.model, Car.year)
+                .outerjoin(Car, and_(Car.user_id == User.id, Car.is_active == True))
+                .where(User.telegram_id == telegram_id)
+                .order_by(Car.id)
+            )).all()
+        if not rows:
+            return None
+        user_id, is_premium, premium_until, is_reachable = rows[0][:4]
+        cars = tuple(IdentityCar(*row[4:]) for row in rows if row[4] is not None)
+        return Identity(user_id, telegram_id, bool(is_premium), premium_until, cars, is_reachable is not False)
+
+    def invalidate(self, telegram_id: int):
+        self._data.pop(telegram_id, None)
+
+identity_cache = IdentityCache(config.IDENTITY_CACHE_SIZE, config.IDENTITY_CACHE_TTL)
+
+async def set_reachable(telegram_ids, reachable: bool):
+    """Отмечает пользователей доступными или недоступными (заблокировали бота)."""
+    if not telegram_ids:
+        return
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(User)
+            .where(User.telegram_id.in_(telegram_ids))
+            .values(is_reachable=reachable, unreachable_since=None if reachable else datetime.utcnow())
+        )
+        await db.commit()
+    for telegram_id in telegram_ids:
+        identity_cache.invalidate(telegram_id)
+    if reachable:
+        logger.info(f"Пользователь снова доступен: {', '.join(map(str, telegram_ids))}")
+    else:
+        logger.info(f"Отмечено недоступных пользователей: {len(telegram_ids)}")
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func, or_, true
+from sqlalchemy.exc import IntegrityError
+
+from config import config
+from database import AsyncSessionLocal, Job
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: чем больше, тем раньше задача берётся воркером
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 1
+
+# Сколько хранить завершённые задачи
+JOBS_KEEP_DAYS = 7
+
+FAILED_TEXT = "❌ Не удалось выполнить запрос. Попробуйте позже."
+
+class JobContext:
+    """То, что получает обработчик задачи: бот, чат, параметры и сообщение с прогрессом."""
+
+    def __init__(self, queue, bot, job):
+        self.queue = queue
+        self.bot = bot
+        self.job_id = job.id
+        self.chat_id = job.chat_id
+        self.message_id = job.message_id
+        self.payload = json.loads(job.payload) if job.payload else {}
+
+    async def progress(self, text: str, **kwargs):
+        """Обновляет сообщение с прогрессом на месте (или отправляет новое, если его нет)."""
+        try:
+            if self.message_id:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+            else:
+                msg = await self.bot.send_message(self.chat_id, text, **kwargs)
+                self.message_id = msg.message_id
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс задачи {self.job_id}: {e}")
+
+    async def delete_progress(self):
+        if not self.message_id:
+            return
+        try:
+            await self.bot.delete_message(self.chat_id, self.message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщение задачи {self.job_id}: {e}")
+        self.message_id = None
+
+    async def run_cpu(self, func, *args):
+        return await self.queue.run_cpu(func, *args)
+
+class JobQueue:
+    """Очередь фоновых задач в таблице jobs и пул воркеров, который её разбирает.
+
+    Обработчики регистрируются декоратором @job_queue.handler("kind") в модулях handlers/*,
+    сами апдейт-хендлеры только ставят задачу через enqueue и сразу возвращаются.
+    Задачи с user_limit=False (рассылки администратора) не учитываются в лимите задач пользователя
+    и не ждут его. @job_queue.on_failure("kind") регистрирует очистку после окончательной ошибки задачи:
+    исключения в обработчике или исчерпания попыток после падений воркера.
+    """
+
+    def __init__(self, workers: int, cpu_workers: int, per_user_limit: int, poll_interval: float,
+                 lease_seconds: int, max_attempts: int):
+        self.workers = workers
+        self.cpu_workers = cpu_workers
+        self.per_user_limit = per_user_limit
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.handlers = {}
+        self.failure_handlers = {}
+        self.unlimited_kinds = set()
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._cpu_pool = None
+
+    def handler(self, kind: str, user_limit: bool = True):
+        def decorator(func):
+            self.handlers[kind] = func
+            if not user_limit:
+                self.unlimited_kinds.add(kind)
+            return func
+        return decorator
+
+    def on_failure(self, kind: str):
+        def decorator(func):
+            self.failure_handlers[kind] = func
+            return func
+        return decorator
+
+    async def enqueue(self, bot, kind: str, chat_id: int, payload: dict | None = None,
+                      priority: int = PRIORITY_NORMAL, text: str = "⏳ Задача поставлена в очередь...") -> int | None:
+        """Ставит задачу в очередь. Возвращает id задачи или None, если такая же задача пользователя ещё не выполнена."""
+        busy_text = "⏳ Предыдущий запрос ещё выполняется, дождитесь результата."
+        async with AsyncSessionLocal() as db:
+            pending = await db.scalar(select(Job.id).where(
+                Job.chat_id == chat_id, Job.kind == kind, Job.status.in_(("queued", "running"))
+            ).limit(1))
+        if pending is not None:
+            await bot.send_message(chat_id, busy_text)
+            return None
+        # Сообщение отправляется без открытой сессии; от двойного нажатия защищает уникальный индекс
+        msg = await bot.send_message(chat_id, text)
+        job = Job(
+            kind=kind,
+            chat_id=chat_id,
+            payload=json.dumps(payload or {}, ensure_ascii=False),
+            priority=priority,
+            status="queued",
+            message_id=msg.message_id
+        )
+        try:
+            async with AsyncSessionLocal() as db:
+                db.add(job)
+                await db.commit()
+        except IntegrityError:
+            try:
+                await bot.edit_message_text(busy_text, chat_id=chat_id, message_id=msg.message_id)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить сообщение о задаче: {e}")
+            return None
+        self._wakeup.set()
+        return job.id
+
+    async def start(self, bot):
+        async with AsyncSessionLocal() as db:
+            # Задачи других реплик не трогаем: прерванные задачи возвращаются в очередь по истечении аренды
+            await db.execute(delete(Job).where(
+                Job.status.in_(("done", "failed")),
+                Job.finished_at < datetime.utcnow() - timedelta(days=JOBS_KEEP_DAYS)
+            ))
+            await db.commit()
+        self._tasks = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers)]
+        logger.info(f"Запущено воркеров фоновых задач: {self.workers}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._cpu_pool:
+            self._cpu_pool.shutdown(wait=False, cancel_futures=True)
+            self._cpu_pool = None
+
+    async def run_cpu(self, func, *args):
+        """Выполняет CPU-тяжёлую функцию в пуле процессов, не блокируя цикл событий."""
+        if self._cpu_pool is None:
+            self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_pool, func, *args)
+
+    async def _recover(self, db, now) -> list:
+        """Возвращает в очередь задачи с истёкшей арендой (воркер или процесс упал);
+        задачи, исчерпавшие попытки, помечаются failed и возвращаются для уведомления пользователя."""
+        expired = or_(Job.locked_until < now, Job.locked_until.is_(None))
+        exhausted = (await db.scalars(
+            select(Job).where(Job.status == "running", expired, Job.attempts >= self.max_attempts)
+        )).all()
+        failed = []
+        for job in exhausted:
+            # Условие на status и аренду: задачу могла уже обработать другая реплика
+            result = await db.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.status == "running", expired)
+                .values(status="failed", error="Превышено число попыток", finished_at=now, locked_until=None)
+            )
+            if result.rowcount == 1:
+                failed.append(job)
+        result = await db.execute(
+            update(Job).where(Job.status == "running", expired).values(status="queued", locked_until=None)
+        )
+        if result.rowcount:
+            logger.warning(f"Возвращено в очередь задач с истёкшей арендой: {result.rowcount}")
+        if failed:
+            logger.warning(f"Задачи исчерпали попытки и помечены failed: {', '.join(str(job.id) for job in failed)}")
+        return failed
+
+    async def _fail(self, ctx, kind: str):
+        """Сообщает пользователю об ошибке и вызывает очистку, зарегистрированную для типа задачи."""
+        await ctx.progress(FAILED_TEXT)
+        on_failure = self.failure_handlers.get(kind)
+        if on_failure is None:
+            return
+        try:
+            await on_failure(ctx)
+        except Exception as e:
+            logger.exception(f"Ошибка при очистке после задачи {ctx.job_id} ({kind}): {e}")
+
+    async def _claim(self, bot):
+        async with self._claim_lock, AsyncSessionLocal() as db:
+            now = datetime.utcnow()
+            failed = await self._recover(db, now)
+            await db.commit()
+        # Уведомления отправляются без блокировки и открытой сессии
+        for job in failed:
+            await self._fail(JobContext(self, bot, job), job.kind)
+        async with self._claim_lock, AsyncSessionLocal() as db:
+            now = datetime.utcnow()
+            limited = Job.kind.not_in(self.unlimited_kinds) if self.unlimited_kinds else true()
+            busy_chats = (
+                select(Job.chat_id)
+                .where(Job.status == "running", limited)
+                .group_by(Job.chat_id)
+                .having(func.count() >= self.per_user_limit)
+            )
+            candidates = (await db.scalars(
+                select(Job)
+                .where(Job.status == "queued", or_(~limited, Job.chat_id.not_in(busy_chats)))
+                .order_by(Job.priority.desc(), Job.id)
+                .limit(self.workers)
+            )).all()
+            for job in candidates:
+                # Условие на status защищает от захвата той же задачи другим процессом
+                result = await db.execute(
+                    update(Job)
+                    .where(Job.id == job.id, Job.status == "queued")
+                    .values(status="running", started_at=now, attempts=Job.attempts + 1,
+                            locked_until=now + timedelta(seconds=self.lease_seconds))
+                )
+                if result.rowcount == 1:
+                    await db.commit()
+                    return job
+            return None
+
+    async def _heartbeat(self, job_id: int):
+        """Продлевает аренду задачи, пока она выполняется."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.status == "running")
+                        .values(locked_until=datetime.utcnow() + timedelta(seconds=self.lease_seconds))
+                    )
+                    await db.commit()
+            except Exception as e:
+                logger.warning(f"Не удалось продлить аренду задачи {job_id}: {e}")
+
+    async def _worker(self, bot):
+        while True:
+            try:
+                job = await self._claim(bot)
+            except Exception as e:
+                logger.exception(f"Ошибка при получении задачи из очереди: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(bot, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Задача останется running и вернётся в очередь, когда истечёт аренда
+                logger.exception(f"Ошибка при завершении задачи {job.id}: {e}")
+
+    async def _run(self, bot, job):
+        ctx = JobContext(self, bot, job)
+        status, error = "done", None
+        heartbeat = asyncio.create_task(self._heartbeat(job.id))
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise RuntimeError(f"Нет обработчика для задачи типа {job.kind}")
+            await handler(ctx)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Ошибка в задаче {job.id} ({job.kind}): {e}")
+            status, error = "failed", str(e)[:500]
+            await self._fail(ctx, job.kind)
+        finally:
+            heartbeat.cancel()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Job).where(Job.id == job.id).values(
+                    status=status, error=error, finished_at=datetime.utcnow(), locked_until=None
+                )
+            )
+            await db.commit()
+        # Освободилось место в лимите пользователя — разбудим остальные воркеры
+        self._wakeup.set()
+
+job_queue = JobQueue(
+    config.JOB_WORKERS,
+    config.JOB_CPU_WORKERS,
+    config.JOB_USER_LIMIT,
+    config.JOB_POLL_INTERVAL,
+    config.JOB_LEASE_SECONDS,
+    config.JOB_MAX_ATTEMPTS,
+)
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import config
+from database import AsyncSessionLocal, OutboxMessage
+from services.bans import ban_list
+from services.identity import set_reachable
+from services.scheduler import advisory_lock
+from services.sender import outbound_priority, is_unreachable_error, PRIORITY_REMINDER
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщение может оставаться в статусе sending, прежде чем его заберёт другой воркер
+LEASE_SECONDS = 300
+# Сколько хранить доставленные и недоставленные уведомления и как часто их чистить
+OUTBOX_KEEP_DAYS = 7
+OUTBOX_DEAD_KEEP_DAYS = 30
+PURGE_INTERVAL = 3600
+# Доставкой занимается одна реплика — та, что держит эту блокировку; остальные проверяют её раз в LEADER_RETRY секунд
+OUTBOX_LOCK = "outbox"
+LEADER_RETRY = 30
+
+def dump_options(options: dict | None) -> str | None:
+    if not options:
+        return None
+    options = dict(options)
+    if "reply_markup" in options:
+        options["reply_markup"] = options["reply_markup"].model_dump(exclude_none=True)
+    return json.dumps(options, ensure_ascii=False)
+
+def load_options(raw: str | None) -> dict:
+    options = json.loads(raw) if raw else {}
+    if "reply_markup" in options:
+        options["reply_markup"] = InlineKeyboardMarkup.model_validate(options["reply_markup"])
+    return options
+
+class Outbox:
+    """Очередь исходящих уведомлений в таблице notification_outbox.
+
+    Задачи планировщика только находят, кому и что отправить, и записывают уведомления
+    через add() в той же транзакции, что и флаги notified_*. Доставкой занимается воркер:
+    повторяет временные ошибки с экспоненциальной задержкой, а сообщения, которые
+    доставить нельзя или не удалось за max_attempts попыток, помечает как dead.
+    """
+
+    def __init__(self, batch_size: int, max_attempts: int, retry_base: float, poll_interval: float, concurrency: int):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.poll_interval = poll_interval
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def add(self, db, notifications, priority: int = PRIORITY_REMINDER, requeue: bool = False):
+        """Записывает уведомления (dedup_key, chat_id, text[, параметры send_message]) в сессию db.
+        Уведомления с dedup_key, который уже есть в очереди, пропускаются. С requeue=True уже
+        доставленные или недоставленные (sent/dead) уведомления с тем же ключом ставятся заново:
+        так вызывающий, который выставляет флаги notified_* в той же транзакции, не теряет
+        повторно взведённое напоминание. Коммит остаётся за вызывающим."""
+        now = datetime.utcnow()
+        rows = [
+            {"dedup_key": n[0], "chat_id": n[1], "text": n[2], "options": dump_options(n[3] if len(n) > 3 else None),
+             "priority": priority, "status": "pending", "attempts": 0, "next_attempt_at": now}
+            for n in notifications
+        ]
+        if not rows:
+            return
+        # Без IN (...): раскрываемые параметры нельзя использовать в executemany
+        finished = or_(OutboxMessage.status == "sent", OutboxMessage.status == "dead")
+        dialect = db.bind.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            insert = pg_insert if dialect == "postgresql" else sqlite_insert
+            stmt = insert(OutboxMessage)
+            if requeue:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["dedup_key"],
+                    set_={"chat_id": stmt.excluded.chat_id, "text": stmt.excluded.text,
+                          "options": stmt.excluded.options, "priority": stmt.excluded.priority,
+                          "status": "pending", "attempts": 0, "next_attempt_at": now,
+                          "last_error": None, "created_at": now, "sent_at": None},
+                    where=finished,
+                )
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=["dedup_key"])
+            await db.execute(stmt, rows)
+            return
+        existing = {m.dedup_key: m for m in (await db.scalars(
+            select(OutboxMessage).where(OutboxMessage.dedup_key.in_([r["dedup_key"] for r in rows]))
+        )).all()}
+        for row in rows:
+            message = existing.get(row["dedup_key"])
+            if message is None:
+                db.add(OutboxMessage(**row))
+            elif requeue and message.status in ("sent", "dead"):
+                for field, value in row.items():
+                    setattr(message, field, value)
+                message.last_error, message.created_at, message.sent_at = None, now, None
+
+    async def purge(self):
+        """Удаляет доставленные уведомления старше OUTBOX_KEEP_DAYS и недоставленные старше OUTBOX_DEAD_KEEP_DAYS."""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(OutboxMessage).where(
+                ((OutboxMessage.status == "sent") & (OutboxMessage.sent_at < now - timedelta(days=OUTBOX_KEEP_DAYS)))
+                | ((OutboxMessage.status == "dead")
+                   & (OutboxMessage.created_at < now - timedelta(days=OUTBOX_DEAD_KEEP_DAYS)))
+            ))
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"Удалено старых уведомлений из outbox: {result.rowcount}")
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def start(self, bot):
+        self._task = asyncio.create_task(self._worker(bot))
+        logger.info("Воркер доставки уведомлений запущен")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _claim(self):
+        now = datetime.utcnow()
+        # Время окончания аренды с микросекундами служит меткой пачки этого воркера
+        lease_until = now + timedelta(seconds=LEASE_SECONDS)
+        async with AsyncSessionLocal() as db:
+            # Сообщения, зависшие у упавшего воркера, возвращаются в очередь
+            await db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.status == "sending", OutboxMessage.next_attempt_at < now)
+                .values(status="pending")
+            )
+            ids = (await db.scalars(
+                select(OutboxMessage.id)
+                .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+                .order_by(OutboxMessage.priority, OutboxMessage.id)
+                .limit(self.batch_size)
+            )).all()
+            if ids:
+                await db.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id.in_(ids), OutboxMessage.status == "pending")
+                    .values(status="sending", next_attempt_at=lease_until, attempts=OutboxMessage.attempts + 1)
+                )
+            await db.commit()
+            if not ids:
+                return []
+            return (await db.scalars(
+                select(OutboxMessage)
+                .where(OutboxMessage.id.in_(ids), OutboxMessage.status == "sending",
+                       OutboxMessage.next_attempt_at == lease_until)
+            )).all()
+
+    async def _deliver(self, bot, message):
+        """Возвращает (результат, ошибка): sent, retry, dead или unreachable."""
+        if message.chat_id in ban_list:
+            return "dead", "пользователь заблокирован администратором"
+        outbound_priority.set(message.priority)
+        try:
+            await bot.send_message(message.chat_id, message.text, **load_options(message.options))
+            return "sent", None
+        except Exception as e:
+            if is_unreachable_error(e):
+                return "unreachable", str(e)[:500]
+            if isinstance(e, TelegramBadRequest):
+                # Ошибка в самом сообщении: повтор не поможет
+                return "dead", str(e)[:500]
+            return "retry", str(e)[:500]
+
+    async def _process(self, bot, messages):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(message):
+            async with semaphore:
+                return await self._deliver(bot, message)
+
+        results = await asyncio.gather(*(deliver(m) for m in messages))
+        now = datetime.utcnow()
+        sent_ids, unreachable = [], []
+        async with AsyncSessionLocal() as db:
+            for message, (result, error) in zip(messages, results):
+                if result == "sent":
+                    sent_ids.append(message.id)
+                    continue
+                if result == "unreachable":
+                    unreachable.append(message.chat_id)
+                if result == "retry" and message.attempts < self.max_attempts:
+                    values = {"status": "pending", "last_error": error,
+                              "next_attempt_at": now + timedelta(seconds=self.retry_base * 2 ** (message.attempts - 1))}
+                else:
+                    logger.warning(f"Уведомление {message.dedup_key} не доставлено: {error}")
+                    values = {"status": "dead", "last_error": error}
+                await db.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(**values))
+            if sent_ids:
+                await db.execute(
+                    update(OutboxMessage).where(OutboxMessage.id.in_(sent_ids)).values(status="sent", sent_at=now)
+                )
+            await db.commit()
+        await set_reachable(unreachable, False)
+        logger.info(f"Доставлено уведомлений: {len(sent_ids)} из {len(messages)}")
+
+    async def _worker(self, bot):
+        # Лимит отправки действует в пределах процесса, поэтому доставка идёт только из одной реплики
+        while True:
+            try:
+                async with advisory_lock(OUTBOX_LOCK) as leader:
+                    if leader:
+                        logger.info("Доставку уведомлений выполняет эта реплика")
+                        await self._deliver_loop(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка блокировки доставки уведомлений: {e}")
+            await asyncio.sleep(LEADER_RETRY)
+
+    async def _deliver_loop(self, bot):
+        # Очистку выполняет та же реплика, что и доставку: сразу после захвата блокировки и затем раз в PURGE_INTERVAL
+        next_purge = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if loop.time() >= next_purge:
+                    next_purge = loop.time() + PURGE_INTERVAL
+                    await self.purge()
+                messages = await self._claim()
+                if messages:
+                    await self._process(bot, messages)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка воркера доставки уведомлений: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+outbox = Outbox(
+    config.OUTBOX_BATCH_SIZE,
+    config.OUTBOX_MAX_ATTEMPTS,
+    config.OUTBOX_RETRY_BASE,
+    config.OUTBOX_POLL_INTERVAL,
+    config.NOTIFY_CONCURRENCY,
+)
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import select, text
+
+from config import config
+from database import AsyncSessionLocal, SchedulerCursor, async_engine
+
+logger = logging.getLogger(__name__)
+
+# Задачи планировщика выполняются параллельно в каждой реплике, поэтому сами берут блокировку
+_local_locks = {}
+
+def lock_key(name: str) -> int:
+    """Стабильный 64-битный ключ advisory lock для имени задачи."""
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], "big", signed=True)
+
+@asynccontextmanager
+async def advisory_lock(name: str):
+    """Пытается взять блокировку name без ожидания; отдаёт True, если она получена.
+
+    В PostgreSQL это pg_try_advisory_lock, общая для всех реплик; блокировка держится
+    на отдельном соединении и снимается при выходе (или при обрыве соединения).
+    SQLite используется одним процессом, там достаточно asyncio.Lock.
+    """
+    if async_engine.dialect.name != "postgresql":
+        lock = _local_locks.setdefault(name, asyncio.Lock())
+        if lock.locked():
+            yield False
+            return
+        async with lock:
+            yield True
+        return
+    key = lock_key(name)
+    async with async_engine.connect() as conn:
+        acquired = await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": key})
+        # Блокировка уровня сессии переживает транзакцию; соединение не остаётся «idle in transaction»
+        await conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+                await conn.commit()
+
+async def get_cursor(name: str) -> datetime | None:
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(select(SchedulerCursor.last_run_at).where(SchedulerCursor.name == name))
+
+async def set_cursor(name: str, value: datetime):
+    async with AsyncSessionLocal() as db:
+        cursor = await db.get(SchedulerCursor, name)
+        if cursor is None:
+            db.add(SchedulerCursor(name=name, last_run_at=value))
+        else:
+            cursor.last_run_at = value
+        await db.commit()
+
+def create_scheduler() -> AsyncIOScheduler:
+    """Планировщик с задачами в памяти: расписание заново регистрируется при старте каждой реплики.
+
+    Общий SQLAlchemyJobStore не подходит: он работает через синхронный движок и блокирует цикл событий,
+    а несколько планировщиков на одном хранилище APScheduler 3.x не поддерживает. Пропущенные
+    за время простоя слоты досылаются по курсору в БД (get_cursor/set_cursor), а не силами планировщика.
+    """
+    return AsyncIOScheduler(
+        jobstores={"default": MemoryJobStore()},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 3600},
+    )
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from config import config
+from services.bans import ban_list
+from services.identity import set_reachable
+from utils.rate_limiter import RateLimiter, PriorityRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений: чем меньше, тем раньше сообщение получает токен
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REMINDER = 1
+PRIORITY_BROADCAST = 2
+
+# Методы API, на которые распространяются лимиты Telegram на отправку сообщений
+LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "sendInvoice",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageReplyMarkup",
+}
+
+def is_unreachable_error(error: Exception) -> bool:
+    """Ошибка означает, что пользователь заблокировал бота или чата больше нет."""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+# 429 сразу по нескольким чатам за короткое окно считаем общим лимитом бота, а не лимитом одного чата
+GLOBAL_FLOOD_WINDOW = 1.0
+GLOBAL_FLOOD_CHATS = 3
+
+# Приоритет текущей отправки; ответы в хендлерах идут с приоритетом по умолчанию
+outbound_priority = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+class Sender(BaseRequestMiddleware):
+    """Единая точка исходящих сообщений бота.
+
+    Подключается к сессии бота как request-middleware, поэтому через общий лимит
+    проходят и ответы хендлеров, и рассылки: token bucket процесса с приоритетами,
+    token bucket на каждый чат и повтор после TelegramRetryAfter. После 429 приостанавливается
+    только чат, получивший его; вся отправка — лишь когда 429 приходят по нескольким чатам сразу.
+    Массовые уведомления отправляются через send_many с ограниченным параллелизмом.
+
+    Лимит действует в пределах процесса: уведомления из outbox доставляет одна реплика
+    (см. services/outbox.py), а ответы хендлеров распределяются между репликами вместе с апдейтами.
+    """
+
+    def __init__(self, rate: float, per_chat_rate: float, per_chat_burst: int,
+                 concurrency: int, max_retries: int, max_chats: int = 10000):
+        self.limiter = PriorityRateLimiter(rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chat_limiters = OrderedDict()
+        self._recent_floods = deque()
+
+    def _chat_limiter(self, chat_id):
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = RateLimiter(self.per_chat_rate, self.per_chat_burst)
+            while len(self._chat_limiters) > self.max_chats:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    def _is_global_flood(self, chat_id) -> bool:
+        now = time.monotonic()
+        self._recent_floods.append((now, chat_id))
+        while self._recent_floods and self._recent_floods[0][0] < now - GLOBAL_FLOOD_WINDOW:
+            self._recent_floods.popleft()
+        return chat_id is None or len({chat for _, chat in self._recent_floods}) >= GLOBAL_FLOOD_CHATS
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ not in LIMITED_METHODS:
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._chat_limiter(chat_id).acquire()
+            await self.limiter.acquire(outbound_priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                if self._is_global_flood(chat_id):
+                    logger.warning(f"Telegram просит подождать {e.retry_after} с, вся отправка приостановлена")
+                    self.limiter.pause(e.retry_after)
+                else:
+                    logger.warning(f"Telegram просит подождать {e.retry_after} с, отправка в чат {chat_id} приостановлена")
+                    self._chat_limiter(chat_id).pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    async def send_many(self, bot, notifications, priority: int = PRIORITY_REMINDER):
+        """Отправляет уведомления (key, chat_id, text[, параметры send_message]) параллельно.
+        Возвращает ключи успешно доставленных сообщений. Получатели, заблокировавшие бота,
+        отмечаются недоступными и исключаются из следующих рассылок."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Заблокированным пользователям уведомления не отправляются
+        notifications = [n for n in notifications if n[1] not in ban_list]
+        unreachable = []
+
+        async def send_one(key, chat_id, text, options=None):
+            async with semaphore:
+                outbound_priority.set(priority)
+                try:
+                    await bot.send_message(chat_id, text, **(options or {}))
+                    return key
+                except Exception as e:
+                    if is_unreachable_error(e):
+                        unreachable.append(chat_id)
+                    else:
+                        logger.error(f"Ошибка отправки уведомления пользователю {chat_id}: {e}")
+                    return None
+
+        results = await asyncio.gather(*(send_one(*n) for n in notifications))
+        try:
+            await set_reachable(unreachable, False)
+        except Exception as e:
+            logger.error(f"Не удалось отметить недоступных пользователей: {e}")
+        return [key for key in results if key is not None]
+
+sender = Sender(
+    config.NOTIFY_RATE_PER_SEC,
+    config.NOTIFY_PER_CHAT_RATE,
+    config.NOTIFY_PER_CHAT_BURST,
+    config.NOTIFY_CONCURRENCY,
+    config.NOTIFY_MAX_RETRIES,
+)
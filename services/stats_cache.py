@@ -0,0 +1,145 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from config import config
+from database import Car
+
+logger = logging.getLogger(__name__)
+
+class MemoryBackend:
+    """LRU-кеш в памяти процесса с временем жизни записей.
+
+    Версии тоже живут только в этом процессе, поэтому бэкенд годится лишь для одной реплики.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        # user_id -> (срок жизни, версия) в порядке последнего сброса
+        self._versions = OrderedDict()
+
+    async def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get_version(self, user_id):
+        item = self._versions.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            return 0
+        return item[1]
+
+    async def bump_version(self, user_id, ttl):
+        # Как и в Redis, версия живёт дольше данных: к её истечению записи со старыми версиями уже устарели
+        now = time.monotonic()
+        version = await self.get_version(user_id) + 1
+        self._versions[user_id] = (now + ttl * 2, version)
+        self._versions.move_to_end(user_id)
+        while self._versions:
+            oldest_id, (expires_at, _) = next(iter(self._versions.items()))
+            if expires_at >= now and len(self._versions) <= self.max_size:
+                break
+            self._versions.popitem(last=False)
+            if expires_at >= now:
+                # Версия вытеснена раньше срока: удаляем и данные пользователя, иначе станут видны старые записи
+                prefix = f"stats:{oldest_id}:"
+                for key in [key for key in self._data if key.startswith(prefix)]:
+                    del self._data[key]
+
+class RedisBackend:
+    """Хранение в Redis (или совместимом сервере), общее для нескольких процессов бота."""
+
+    def __init__(self, url: str):
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+
+    async def get(self, key):
+        raw = await self.redis.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key, value, ttl):
+        await self.redis.set(key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    async def get_version(self, user_id):
+        version = await self.redis.get(f"stats:ver:{user_id}")
+        return int(version) if version else 0
+
+    async def bump_version(self, user_id, ttl):
+        # Версия живёт дольше данных, иначе после её истечения снова станут видны старые записи
+        key = f"stats:ver:{user_id}"
+        await self.redis.incr(key)
+        await self.redis.expire(key, ttl * 2)
+
+class StatsCache:
+    """Кеш посчитанной статистики пользователя.
+
+    Ключ содержит версию данных пользователя: любое изменение заправок, обслуживания,
+    страховок или машин увеличивает версию, и старые записи больше не читаются.
+    """
+
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def get_or_load(self, user_id, name, loader):
+        if self.backend is None:
+            return await loader()
+        try:
+            version = await self.backend.get_version(user_id)
+            key = f"stats:{user_id}:{version}:{name}"
+            value = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Кеш статистики недоступен: {e}")
+            return await loader()
+        if value is not None:
+            return value
+        value = await loader()
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить статистику в кеш: {e}")
+        return value
+
+    async def invalidate(self, user_id):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.bump_version(user_id, self.ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сбросить кеш статистики пользователя {user_id}: {e}")
+
+    async def invalidate_car(self, db, car_id):
+        user_id = await db.scalar(select(Car.user_id).where(Car.id == car_id))
+        if user_id is not None:
+            await self.invalidate(user_id)
+
+def make_backend():
+    """Redis при заданном REDIS_URL, иначе память процесса. В режиме webhook бот работает несколькими
+    репликами, и сброс кеша в памяти одной из них не виден остальным, поэтому без Redis кеш отключается."""
+    if config.REDIS_URL:
+        try:
+            return RedisBackend(config.REDIS_URL)
+        except ImportError:
+            logger.warning("REDIS_URL задан, но пакет redis не установлен")
+    if config.BOT_MODE == "webhook":
+        logger.warning("Кеш статистики отключён: при нескольких репликах нужен REDIS_URL")
+        return None
+    return MemoryBackend(config.STATS_CACHE_SIZE)
+
+stats_cache = StatsCache(make_backend(), config.STATS_CACHE_TTL)
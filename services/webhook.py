@@ -0,0 +1,154 @@
+import asyncio
+import hmac
+import logging
+import signal
+import time
+from collections import OrderedDict
+
+from aiogram.types import Update
+from aiohttp import web
+from sqlalchemy import text
+
+from config import config
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class UpdateDeduplicator:
+    """Помнит недавние update_id, чтобы повторная доставка Telegram не обрабатывалась дважды.
+
+    Без Redis список живёт в памяти процесса; с REDIS_URL он общий для всех реплик.
+    """
+
+    def __init__(self, ttl: int, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self.redis = None
+        if config.REDIS_URL:
+            try:
+                from redis.asyncio import Redis
+                self.redis = Redis.from_url(config.REDIS_URL)
+            except ImportError:
+                logger.warning("REDIS_URL задан, но пакет redis не установлен — дубли апдейтов отсекаются в памяти")
+
+    async def first_seen(self, update_id: int) -> bool:
+        if self.redis is not None:
+            try:
+                return bool(await self.redis.set(f"update:{update_id}", 1, nx=True, ex=self.ttl))
+            except Exception as e:
+                logger.warning(f"Redis недоступен для проверки дублей апдейтов: {e}")
+        now = time.monotonic()
+        while self._seen and next(iter(self._seen.values())) < now:
+            self._seen.popitem(last=False)
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = now + self.ttl
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+class WebhookServer:
+    """aiohttp-сервер, принимающий апдейты от Telegram.
+
+    Запрос проверяется по секретному токену, апдейт кладётся в ограниченную очередь и
+    сразу подтверждается; обрабатывают очередь workers воркеров. При переполнении очереди
+    отвечаем 503 — Telegram повторит доставку позже.
+    """
+
+    def __init__(self, bot, dp, workers: int, queue_size: int):
+        self.bot = bot
+        self.dp = dp
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dedup = UpdateDeduplicator(config.WEBHOOK_DEDUP_TTL)
+        self.ready = False
+        self._tasks = []
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), config.WEBHOOK_SECRET
+        ):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт в вебхуке: {e}")
+            return web.Response(status=400)
+        if self.queue.full():
+            return web.Response(status=503)
+        if not await self.dedup.first_seen(update.update_id):
+            return web.Response()
+        self.queue.put_nowait(update)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        """Готовность реплики: сервер принимает апдейты и БД отвечает."""
+        status = 200 if self.ready else 503
+        db_ok = True
+        try:
+            async with AsyncSessionLocal() as db:
+                await asyncio.wait_for(db.execute(text("SELECT 1")), 2)
+        except Exception:
+            db_ok, status = False, 503
+        return web.json_response(
+            {"ready": self.ready, "database": db_ok, "queue": self.queue.qsize()}, status=status
+        )
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        app = web.Application()
+        app.router.add_post(config.WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/health", self.health)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp, **self.dp.workflow_data)
+        await site.start()
+        await self.bot.set_webhook(
+            config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+        self.ready = True
+        logger.info(f"Вебхук слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}, воркеров: {self.workers}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        try:
+            await stop.wait()
+        finally:
+            # Вебхук не удаляем: остальные реплики продолжают принимать апдейты
+            self.ready = False
+            await runner.cleanup()
+            try:
+                await asyncio.wait_for(self.queue.join(), config.WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не дождались обработки {self.queue.qsize()} апдейтов при остановке")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp, **self.dp.workflow_data)
+            logger.info("Вебхук-сервер остановлен")
+
+async def run_webhook(bot, dp):
+    await WebhookServer(bot, dp, config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE_SIZE).run()
@@ -0,0 +1,103 @@
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины текста одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+def split_point(text: str, limit: int) -> int:
+    """Где разрезать текст длиннее limit: по абзацу, строке или пробелу, в крайнем случае ровно по лимиту."""
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, limit)
+        if index > limit // 2:
+            return index
+    return limit
+
+class StreamingMessage:
+    """Сообщение, которое дописывается по мере генерации текста.
+
+    Правки отправляются не чаще раза в interval секунд, чтобы не упираться в лимит Telegram
+    на редактирование; текст длиннее лимита продолжается в следующем сообщении.
+    Во время генерации текст идёт с явным parse_mode=None: у бота разметка Markdown по умолчанию,
+    а незакрытая разметка в недописанном тексте ломает правку. finish() применяет parse_mode
+    к готовым сообщениям, а если разметка не разбирается — оставляет простой текст.
+    """
+
+    def __init__(self, bot, chat_id: int, header: str = "", message_id: int | None = None,
+                 interval: float = 1.5, limit: int = MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.limit = limit
+        self._text = header
+        self._shown = None
+        self._last_edit = 0.0
+        # Уже заполненные сообщения: (message_id, текст)
+        self._done = []
+
+    async def _show(self, text: str):
+        if text == self._shown:
+            return
+        if self.message_id is None:
+            message = await self.bot.send_message(self.chat_id, text, parse_mode=None)
+            self.message_id = message.message_id
+        else:
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, parse_mode=None)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def append(self, delta: str):
+        self._text += delta
+        while len(self._text) > self.limit:
+            cut = split_point(self._text, self.limit)
+            head, self._text = self._text[:cut].rstrip(), self._text[cut:].lstrip()
+            await self._show(head)
+            self._done.append((self.message_id, head))
+            self.message_id, self._shown = None, None
+        if self._text.strip() and time.monotonic() - self._last_edit >= self.interval:
+            await self._show(self._text)
+
+    async def _format(self, message_id: int, text: str, parse_mode: str):
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=message_id, parse_mode=parse_mode)
+        except TelegramBadRequest as e:
+            logger.debug(f"Разметка не применена к сообщению {message_id}: {e}")
+
+    async def _send_final(self, text: str, parse_mode: str | None, reply_markup):
+        """Последнее сообщение отправляется заново: клавиатуру ответа нельзя прикрепить правкой."""
+        if self.message_id is not None:
+            try:
+                await self.bot.delete_message(self.chat_id, self.message_id)
+            except Exception as e:
+                logger.debug(f"Не удалось удалить промежуточное сообщение {self.message_id}: {e}")
+        try:
+            message = await self.bot.send_message(self.chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            if parse_mode is None:
+                raise
+            logger.debug(f"Разметка не применена к ответу: {e}")
+            message = await self.bot.send_message(self.chat_id, text, parse_mode=None, reply_markup=reply_markup)
+        self.message_id = message.message_id
+
+    async def finish(self, parse_mode: str | None = None, reply_markup=None):
+        """Показывает остаток текста и, если задан parse_mode, применяет разметку.
+        С reply_markup последнее сообщение отправляется заново вместе с клавиатурой."""
+        if parse_mode:
+            for message_id, text in self._done:
+                await self._format(message_id, text, parse_mode)
+        if not self._text.strip():
+            return
+        if reply_markup is not None:
+            await self._send_final(self._text, parse_mode, reply_markup)
+            return
+        await self._show(self._text)
+        if parse_mode:
+            await self._format(self.message_id, self._text, parse_mode)